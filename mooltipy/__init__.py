@@ -26,7 +26,15 @@ Classes:
                 Some client-side code should be universal amongst apps
                 and MooltipassClient() should be a layer fulfilling
                 this need.
+    AsyncMooltipassClient -- MooltipassClient for asyncio; commands
+                are coroutines and a single reader task routes replies.
+    MooltipassEmulator -- Simulated Mooltipass speaking the same USB
+                packet protocol. Hand one to MooltipassClient() (or set
+                MOOLTIPY_EMULATOR to a state file) to run without a
+                device.
 
 """
 
 from .mooltipass_client import MooltipassClient
+from .async_client import AsyncMooltipassClient
+from .emulator import MooltipassEmulator
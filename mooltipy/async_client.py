@@ -0,0 +1,457 @@
+# This file is part of Mooltipy.
+#
+# Mooltipy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Mooltipy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Mooltipy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""asyncio flavour of MooltipassClient.
+
+AsyncMooltipassClient mirrors MooltipassClient but every command is a
+coroutine. A single reader task drains the IN endpoint and hands each
+packet to the command waiting on its command byte, so waiting for the
+user to confirm something on the device does not block the event loop:
+
+    async with AsyncMooltipassClient() as mooltipass:
+        if await mooltipass.set_context('example.com'):
+            password = await mooltipass.get_password()
+
+Blocking endpoint reads are done in the loop's default executor with a
+short timeout; only one read is ever in flight per device. Endpoint
+writes and compressing data to write run in the executor too.
+"""
+
+from array import array
+from collections import deque
+
+import asyncio
+import logging
+import random
+import struct
+import weakref
+
+import usb.core
+
+from .commands import COMMANDS
+from .compression import CONTAINER_FLAG, DIGEST_FLAG, DIGEST_SIZE, LENGTH_MASK, Decompressor
+from .constants import *
+from .mooltipass import _Mooltipass, _USBTimeoutError
+from .mooltipass import str_from_array
+from .mooltipass_client import make_node, PARENT_DATA, _framed_bytes
+
+
+class _Waiter:
+    """A command waiting for its reply packets."""
+
+    def __init__(self, future, complete):
+        self.future = future
+        self.complete = complete
+        self.packets = []
+
+
+class AsyncMooltipassClient:
+    """Awaitable counterpart of MooltipassClient.
+
+    Call open() (or use "async with") before sending commands.
+
+    Nodes returned by read_node() are the usual ParentNode, ChildNode
+    and DataNode objects; their write() returns an awaitable, but
+    delete() is only available through MooltipassClient.
+    """
+
+    valid_params = _Mooltipass.valid_params
+
+    def __init__(self, device=None, use_daemon=True, poll_interval=100):
+        """Find the Mooltipass.
+
+        Keyword arguments:
+            device -- see _Mooltipass().
+            use_daemon -- see _Mooltipass().
+            poll_interval -- ms each endpoint read waits before
+                    checking whether the reader should stop.
+        """
+        self._mooltipass = _Mooltipass(device, use_daemon)
+        self._poll_interval = poll_interval
+        self._waiters = {}
+        self._reader = None
+        self._lock = None
+        self._error = None
+        self.flash_size = None
+        self.version = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def open(self):
+        """Start the reader task, ping and query the version."""
+        self._lock = asyncio.Lock()
+        self._reader = asyncio.get_running_loop().create_task(self._read_packets())
+        if not await self.ping():
+            await self.close()
+            raise RuntimeError('Mooltipass did not respond to ping.')
+        self.flash_size, self.version = await self.get_version()
+        logging.debug('Connected to Mooltipass {} w/ {} Mb Flash'.format(
+                self.version,
+                self.flash_size))
+
+    async def close(self):
+        """Stop the reader task."""
+        if self._reader is not None:
+            self._reader.cancel()
+            try:
+                await self._reader
+            except asyncio.CancelledError:
+                pass
+            self._reader = None
+
+    # Packet routing
+    # --------------
+
+    async def _read_packets(self):
+        """Drain the IN endpoint, routing packets by command byte."""
+        loop = asyncio.get_running_loop()
+        epin = self._mooltipass._epin
+        while True:
+            try:
+                recv = await loop.run_in_executor(
+                        None, epin.read, epin.wMaxPacketSize, self._poll_interval)
+            except _USBTimeoutError:
+                continue
+            except usb.core.USBError as e:
+                self._fail(e)
+                return
+            self._route(recv)
+
+    def _route(self, recv):
+        cmd = recv[_Mooltipass._CMD_INDEX]
+        if cmd == CMD_DEBUG:
+            debug_msg = str_from_array(recv[_Mooltipass._DATA_INDEX:recv[_Mooltipass._PKT_LEN_INDEX]+1])
+            self._fail(RuntimeError('Received debug message {}'.format(debug_msg)))
+            return
+        elif cmd == 0xC4:
+            # See _Mooltipass.recv_packet()
+            logging.debug('Ignoring resend request (0xC4)')
+            return
+
+        waiters = self._waiters.get(cmd)
+        if not waiters:
+            logging.debug('Dropping unsolicited packet CMD:0x{:x}'.format(cmd))
+            return
+        waiter = waiters[0]
+        waiter.packets.append(recv)
+        if waiter.complete(waiter.packets):
+            waiters.popleft()
+            if not waiter.future.done():
+                waiter.future.set_result(waiter.packets)
+
+    def _fail(self, error):
+        """Fail every pending command with error."""
+        self._error = error
+        for waiters in self._waiters.values():
+            while waiters:
+                future = waiters.popleft().future
+                if not future.done():
+                    future.set_exception(error)
+
+    async def _command(self, cmd, *args, timeout=17500):
+        """Send a command and return its decoded reply.
+
+        Arguments are packed and the reply decoded as per COMMANDS.
+
+        Keyword argument:
+            timeout -- ms to wait for the reply; raises
+                    asyncio.TimeoutError when exceeded.
+        """
+        if self._error is not None:
+            raise self._error
+        response = COMMANDS[cmd].response
+        async with self._lock:
+            waiter = _Waiter(asyncio.get_running_loop().create_future(), response.complete)
+            waiters = self._waiters.setdefault(cmd, deque())
+            waiters.append(waiter)
+            await asyncio.get_running_loop().run_in_executor(
+                    None, self._mooltipass._send_command, cmd, args)
+            try:
+                packets = await asyncio.wait_for(waiter.future, timeout / 1000)
+            except asyncio.TimeoutError:
+                if waiter in waiters:
+                    waiters.remove(waiter)
+                raise
+        return response.decode(packets)
+
+    # Commands
+    # --------
+
+    async def ping(self):
+        """Ping the mooltipass.
+
+        Return true/false on success/failure.
+        """
+        data = array('B', [random.randint(0,255) for _ in range(4)])
+        try:
+            recv = await self._command(CMD_PING, data)
+        except Exception as e:
+            logging.error(e)
+            return False
+        return recv[:4] == data
+
+    async def get_version(self):
+        """Return mooltipass (flash_size, version), as _Mooltipass does."""
+        return await self._command(CMD_VERSION)
+
+    async def set_context(self, context):
+        """Set mooltipass context.
+
+        Return True if successful, False if context is unknown and
+        None if no card is in the mooltipass.
+        """
+        recv = await self._command(CMD_CONTEXT, context, timeout=10000)
+        resp = {0:False, 1:True, 3:None}
+        return resp[recv]
+
+    async def get_login(self):
+        """Get the login for current context or 0 on failure."""
+        return await self._command(CMD_GET_LOGIN)
+
+    async def get_password(self):
+        """Get the password for current context or 0 on failure."""
+        return await self._command(CMD_GET_PASSWORD)
+
+    async def set_login(self, login):
+        """Set a login. Return 1 or 0 indicating success or failure."""
+        return await self._command(CMD_SET_LOGIN, login)
+
+    async def check_password(self, password):
+        """Compare given password to set password for context.
+
+        Returns 1 or 0 indicating success or failure.
+        """
+        recv = None
+        # A return of 0x02 means the device's timer is still counting down.
+        while recv is None or recv == 0x02:
+            recv = await self._command(CMD_CHECK_PASSWORD, password)
+            if recv == 0x02:
+                await asyncio.sleep(.2)
+        return recv
+
+    async def set_password(self, password):
+        """Set password for current context and login.
+
+        Return 1 or 0 indicating success or failure.
+        """
+        if await self.check_password(password):
+            return 0
+        return await self._command(CMD_SET_PASSWORD, password)
+
+    async def add_context(self, context):
+        """Add a context. Return 1 or 0 indicating success or failure."""
+        return await self._command(CMD_ADD_CONTEXT, context)
+
+    async def get_random_number(self):
+        """Get 32 random bytes."""
+        return (await self._command(CMD_GET_RANDOM_NUMBER))[0]
+
+    async def get_status(self):
+        """Return raw mooltipass status as int. See _Mooltipass."""
+        return await self._command(CMD_MOOLTIPASS_STATUS)
+
+    async def start_memory_management(self, timeout=20000):
+        """Enter memory management mode.
+
+        Return true/false on success/failure. May raise RuntimeError
+        if mooltipass is not unlocked.
+        """
+        if not await self.get_status() == 0x05:
+            raise RuntimeError('Cannot enter memory management mode; ' + \
+                    'mooltipass not unlocked.')
+
+        # Already in memory management mode if we can get starting parent
+        if await self.get_starting_parent_address():
+            return True
+
+        print('Accept memory management mode to continue...')
+        return await self._command(CMD_START_MEMORYMGMT, timeout=timeout)
+
+    async def end_memory_management(self):
+        """End memory management mode.
+
+        Return 1 or 0 indicating success or failure."""
+        return await self._command(CMD_END_MEMORYMGMT)
+
+    async def set_data_context(self, context):
+        """Set the data context. Return 1 or 0."""
+        return await self._command(CMD_SET_DATA_SERVICE, context)
+
+    async def add_data_context(self, context):
+        """Add a data context. Return 1 or 0."""
+        return await self._command(CMD_ADD_DATA_SERVICE, context)
+
+    async def write_data_context(self, data, callback=None, compression=None, digest=False):
+        """Write to mooltipass data context.
+
+        See MooltipassClient.write_data_context(); the data is stored
+        in the same format. Return True or raise RuntimeError on an
+        unexpected reply.
+        """
+        BLOCK_SIZE = 32
+
+        ext_data = await asyncio.get_running_loop().run_in_executor(
+                None, _framed_bytes, data, compression, digest)
+
+        view = memoryview(ext_data)
+        for i in range(0, len(ext_data), BLOCK_SIZE):
+            eod = 0 if len(ext_data) - i > BLOCK_SIZE else 1
+            if not await self._command(CMD_WRITE_32B_IN_DN, eod, view[i:i+BLOCK_SIZE]):
+                raise RuntimeError('Unexpected return')
+            if callback:
+                callback((i+BLOCK_SIZE, len(ext_data)))
+        return True
+
+    async def read_data_context(self, callback=None):
+        """Read data from context.
+
+        See MooltipassClient.read_data_context(); compressed data is
+        decompressed. Return data as array.
+        """
+        data = array('B')
+        while True:
+            block = await self._command(CMD_READ_32B_IN_DN, timeout=5000)
+            # A lone 0 marks the end of the data
+            if len(block) == 1:
+                break
+            data.extend(block)
+            if callback:
+                if len(data) == 32:
+                    full_size = struct.unpack('>L', data[:4])[0] & LENGTH_MASK
+                callback((len(data), full_size))
+
+        lod = struct.unpack('>L', data[:4])[0]
+        start = 4 + DIGEST_SIZE if lod & DIGEST_FLAG else 4
+        end = start + (lod & LENGTH_MASK)
+        if not end <= len(data):
+            raise RuntimeError('The size of data received from the device ' + \
+                    'does not match what was expected. This can happen if ' + \
+                    'a data transfer was cancelled.')
+        if lod & CONTAINER_FLAG:
+            container = Decompressor()
+            data = array('B', container.decompress(data[start:end]))
+            container.finish()
+            return data
+        return data[start:end]
+
+    async def read_node(self, node_addr, parent_weak_ref=None):
+        """Read a node and return a Node object.
+
+        Raises RuntimeError if the mooltipass refuses the read or sends
+        a garbled node.
+        """
+        try:
+            recv = await self._command(CMD_READ_FLASH_NODE, node_addr)
+        except ValueError as e:
+            raise RuntimeError('{} (node 0x{:x}).'.format(e, node_addr))
+        if parent_weak_ref is None:
+            parent_weak_ref = weakref.ref(self)()
+        return make_node(node_addr, recv, parent_weak_ref)
+
+    async def _write_node(self, node_number, node_data, chunks=None):
+        """Write a node in flash. Raises RuntimeError on failure.
+
+        All chunks are always sent; chunks is accepted for Node.write().
+        """
+        if not len(node_data) == _Mooltipass._NODE_SIZE:
+            raise RuntimeError('Nodes are expected to be 132 bytes; found {}.'.format(
+                len(node_data)))
+        view = memoryview(node_data)
+        for c, i in enumerate(range(0, len(node_data), 59)):
+            if not await self._command(CMD_WRITE_FLASH_NODE, node_number, c, view[i:i+59]):
+                raise RuntimeError('Write node failed')
+
+    async def write_node(self, node):
+        """Write to a node in memory."""
+        return await self._write_node(node.addr, node.raw)
+
+    async def get_favorite(self, slot_id):
+        """Return parent_addr, child_addr tuple for a favorite slot."""
+        return await self._command(CMD_GET_FAVORITE, slot_id)
+
+    async def set_favorite(self, slot_id, addr_tuple):
+        """Set a favorite to a parent_addr, child_addr tuple."""
+        return await self._command(CMD_SET_FAVORITE, slot_id, *addr_tuple)
+
+    async def get_starting_parent_address(self):
+        """Get the address of the starting parent."""
+        return await self._command(CMD_GET_STARTING_PARENT)
+
+    async def get_starting_data_parent_address(self):
+        """Get the address of the data starting parent."""
+        return await self._command(CMD_GET_DN_START_PARENT)
+
+    async def set_starting_parent(self, parent_addr):
+        """Set the starting parent node, refusing invalid addresses."""
+        valid_addresses = [0]
+        async for pnode in self.parent_nodes('login'):
+            valid_addresses.append(pnode.addr)
+        if not parent_addr in valid_addresses:
+            raise RuntimeError('Can not set the starting parent to an invalid node address!')
+        return await self._command(CMD_SET_STARTING_PARENT, parent_addr)
+
+    async def set_starting_data_parent_addr(self, parent_addr):
+        """Set the data starting parent node, refusing invalid addresses."""
+        valid_addresses = [0]
+        async for pnode in self.parent_nodes('data'):
+            valid_addresses.append(pnode.addr)
+        if not parent_addr in valid_addresses:
+            raise RuntimeError('Can not set the starting parent to an invalid node address!')
+        return await self._command(CMD_SET_DN_START_PARENT, parent_addr)
+
+    async def get_param(self, param):
+        """Gets the value of a setting on the mooltipass."""
+        return await self._command(CMD_GET_MOOLTIPASS_PARM, param)
+
+    async def set_param(self, param, value):
+        """Sets a setting on the mooltipass. Return 1 or 0."""
+        return await self._command(CMD_SET_MOOLTIPASS_PARM, param, value)
+
+    def cancel_user_request(self):
+        """Cancel user input request. Nothing is sent back."""
+        self._mooltipass._send_command(CMD_CANCEL_USER_REQUEST)
+
+    async def parent_nodes(self, node_type=None):
+        """Asynchronously iterate parent nodes.
+
+        Arguments:
+            node_type = [login|data]
+        """
+        if not node_type in ['login','data']:
+            raise RuntimeError('node_type must be \'login\' or \'data\'')
+        if node_type == 'login':
+            addr = await self.get_starting_parent_address()
+        else:
+            addr = await self.get_starting_data_parent_address()
+        while addr:
+            pnode = await self.read_node(addr)
+            yield pnode
+            addr = pnode.next_parent_addr
+
+    async def child_nodes(self, pnode):
+        """Asynchronously iterate the child or data nodes of pnode."""
+        addr = pnode.next_child_addr
+        while addr:
+            cnode = await self.read_node(addr, pnode)
+            yield cnode
+            if pnode.flags & 0xC000 == PARENT_DATA:
+                addr = cnode.next_data_addr
+            else:
+                addr = cnode.next_child_addr
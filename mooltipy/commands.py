@@ -0,0 +1,315 @@
+# This file is part of Mooltipy.
+#
+# Mooltipy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Mooltipy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Mooltipy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Request & response layouts of the Mooltipass USB commands.
+
+COMMANDS maps each command constant to a Command describing how its
+request payload and its reply are laid out. The structs are compiled
+once here and shared by _Mooltipass, _Batch, AsyncMooltipassClient and
+the emulator, which packs replies and unpacks requests with the same
+codecs.
+
+Packets are [length, command, payload...]; request codecs pack payloads
+straight into a transmit buffer and response codecs decode the list of
+whole reply packets (most commands reply with one packet, nodes take
+three).
+"""
+
+from array import array
+from collections import namedtuple
+
+import struct
+
+from .constants import *
+
+ENCODING = 'ascii'
+
+_LEN_INDEX = 0
+_DATA_INDEX = 2
+
+NODE_SIZE = 132
+NODE_PACKET_SIZE = 62
+# Nodes are written in chunks of 59, 59 and 14 bytes
+NODE_CHUNK_SIZE = 59
+NODE_CHUNKS = 3
+# CMD_GET_30_FREE_SLOTS replies with up to 31 addresses per packet
+FREE_SLOTS_PER_REPLY = 31
+
+
+def _payload(packet):
+    """Return the payload of a whole packet, as per its length byte."""
+    return packet[_DATA_INDEX:_DATA_INDEX+packet[_LEN_INDEX]]
+
+
+# Request codecs
+# --------------
+
+class Fields:
+    """Fixed fields, optionally followed by trailing raw bytes.
+
+    Arguments:
+        fmt -- struct format of the fixed fields ('' for none).
+        tail -- True if raw bytes follow the fields.
+    """
+
+    def __init__(self, fmt='', tail=False):
+        self.struct = struct.Struct(fmt)
+        self.tail = tail
+
+    def pack_into(self, view, offset, *args):
+        """Pack args into view at offset; return bytes written."""
+        if self.tail:
+            args, tail = args[:-1], args[-1]
+        self.struct.pack_into(view, offset, *args)
+        length = self.struct.size
+        if self.tail:
+            view[offset+length:offset+length+len(tail)] = tail
+            length += len(tail)
+        return length
+
+    def unpack(self, data):
+        """Return the tuple of args packed into data."""
+        args = self.struct.unpack_from(data)
+        if self.tail:
+            args += (bytes(data[self.struct.size:]),)
+        return args
+
+
+class CString:
+    """A null terminated string."""
+
+    def pack_into(self, view, offset, value):
+        encoded = value.encode(ENCODING) if isinstance(value, str) else value
+        view[offset:offset+len(encoded)] = encoded
+        view[offset+len(encoded)] = 0
+        return len(encoded) + 1
+
+    def unpack(self, data):
+        """Return the string as bytes, without its terminator."""
+        return (bytes(data).partition(b'\0')[0],)
+
+
+# Response codecs
+# ---------------
+
+class _SinglePacket:
+
+    # Fewest payload bytes of a reply which is not a refusal
+    size = 0
+
+    def complete(self, packets):
+        return True
+
+    def refused(self, packets):
+        """Return True if the reply is a lone refusal byte."""
+        return packets[0][_LEN_INDEX] < self.size
+
+
+class Byte(_SinglePacket):
+    """A single status or value byte."""
+
+    def pack(self, value):
+        return bytes([value & 0xFF])
+
+    def decode(self, packets):
+        return packets[0][_DATA_INDEX]
+
+
+class Struct(_SinglePacket):
+    """Fixed fields; decodes to a scalar if there is only one."""
+
+    def __init__(self, fmt):
+        self.struct = struct.Struct(fmt)
+        self.size = self.struct.size
+        self._scalar = len(self.struct.unpack(bytes(self.struct.size))) == 1
+
+    def pack(self, *values):
+        return self.struct.pack(*values)
+
+    def decode(self, packets):
+        values = self.struct.unpack_from(packets[0], _DATA_INDEX)
+        return values[0] if self._scalar else values
+
+
+class String(_SinglePacket):
+    """A null terminated string.
+
+    Arguments:
+        zero_on_failure -- decode a reply starting with 0 as 0.
+    """
+
+    def __init__(self, zero_on_failure=False):
+        self.zero_on_failure = zero_on_failure
+
+    def pack(self, value):
+        encoded = value.encode(ENCODING) if isinstance(value, str) else value
+        return encoded + b'\x00'
+
+    def decode(self, packets):
+        packet = packets[0]
+        if self.zero_on_failure and packet[_DATA_INDEX] == 0:
+            return 0
+        # The length byte counts the terminator
+        data = packet[_DATA_INDEX:_DATA_INDEX+packet[_LEN_INDEX]-1]
+        return bytes(data).partition(b'\0')[0].decode(ENCODING)
+
+
+class Version(_SinglePacket):
+    """The FLASH_CHIP byte, i.e. Mb of flash, then the version string.
+
+    Decodes to (flash_size, version), e.g. (4, 'v1').
+    """
+
+    def pack(self, flash_size, version):
+        return bytes([flash_size]) + version.encode(ENCODING) + b'\x00'
+
+    def decode(self, packets):
+        data = bytes(_payload(packets[0]))
+        if not data:
+            return 0, ''
+        return data[0], data[1:].partition(b'\0')[0].decode(ENCODING)
+
+
+class Raw(_SinglePacket):
+    """Payload bytes as given by the length byte."""
+
+    def pack(self, value):
+        return bytes(value)
+
+    def decode(self, packets):
+        return _payload(packets[0])
+
+
+class UInt24(_SinglePacket):
+    """A 3 byte, big endian counter."""
+
+    size = 3
+
+    def pack(self, value):
+        return value.to_bytes(3, 'big')
+
+    def decode(self, packets):
+        return int.from_bytes(bytes(packets[0][_DATA_INDEX:_DATA_INDEX+3]), 'big')
+
+
+class Addresses(_SinglePacket):
+    """A list of 2 byte node addresses; a lone 0 byte decodes as none."""
+
+    def pack(self, addrs):
+        return struct.pack('<{}H'.format(len(addrs)), *addrs)
+
+    def decode(self, packets):
+        data = _payload(packets[0])
+        return list(struct.unpack_from('<{}H'.format(len(data) // 2), data))
+
+
+class Node:
+    """A 132 byte node sent as packets of 62, 62 and 8 bytes.
+
+    A one byte reply means the mooltipass refused the read. decode()
+    raises ValueError for refused, short or garbled nodes.
+    """
+
+    def pack(self, node):
+        """Return the payloads of the packets carrying node."""
+        node = bytes(node)
+        return [node[i:i+NODE_PACKET_SIZE]
+                for i in range(0, NODE_SIZE, NODE_PACKET_SIZE)]
+
+    @staticmethod
+    def _expected(received):
+        return min(NODE_PACKET_SIZE, NODE_SIZE - received)
+
+    def refused(self, packets):
+        return packets[0][_LEN_INDEX] == 1
+
+    def complete(self, packets):
+        received = 0
+        for packet in packets:
+            if packet[_LEN_INDEX] != self._expected(received):
+                # Refused or garbled; nothing more is coming
+                return True
+            received += packet[_LEN_INDEX]
+        return received >= NODE_SIZE
+
+    def decode(self, packets):
+        if self.refused(packets):
+            raise ValueError('Mooltipass refused to read node')
+        received = 0
+        for packet in packets:
+            length = packet[_LEN_INDEX]
+            expected = self._expected(received)
+            if length != expected:
+                raise ValueError('Garbled node; expected a {} byte packet, got {}'.format(
+                        expected, length))
+            received += length
+        if received != NODE_SIZE:
+            raise ValueError('Short node; got {} of {} bytes'.format(received, NODE_SIZE))
+        node = array('B')
+        for packet in packets:
+            node.extend(_payload(packet))
+        return node
+
+
+# Command table
+# -------------
+
+Command = namedtuple('Command', 'cmd, name, request, response')
+
+NONE = Fields()
+BYTE = Byte()
+ADDRESS = Fields('<H')
+
+_commands = [
+    Command(CMD_PING,                'ping',                  Fields('', tail=True), Raw()),
+    Command(CMD_VERSION,             'get_version',           NONE,                  Version()),
+    Command(CMD_CONTEXT,             'set_context',           CString(),             BYTE),
+    Command(CMD_GET_LOGIN,           'get_login',             NONE,                  String(True)),
+    Command(CMD_GET_PASSWORD,        'get_password',          NONE,                  String(True)),
+    Command(CMD_SET_LOGIN,           'set_login',             CString(),             BYTE),
+    Command(CMD_SET_PASSWORD,        'set_password',          CString(),             BYTE),
+    Command(CMD_CHECK_PASSWORD,      'check_password',        CString(),             BYTE),
+    Command(CMD_ADD_CONTEXT,         'add_context',           CString(),             BYTE),
+    Command(CMD_GET_RANDOM_NUMBER,   'get_random_number',     NONE,                  Raw()),
+    Command(CMD_START_MEMORYMGMT,    'start_memory_management', NONE,                BYTE),
+    Command(CMD_SET_MOOLTIPASS_PARM, 'set_param',             Fields('BB'),          BYTE),
+    Command(CMD_GET_MOOLTIPASS_PARM, 'get_param',             Fields('B'),           BYTE),
+    Command(CMD_MOOLTIPASS_STATUS,   'get_status',            NONE,                  BYTE),
+    Command(CMD_SET_DATE,            'set_date',              Fields('<H'),          BYTE),
+    Command(CMD_SET_DATA_SERVICE,    'set_data_context',      CString(),             BYTE),
+    Command(CMD_ADD_DATA_SERVICE,    'add_data_context',      CString(),             BYTE),
+    # End of data flag then a block of up to 32 bytes
+    Command(CMD_WRITE_32B_IN_DN,     'write_32b',             Fields('B', tail=True), BYTE),
+    # 32 bytes of data, or a single 0 once there is no more
+    Command(CMD_READ_32B_IN_DN,      'read_32b',              NONE,                  Raw()),
+    # 8 bytes of CPZ, or a single 0 without an unlocked card
+    Command(CMD_GET_CUR_CARD_CPZ,    'get_card_cpz',          NONE,                  Raw()),
+    Command(CMD_CANCEL_USER_REQUEST, 'cancel_user_request',   NONE,                  None),
+    Command(CMD_READ_FLASH_NODE,     'read_node',             ADDRESS,               Node()),
+    # Node address, chunk number (0-2) then up to 59 bytes of the node
+    Command(CMD_WRITE_FLASH_NODE,    'write_node',            Fields('<HB', tail=True), BYTE),
+    Command(CMD_GET_FAVORITE,        'get_favorite',          Fields('B'),           Struct('<HH')),
+    Command(CMD_SET_FAVORITE,        'set_favorite',          Fields('<BHH'),        BYTE),
+    Command(CMD_GET_STARTING_PARENT, 'get_starting_parent',   NONE,                  Struct('<H')),
+    Command(CMD_SET_STARTING_PARENT, 'set_starting_parent',   ADDRESS,               BYTE),
+    Command(CMD_GET_CTRVALUE,        'get_ctr',               NONE,                  UInt24()),
+    Command(CMD_SET_CTRVALUE,        'set_ctr',               Fields('3s'),          BYTE),
+    Command(CMD_GET_30_FREE_SLOTS,   'get_free_slots',        ADDRESS,               Addresses()),
+    Command(CMD_GET_DN_START_PARENT, 'get_data_starting_parent', NONE,               Struct('<H')),
+    Command(CMD_SET_DN_START_PARENT, 'set_data_starting_parent', ADDRESS,            BYTE),
+    Command(CMD_END_MEMORYMGMT,      'end_memory_management', NONE,                  BYTE),
+]
+
+COMMANDS = {command.cmd: command for command in _commands}
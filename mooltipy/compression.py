@@ -0,0 +1,172 @@
+# This file is part of Mooltipy.
+#
+# Mooltipy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Mooltipy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Mooltipy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compressed container for data context payloads.
+
+MooltipassClient writes data contexts behind a 4 byte, big endian
+length. Plain data follows the length directly. When bit 31 of the
+length is set, which plain data can not do as the flash is far smaller,
+the length counts the bytes of a container instead:
+
+    version (1) | method (1) | size of the data (4, big endian) | stream
+
+where stream is the data compressed with zlib or lzma.
+
+When bit 30 is set, a 16 byte BLAKE2b digest of the data, as it was
+before compressing, sits between the length and what it counts. It
+fits in the first block read back, so whether a context holds some data
+can be checked without reading the rest.
+"""
+
+import hashlib
+import lzma
+import struct
+import tempfile
+import zlib
+
+CONTAINER_FLAG = 0x80000000
+CONTAINER_VERSION = 1
+
+DIGEST_FLAG = 0x40000000
+DIGEST_SIZE = 16
+
+# The bits of the length which count bytes
+LENGTH_MASK = 0x3FFFFFFF
+
+# Container method byte of each compression method
+METHODS = {'zlib': 1, 'lzma': 2}
+
+_HEADER = struct.Struct('>BBL')
+
+# Compressed data is kept in memory up to this size, then on disk
+_SPOOL_SIZE = 1 << 20
+
+
+def new_digest():
+    """Return a hash object for the digest stored with DIGEST_FLAG."""
+    return hashlib.blake2b(digest_size=DIGEST_SIZE)
+
+
+def _compressor(method):
+    if method == 'zlib':
+        return zlib.compressobj(9)
+    # The .lzma format has the smallest header
+    return lzma.LZMACompressor(lzma.FORMAT_ALONE, preset=9)
+
+
+def _decompressor(method):
+    if method == 'zlib':
+        return zlib.decompressobj()
+    return lzma.LZMADecompressor(lzma.FORMAT_ALONE)
+
+
+def compress(chunks, length, methods, digest=None):
+    """Compress the first length bytes of chunks into a container.
+
+    Every method is run over the chunks as they are read, so the data
+    is read once and never held in memory as a whole.
+
+    Arguments:
+        chunks -- iterable of bytes-like chunks.
+        length -- number of bytes to compress.
+        methods -- names of the methods to try (see METHODS).
+
+    Keyword argument:
+        digest -- hash object (see new_digest()) to update with the
+                data on the way.
+
+    Return (spool, size) for the smallest container: a file positioned
+    at its start and the number of bytes in it. Raises RuntimeError if
+    chunks end before length bytes.
+    """
+    compressors = {}
+    spools = {}
+    for method in methods:
+        compressors[method] = _compressor(method)
+        spools[method] = tempfile.SpooledTemporaryFile(_SPOOL_SIZE)
+        spools[method].write(_HEADER.pack(CONTAINER_VERSION, METHODS[method], length))
+
+    remaining = length
+    for chunk in chunks:
+        try:
+            chunk = memoryview(chunk).cast('B')[:remaining]
+        except TypeError:
+            # Not bytes-like (e.g. a list of ints)
+            chunk = memoryview(bytes(chunk))[:remaining]
+        remaining -= len(chunk)
+        if digest is not None:
+            digest.update(chunk)
+        for method, compressor in compressors.items():
+            spools[method].write(compressor.compress(chunk))
+        if not remaining:
+            break
+    if remaining:
+        for spool in spools.values():
+            spool.close()
+        raise RuntimeError('Data ended after {} of {} bytes.'.format(
+                length - remaining, length))
+
+    best = None
+    for method, compressor in compressors.items():
+        spools[method].write(compressor.flush())
+        if best is None or spools[method].tell() < spools[best].tell():
+            best = method
+    for method, spool in spools.items():
+        if method != best:
+            spool.close()
+    spool = spools[best]
+    size = spool.tell()
+    spool.seek(0)
+    return spool, size
+
+
+class Decompressor:
+    """Decompress a container fed in pieces.
+
+    Raises RuntimeError for unknown containers and corrupt data.
+    """
+
+    def __init__(self):
+        self._header = bytearray()
+        self._decompressor = None
+        self.size = None
+        self._received = 0
+
+    def decompress(self, data):
+        """Return the data decompressed from the next piece."""
+        if self._decompressor is None:
+            need = _HEADER.size - len(self._header)
+            self._header += data[:need]
+            data = data[need:]
+            if len(self._header) < _HEADER.size:
+                return b''
+            version, method, self.size = _HEADER.unpack(self._header)
+            names = [name for name, value in METHODS.items() if value == method]
+            if version != CONTAINER_VERSION or not names:
+                raise RuntimeError('Unsupported data container (version {}, method {}).'.format(
+                        version, method))
+            self._decompressor = _decompressor(names[0])
+        try:
+            data = self._decompressor.decompress(data)
+        except (zlib.error, lzma.LZMAError) as e:
+            raise RuntimeError('Corrupt compressed data: {}'.format(e))
+        self._received += len(data)
+        return data
+
+    def finish(self):
+        """Raise RuntimeError unless all of the data was decompressed."""
+        if self._decompressor is None or not self._decompressor.eof or \
+                self._received != self.size:
+            raise RuntimeError('Compressed data is incomplete.')
@@ -34,6 +34,7 @@ CMD_SET_DATA_SERVICE    = 0xBE
 CMD_ADD_DATA_SERVICE    = 0xBF
 CMD_WRITE_32B_IN_DN     = 0xC0
 CMD_READ_32B_IN_DN      = 0xC1
+CMD_GET_CUR_CARD_CPZ    = 0xC2
 CMD_CANCEL_USER_REQUEST = 0xC3
 CMD_READ_FLASH_NODE     = 0xC5
 CMD_WRITE_FLASH_NODE    = 0xC6
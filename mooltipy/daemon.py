@@ -0,0 +1,404 @@
+# This file is part of Mooltipy.
+#
+# Mooltipy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Mooltipy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Mooltipy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A long-lived process owning the Mooltipass.
+
+MooltipassDaemon opens the device once and relays raw 64 byte packets
+between it and clients connecting over a Unix socket. _Mooltipass
+connects to a running daemon automatically (see connect()), so the
+utilities skip USB discovery, kernel driver detaching and resets.
+
+The daemon also keeps memory management mode open between clients: a
+request to end memory management is acknowledged but deferred, and a
+later request to start it is answered without asking the user to
+confirm again. The deferred exit is carried out before any command
+which is not available in memory management mode, after the daemon
+has been idle for a while, and on shutdown. The card CPZ is read as the
+session starts so that later clients can still ask for it. Replies the
+daemon makes up are queued behind those still due for commands sent
+before, so a client pipelining commands reads every reply in order.
+
+Clients are served one at a time. The daemon greets a client with an
+empty K message once it is served, so a client waiting longer than
+DEFAULT_CONNECT_TIMEOUT gives up on a busy daemon, and a client which
+sends nothing for idle_timeout seconds is disconnected.
+
+Messages in either direction are a one byte op code, a two byte big
+endian length and a payload:
+
+    client -> daemon
+        W <packet>          -- write packet to the OUT endpoint
+        R <timeout ms>      -- read a packet from the IN endpoint
+    daemon -> client
+        K <packet>          -- success; packet read if any
+        T                   -- read timed out
+        E <message>         -- USB error
+"""
+
+from array import array
+from collections import deque
+
+import logging
+import os
+import socket
+import struct
+import tempfile
+
+import usb.core
+
+from .commands import COMMANDS
+from .constants import *
+from .mooltipass import _Mooltipass, _USBTimeoutError
+
+DEFAULT_IDLE_TIMEOUT = 300
+# Seconds to wait for the daemon to finish with another client
+DEFAULT_CONNECT_TIMEOUT = 5
+
+# ms to wait for each reply still due before the daemon answers itself
+_COLLECT_TIMEOUT = 5000
+
+# Seconds a reply from the daemon may take beyond any USB read timeout,
+# e.g. while it collects replies still due
+_RESPONSE_TIMEOUT = 60
+
+_OP_WRITE = b'W'
+_OP_READ = b'R'
+_OP_OK = b'K'
+_OP_TIMEOUT = b'T'
+_OP_ERROR = b'E'
+
+_HEADER = struct.Struct('>cH')
+
+# Commands which may be sent while in memory management mode
+_MEMORY_MANAGEMENT_COMMANDS = frozenset([
+        CMD_PING, CMD_VERSION, CMD_GET_RANDOM_NUMBER, CMD_START_MEMORYMGMT,
+        CMD_MOOLTIPASS_STATUS, CMD_CANCEL_USER_REQUEST, CMD_READ_FLASH_NODE,
+        CMD_WRITE_FLASH_NODE, CMD_GET_FAVORITE, CMD_SET_FAVORITE,
+        CMD_GET_STARTING_PARENT, CMD_SET_STARTING_PARENT, CMD_GET_CTRVALUE,
+        CMD_SET_CTRVALUE, CMD_GET_30_FREE_SLOTS, CMD_GET_DN_START_PARENT,
+        CMD_SET_DN_START_PARENT, CMD_END_MEMORYMGMT])
+
+
+def default_socket_path():
+    """Return the socket path from MOOLTIPY_SOCKET or a per-user default."""
+    path = os.environ.get('MOOLTIPY_SOCKET')
+    if path:
+        return path
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    return os.path.join(runtime_dir, 'mooltipy-{}.sock'.format(os.getuid()))
+
+
+def _recv_exact(sock, length):
+    data = b''
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            raise ConnectionError('Connection closed')
+        data += chunk
+    return data
+
+
+def _send_msg(sock, op, payload=b''):
+    sock.sendall(_HEADER.pack(op, len(payload)) + bytes(payload))
+
+
+def _recv_msg(sock):
+    op, length = _HEADER.unpack(_recv_exact(sock, _HEADER.size))
+    return op, _recv_exact(sock, length)
+
+
+def _packet(cmd, payload):
+    packet = array('B', [len(payload), cmd])
+    packet.extend(payload)
+    packet.extend(b'\x00' * (64 - len(packet)))
+    return packet
+
+
+class _ProxyEndpointOut:
+
+    wMaxPacketSize = 64
+
+    def __init__(self, connection):
+        self._connection = connection
+
+    def write(self, data, timeout=None):
+        self._connection.request(_OP_WRITE, data, _RESPONSE_TIMEOUT)
+        return len(data)
+
+
+class _ProxyEndpointIn:
+
+    wMaxPacketSize = 64
+
+    def __init__(self, connection):
+        self._connection = connection
+
+    def read(self, size, timeout=None):
+        payload = struct.pack('>L', timeout or 0)
+        wait = timeout / 1000 + _RESPONSE_TIMEOUT if timeout else None
+        return array('B', self._connection.request(_OP_READ, payload, wait)[:size])
+
+
+class DaemonConnection:
+    """Client side of a connection to MooltipassDaemon.
+
+    Provides epin / epout endpoints for _Mooltipass.
+    """
+
+    def __init__(self, sock):
+        self._sock = sock
+        self.epin = _ProxyEndpointIn(self)
+        self.epout = _ProxyEndpointOut(self)
+
+    def request(self, op, payload, timeout=None):
+        """Send a request; return the payload of the reply.
+
+        Raises RuntimeError if the daemon does not reply within timeout
+        seconds, after which the connection is out of step and closed.
+        """
+        self._sock.settimeout(timeout)
+        try:
+            _send_msg(self._sock, op, payload)
+            op, payload = _recv_msg(self._sock)
+        except socket.timeout:
+            self.close()
+            raise RuntimeError('The mooltipy daemon did not respond.')
+        if op == _OP_TIMEOUT:
+            raise _USBTimeoutError('Operation timed out', errno=110)
+        elif op == _OP_ERROR:
+            raise usb.core.USBError(payload.decode('utf-8', 'replace'))
+        return payload
+
+    def close(self):
+        self._sock.close()
+
+
+def connect(path=None, timeout=DEFAULT_CONNECT_TIMEOUT):
+    """Connect to a running daemon.
+
+    Keyword arguments:
+        path -- socket path (default from default_socket_path()).
+        timeout -- seconds to wait for the daemon to serve this client.
+
+    Return a DaemonConnection or None if no daemon is listening. Raises
+    RuntimeError if the daemon is busy with another client for longer
+    than timeout.
+    """
+    if path is None:
+        path = default_socket_path()
+    if not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    sock.settimeout(timeout)
+    try:
+        _recv_msg(sock)
+    except socket.timeout:
+        sock.close()
+        raise RuntimeError('The mooltipy daemon at {} is busy with another client.'.format(
+                path))
+    except ConnectionError:
+        sock.close()
+        return None
+    logging.debug('Connected to mooltipy daemon at {}'.format(path))
+    return DaemonConnection(sock)
+
+
+class MooltipassDaemon:
+    """Own the Mooltipass and serve clients one at a time."""
+
+    def __init__(self, path=None, device=None, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        """Open the Mooltipass.
+
+        Keyword arguments:
+            path -- socket path (default from default_socket_path()).
+            device -- passed on to _Mooltipass, e.g. an emulator.
+            idle_timeout -- seconds without a client after which a
+                    deferred exit from memory management is carried out,
+                    and without a request after which a client is
+                    disconnected.
+        """
+        self.path = path or default_socket_path()
+        self.idle_timeout = idle_timeout
+        self._mooltipass = _Mooltipass(device, use_daemon=False)
+        self._memory_management = False
+        # CPZ of the card in memory management mode, if known
+        self._card_cpz = None
+        # Replies read ahead of the client, in the order it reads them
+        self._replies = deque()
+        # [cmd, response codec, packets so far] of commands sent to the
+        # device whose replies have not all been read yet
+        self._outstanding = deque()
+
+    def serve_forever(self):
+        """Accept and serve clients until interrupted."""
+        if os.path.exists(self.path):
+            try:
+                connection = connect(self.path)
+            except RuntimeError:
+                # Listening, though busy with a client
+                raise RuntimeError('A daemon is already listening on {}'.format(self.path))
+            if connection is not None:
+                connection.close()
+                raise RuntimeError('A daemon is already listening on {}'.format(self.path))
+            os.unlink(self.path)
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o077)
+        try:
+            server.bind(self.path)
+        finally:
+            os.umask(old_umask)
+        server.listen(8)
+        server.settimeout(self.idle_timeout)
+        logging.info('Listening on {}'.format(self.path))
+
+        try:
+            while True:
+                try:
+                    sock, _ = server.accept()
+                except socket.timeout:
+                    self._end_memory_management()
+                    continue
+                sock.settimeout(self.idle_timeout)
+                try:
+                    _send_msg(sock, _OP_OK)
+                    self._serve(sock)
+                except OSError as e:
+                    # E.g. a client which gave up waiting
+                    logging.debug('Lost client: {}'.format(e))
+                finally:
+                    sock.close()
+                    self._drain()
+        finally:
+            server.close()
+            os.unlink(self.path)
+            self._end_memory_management()
+
+    def _serve(self, sock):
+        while True:
+            try:
+                op, payload = _recv_msg(sock)
+            except socket.timeout:
+                logging.info('Disconnecting an idle client.')
+                return
+            except ConnectionError:
+                return
+            try:
+                if op == _OP_WRITE:
+                    self._write(payload)
+                    _send_msg(sock, _OP_OK)
+                elif op == _OP_READ:
+                    timeout = struct.unpack('>L', payload)[0] or None
+                    _send_msg(sock, _OP_OK, self._read(timeout))
+                else:
+                    _send_msg(sock, _OP_ERROR, b'Unknown request')
+            except _USBTimeoutError:
+                _send_msg(sock, _OP_TIMEOUT)
+            except usb.core.USBError as e:
+                _send_msg(sock, _OP_ERROR, str(e).encode('utf-8'))
+
+    def _write(self, packet):
+        cmd = packet[1] if len(packet) > 1 else 0
+        if self._memory_management and (cmd in (CMD_START_MEMORYMGMT, CMD_END_MEMORYMGMT)
+                                         or cmd not in _MEMORY_MANAGEMENT_COMMANDS):
+            # Replies to earlier commands come first and may end the session
+            self._collect()
+        if self._memory_management:
+            if cmd == CMD_START_MEMORYMGMT:
+                # Session already confirmed by the user
+                self._replies.append(_packet(cmd, b'\x01'))
+                return
+            if cmd == CMD_END_MEMORYMGMT:
+                # Defer so the next client can reuse the session
+                self._replies.append(_packet(cmd, b'\x01'))
+                return
+            if cmd == CMD_GET_CUR_CARD_CPZ and self._card_cpz is not None:
+                # Read as the session started; asking would end it
+                self._replies.append(_packet(cmd, self._card_cpz))
+                return
+            if cmd not in _MEMORY_MANAGEMENT_COMMANDS:
+                self._end_memory_management()
+        elif cmd == CMD_START_MEMORYMGMT:
+            # The device only names the card outside memory management
+            self._collect()
+            try:
+                self._card_cpz = self._mooltipass._get_current_card_cpz()
+            except usb.core.USBError:
+                self._card_cpz = None
+        self._mooltipass._epout.write(packet)
+        command = COMMANDS.get(cmd)
+        if command is not None and command.response is not None:
+            self._outstanding.append([cmd, command.response, []])
+
+    def _read(self, timeout):
+        if self._replies:
+            return self._replies.popleft()
+        return self._read_device(timeout)
+
+    def _read_device(self, timeout):
+        """Read a packet from the device, tracking the session state."""
+        recv = self._mooltipass._epin.read(self._mooltipass._epin.wMaxPacketSize,
+                                           timeout=timeout)
+        cmd = recv[_Mooltipass._CMD_INDEX]
+        value = recv[_Mooltipass._DATA_INDEX]
+        if self._outstanding and self._outstanding[0][0] == cmd:
+            reply = self._outstanding[0]
+            reply[2].append(recv)
+            if reply[1].complete(reply[2]):
+                self._outstanding.popleft()
+        if cmd == CMD_START_MEMORYMGMT and value:
+            self._memory_management = True
+        elif cmd == CMD_END_MEMORYMGMT:
+            self._memory_management = False
+        elif cmd == CMD_MOOLTIPASS_STATUS and value != 0x05:
+            # Card removed or locked; the session is gone
+            self._memory_management = False
+        return recv
+
+    def _collect(self):
+        """Read the replies still due from the device into _replies."""
+        while self._outstanding:
+            try:
+                self._replies.append(self._read_device(_COLLECT_TIMEOUT))
+            except usb.core.USBError:
+                logging.debug('Gave up waiting for a reply to CMD:0x{:x}'.format(
+                        self._outstanding[0][0]))
+                self._outstanding.clear()
+
+    def _drain(self):
+        """Discard replies a disconnected client left unread."""
+        self._replies.clear()
+        self._outstanding.clear()
+        while True:
+            try:
+                self._read_device(50)
+            except usb.core.USBError:
+                break
+
+    def _end_memory_management(self):
+        """Carry out a deferred exit from memory management mode."""
+        if not self._memory_management:
+            return
+        logging.info('Exiting memory management mode.')
+        try:
+            self._mooltipass._command(CMD_END_MEMORYMGMT, timeout=5000)
+        except usb.core.USBError:
+            pass
+        self._memory_management = False
@@ -0,0 +1,724 @@
+# This file is part of Mooltipy.
+#
+# Mooltipy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Mooltipy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Mooltipy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""An in-process Mooltipass emulator.
+
+MooltipassEmulator speaks the same 64 byte packet protocol as the
+device and exposes IN / OUT endpoint objects which _Mooltipass uses in
+place of those found through usb.core.find(). It simulates the flash
+node space, login and data contexts, parameters, favorites and status
+so MooltipassClient and the utilities can be run without a unit on the
+desk.
+
+The emulator can be selected without touching any code by pointing the
+MOOLTIPY_EMULATOR environment variable at a state file:
+
+    $ MOOLTIPY_EMULATOR=/tmp/mooltipass.json mplogin list
+
+Passwords are not encrypted and no PIN entry is simulated; every
+request requiring confirmation on the device is accepted unless the
+approve attribute is set to False.
+"""
+
+from array import array
+from collections import deque
+
+import base64
+import json
+import logging
+import os
+import struct
+import threading
+import time
+
+import usb.core
+
+from .commands import COMMANDS
+from .constants import *
+from .mooltipass import _Mooltipass, _USBTimeoutError, CPZ_SIZE
+
+NODE_SIZE = 132
+NODE_ADDR_SHMT = 3
+NODES_PER_PAGE = 4
+FIRST_NODE_PAGE = 128
+DEFAULT_PAGE_COUNT = 256
+FAVORITE_COUNT = 14
+
+# Node flags: bits 15-14 are the node type, bit 13 is set when the node
+# is *not* valid (erased flash) and bits 12-8 hold the user id.
+NODE_TYPE_MASK = 0xC000
+NODE_PARENT = 0x0000
+NODE_CHILD = 0x4000
+NODE_PARENT_DATA = 0x8000
+NODE_CHILD_DATA = 0xC000
+NODE_INVALID_BIT = 0x2000
+NODE_USER_MASK = 0x1F00
+
+DATA_BLOCK_SIZE = 32
+DATA_BLOCKS_PER_NODE = 4
+
+# Commands refused while in memory management mode
+_CONTEXT_COMMANDS = frozenset([
+        CMD_CONTEXT, CMD_GET_LOGIN, CMD_GET_PASSWORD, CMD_SET_LOGIN,
+        CMD_SET_PASSWORD, CMD_CHECK_PASSWORD, CMD_ADD_CONTEXT,
+        CMD_SET_DATA_SERVICE, CMD_ADD_DATA_SERVICE, CMD_WRITE_32B_IN_DN,
+        CMD_READ_32B_IN_DN])
+
+# Commands after which state is saved to the state file (if any)
+_MUTATING_COMMANDS = frozenset([
+        CMD_SET_LOGIN, CMD_SET_PASSWORD, CMD_ADD_CONTEXT,
+        CMD_SET_MOOLTIPASS_PARM, CMD_ADD_DATA_SERVICE, CMD_WRITE_32B_IN_DN,
+        CMD_WRITE_FLASH_NODE, CMD_SET_FAVORITE, CMD_SET_STARTING_PARENT,
+        CMD_SET_CTRVALUE, CMD_SET_DN_START_PARENT])
+
+
+def _cstr(value):
+    """Return bytes of a null terminated string."""
+    return bytes(value).partition(b'\0')[0]
+
+
+class _EndpointOut:
+    """OUT endpoint; packets written here are handled by the emulator."""
+
+    wMaxPacketSize = 64
+
+    def __init__(self, emulator):
+        self._emulator = emulator
+
+    def write(self, data, timeout=None):
+        if len(data) > self.wMaxPacketSize:
+            raise usb.core.USBError('Packet exceeds {} bytes'.format(
+                    self.wMaxPacketSize))
+        self._emulator.handle_packet(bytes(data))
+        return len(data)
+
+
+class _EndpointIn:
+    """IN endpoint; returns packets queued by the emulator."""
+
+    wMaxPacketSize = 64
+
+    def __init__(self, emulator):
+        self._emulator = emulator
+
+    def read(self, size, timeout=None):
+        """Return the next reply, waiting up to timeout ms for one."""
+        if timeout is None:
+            timeout = 1000
+        emulator = self._emulator
+        with emulator.responses_ready:
+            if not emulator.responses_ready.wait_for(
+                    lambda: emulator.responses, timeout / 1000):
+                raise _USBTimeoutError('Operation timed out', errno=110)
+            return emulator.responses.popleft()[:size]
+
+
+class MooltipassEmulator:
+    """Simulated Mooltipass.
+
+    Attributes:
+        status -- value returned for CMD_MOOLTIPASS_STATUS (default 5,
+                card present and unlocked).
+        approve -- whether requests needing confirmation on the device
+                are accepted (default True).
+        epin / epout -- endpoints handed to _Mooltipass.
+    """
+
+    user_id = 0
+    flash_chip = 4
+    version = 'v1.2'
+
+    def __init__(self, path=None, page_count=DEFAULT_PAGE_COUNT):
+        """Create an emulated Mooltipass.
+
+        Keyword arguments:
+            path -- optional state file; loaded if it exists and saved
+                    after each command modifying the device.
+            page_count -- number of flash pages available for nodes.
+        """
+        self.path = path
+        self.page_count = page_count
+        self.status = 0x05
+        self.approve = True
+
+        self.flash = bytearray(b'\xff' * NODE_SIZE * NODES_PER_PAGE * page_count)
+        self.starting_parent = 0
+        self.data_starting_parent = 0
+        self.favorites = [(0, 0)] * FAVORITE_COUNT
+        self.params = {p.param: p.default_value
+                       for p in _Mooltipass.valid_params.values()}
+        self.ctr = 0
+        self.cpz = os.urandom(CPZ_SIZE)
+
+        self.responses = deque()
+        self.responses_ready = threading.Condition()
+        self.epin = _EndpointIn(self)
+        self.epout = _EndpointOut(self)
+
+        self._memory_management = False
+        self._context = 0
+        self._login = 0
+        self._data_context = 0
+        self._write_addr = 0
+        self._write_block = 0
+        self._read_addr = None
+        self._read_block = 0
+
+        self._handlers = {
+            CMD_PING: self._ping,
+            CMD_VERSION: self._version,
+            CMD_CONTEXT: self._set_context,
+            CMD_GET_LOGIN: self._get_login,
+            CMD_GET_PASSWORD: self._get_password,
+            CMD_SET_LOGIN: self._set_login,
+            CMD_SET_PASSWORD: self._set_password,
+            CMD_CHECK_PASSWORD: self._check_password,
+            CMD_ADD_CONTEXT: self._add_context,
+            CMD_GET_RANDOM_NUMBER: self._get_random_number,
+            CMD_START_MEMORYMGMT: self._start_memory_management,
+            CMD_SET_MOOLTIPASS_PARM: self._set_param,
+            CMD_GET_MOOLTIPASS_PARM: self._get_param,
+            CMD_MOOLTIPASS_STATUS: self._get_status,
+            CMD_SET_DATE: self._set_date,
+            CMD_SET_DATA_SERVICE: self._set_data_context,
+            CMD_ADD_DATA_SERVICE: self._add_data_context,
+            CMD_WRITE_32B_IN_DN: self._write_32b,
+            CMD_READ_32B_IN_DN: self._read_32b,
+            CMD_GET_CUR_CARD_CPZ: self._get_card_cpz,
+            CMD_CANCEL_USER_REQUEST: self._cancel_user_request,
+            CMD_READ_FLASH_NODE: self._read_node,
+            CMD_WRITE_FLASH_NODE: self._write_node,
+            CMD_GET_FAVORITE: self._get_favorite,
+            CMD_SET_FAVORITE: self._set_favorite,
+            CMD_GET_STARTING_PARENT: self._get_starting_parent,
+            CMD_SET_STARTING_PARENT: self._set_starting_parent,
+            CMD_GET_CTRVALUE: self._get_ctr,
+            CMD_SET_CTRVALUE: self._set_ctr,
+            CMD_GET_30_FREE_SLOTS: self._get_free_slots,
+            CMD_GET_DN_START_PARENT: self._get_data_starting_parent,
+            CMD_SET_DN_START_PARENT: self._set_data_starting_parent,
+            CMD_END_MEMORYMGMT: self._end_memory_management,
+        }
+
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    # State
+    # -----
+
+    def load(self):
+        """Load emulator state from self.path."""
+        with open(self.path, 'r') as fin:
+            state = json.load(fin)
+        self.flash = bytearray(base64.b64decode(state['flash']))
+        self.page_count = len(self.flash) // (NODE_SIZE * NODES_PER_PAGE)
+        self.starting_parent = state['starting_parent']
+        self.data_starting_parent = state['data_starting_parent']
+        self.favorites = [tuple(f) for f in state['favorites']]
+        self.params.update({int(k): v for k, v in state['params'].items()})
+        self.ctr = state['ctr']
+        if 'cpz' in state:
+            self.cpz = bytes.fromhex(state['cpz'])
+        else:
+            # Keep the card the same from now on
+            self.save()
+
+    def save(self):
+        """Save emulator state to self.path."""
+        state = {
+            'flash': base64.b64encode(bytes(self.flash)).decode('ascii'),
+            'starting_parent': self.starting_parent,
+            'data_starting_parent': self.data_starting_parent,
+            'favorites': self.favorites,
+            'params': self.params,
+            'ctr': self.ctr,
+            'cpz': self.cpz.hex(),
+        }
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as fout:
+            json.dump(state, fout)
+        os.replace(tmp_path, self.path)
+
+    # Packets
+    # -------
+
+    def handle_packet(self, packet):
+        """Handle a packet written to the OUT endpoint."""
+        data_len = packet[0]
+        cmd = packet[1]
+        data = packet[2:2+data_len]
+        logging.debug('Emulator RX - CMD:0x{:x} Length:{}'.format(cmd, data_len))
+
+        handler = self._handlers.get(cmd)
+        if handler is None:
+            self._reply(cmd, b'\x00')
+        elif self._memory_management and cmd in _CONTEXT_COMMANDS:
+            self._reply(cmd, b'\x00')
+        else:
+            try:
+                args = COMMANDS[cmd].request.unpack(data)
+            except struct.error:
+                # Too short for the command's request layout
+                self._reply(cmd, b'\x00')
+            else:
+                handler(cmd, *args)
+
+        if self.path is not None and cmd in _MUTATING_COMMANDS:
+            self.save()
+
+    def _reply(self, cmd, payload):
+        packet = array('B', [len(payload), cmd])
+        packet.extend(payload)
+        packet.extend(b'\x00' * (64 - len(packet)))
+        with self.responses_ready:
+            self.responses.append(packet)
+            self.responses_ready.notify()
+
+    def _reply_bool(self, cmd, value):
+        self._reply(cmd, b'\x01' if value else b'\x00')
+
+    def _reply_value(self, cmd, *values):
+        """Reply with values packed as per COMMANDS."""
+        self._reply(cmd, COMMANDS[cmd].response.pack(*values))
+
+    # Flash nodes
+    # -----------
+
+    def first_node_addr(self):
+        return FIRST_NODE_PAGE << NODE_ADDR_SHMT
+
+    def node_addrs(self, start_addr=0):
+        """Yield every node address, optionally from start_addr."""
+        for page in range(FIRST_NODE_PAGE, FIRST_NODE_PAGE + self.page_count):
+            for node in range(NODES_PER_PAGE):
+                addr = (page << NODE_ADDR_SHMT) | node
+                if addr >= start_addr:
+                    yield addr
+
+    def _offset(self, addr):
+        """Return offset of node addr in flash or None if invalid."""
+        page = (addr >> NODE_ADDR_SHMT) - FIRST_NODE_PAGE
+        node = addr & ((1 << NODE_ADDR_SHMT) - 1)
+        if not 0 <= page < self.page_count or node >= NODES_PER_PAGE:
+            return None
+        return (page * NODES_PER_PAGE + node) * NODE_SIZE
+
+    def node(self, addr):
+        """Return a writable view of the node at addr."""
+        offset = self._offset(addr)
+        if offset is None:
+            raise RuntimeError('Invalid node address 0x{:x}'.format(addr))
+        return memoryview(self.flash)[offset:offset+NODE_SIZE]
+
+    def _flags(self, addr):
+        return struct.unpack_from('<H', self.flash, self._offset(addr))[0]
+
+    def _addr_at(self, addr, index):
+        return struct.unpack_from('<H', self.flash, self._offset(addr) + index)[0]
+
+    def _set_addr_at(self, addr, index, value):
+        struct.pack_into('<H', self.flash, self._offset(addr) + index, value)
+
+    def is_free(self, addr):
+        return bool(self._flags(addr) & NODE_INVALID_BIT)
+
+    def _owned(self, addr):
+        """Return True if addr is a valid node belonging to our user."""
+        if self._offset(addr) is None or self.is_free(addr):
+            return False
+        return (self._flags(addr) & NODE_USER_MASK) >> 8 == self.user_id
+
+    def _allocate(self, flags):
+        """Claim the first free node and return its address."""
+        for addr in self.node_addrs():
+            if self.is_free(addr):
+                node = self.node(addr)
+                node[:] = b'\x00' * NODE_SIZE
+                struct.pack_into('<H', node, 0, flags | (self.user_id << 8))
+                return addr
+        return 0
+
+    def _parents(self, start_addr):
+        addr = start_addr
+        while addr:
+            yield addr
+            addr = self._addr_at(addr, 4)
+
+    def _children(self, parent_addr):
+        addr = self._addr_at(parent_addr, 6)
+        while addr:
+            yield addr
+            addr = self._addr_at(addr, 4)
+
+    def _service_name(self, addr):
+        return _cstr(self.node(addr)[8:66])
+
+    def _child_login(self, addr):
+        return _cstr(self.node(addr)[37:100])
+
+    def _find_parent(self, start_addr, name):
+        for addr in self._parents(start_addr):
+            if self._service_name(addr) == name:
+                return addr
+        return 0
+
+    def _add_parent(self, flags, name):
+        """Create a parent node, sorted by name; return its address."""
+        if flags == NODE_PARENT:
+            start_addr = self.starting_parent
+        else:
+            start_addr = self.data_starting_parent
+
+        addr = self._allocate(flags)
+        if not addr:
+            return 0
+        self.node(addr)[8:8+len(name)] = name
+
+        prev_addr = 0
+        next_addr = start_addr
+        while next_addr and self._service_name(next_addr) < name:
+            prev_addr = next_addr
+            next_addr = self._addr_at(next_addr, 4)
+
+        self._set_addr_at(addr, 2, prev_addr)
+        self._set_addr_at(addr, 4, next_addr)
+        if next_addr:
+            self._set_addr_at(next_addr, 2, addr)
+        if prev_addr:
+            self._set_addr_at(prev_addr, 4, addr)
+        elif flags == NODE_PARENT:
+            self.starting_parent = addr
+        else:
+            self.data_starting_parent = addr
+        return addr
+
+    def _add_child(self, parent_addr, login):
+        """Create a child node sorted by login; return its address."""
+        addr = self._allocate(NODE_CHILD)
+        if not addr:
+            return 0
+        node = self.node(addr)
+        node[37:37+len(login)] = login
+        date = self._date()
+        struct.pack_into('<HH', node, 30, date, date)
+
+        prev_addr = 0
+        next_addr = self._addr_at(parent_addr, 6)
+        while next_addr and self._child_login(next_addr) < login:
+            prev_addr = next_addr
+            next_addr = self._addr_at(next_addr, 4)
+
+        self._set_addr_at(addr, 2, prev_addr)
+        self._set_addr_at(addr, 4, next_addr)
+        if next_addr:
+            self._set_addr_at(next_addr, 2, addr)
+        if prev_addr:
+            self._set_addr_at(prev_addr, 4, addr)
+        else:
+            self._set_addr_at(parent_addr, 6, addr)
+        return addr
+
+    @staticmethod
+    def _date():
+        """Return today's date encoded as the Mooltipass does."""
+        now = time.localtime()
+        return ((now.tm_year - 2010) << 9) | (now.tm_mon << 5) | now.tm_mday
+
+    # Command handlers
+    # ----------------
+
+    def _ping(self, cmd, data):
+        self._reply_value(cmd, data)
+
+    def _version(self, cmd):
+        self._reply_value(cmd, self.flash_chip, self.version)
+
+    def _set_context(self, cmd, name):
+        if self.status != 0x05:
+            self._reply(cmd, b'\x03')
+            return
+        self._context = self._find_parent(self.starting_parent, name)
+        self._login = 0
+        self._reply_bool(cmd, self._context)
+
+    def _get_login(self, cmd):
+        if not self._context or not self.approve:
+            self._reply(cmd, b'\x00')
+            return
+        if not self._login:
+            self._login = next(self._children(self._context), 0)
+        if not self._login:
+            self._reply(cmd, b'\x00')
+            return
+        self._reply_value(cmd, self._child_login(self._login))
+
+    def _get_password(self, cmd):
+        login = self._login
+        if self._context and not login:
+            children = list(self._children(self._context))
+            if len(children) == 1:
+                login = children[0]
+        if not login or not self.approve:
+            self._reply(cmd, b'\x00')
+            return
+        self._reply_value(cmd, _cstr(self.node(login)[100:132]))
+
+    def _set_login(self, cmd, login):
+        if not self._context:
+            self._reply(cmd, b'\x00')
+            return
+        for addr in self._children(self._context):
+            if self._child_login(addr) == login:
+                self._login = addr
+                self._reply(cmd, b'\x01')
+                return
+        if not self.approve:
+            self._reply(cmd, b'\x00')
+            return
+        self._login = self._add_child(self._context, login)
+        self._reply_bool(cmd, self._login)
+
+    def _set_password(self, cmd, password):
+        if not self._login or not self.approve:
+            self._reply(cmd, b'\x00')
+            return
+        password = password[:31]
+        node = self.node(self._login)
+        node[100:132] = password + b'\x00' * (32 - len(password))
+        self.ctr = (self.ctr + 1) & 0xFFFFFF
+        node[34:37] = self.ctr.to_bytes(3, 'big')
+        self._reply(cmd, b'\x01')
+
+    def _check_password(self, cmd, password):
+        if not self._login:
+            self._reply(cmd, b'\x00')
+            return
+        self._reply_bool(cmd, _cstr(self.node(self._login)[100:132]) == password)
+
+    def _add_context(self, cmd, name):
+        if self.status != 0x05 or not self.approve or \
+                self._find_parent(self.starting_parent, name):
+            self._reply(cmd, b'\x00')
+            return
+        self._reply_bool(cmd, self._add_parent(NODE_PARENT, name))
+
+    def _get_random_number(self, cmd):
+        self._reply_value(cmd, os.urandom(32))
+
+    def _start_memory_management(self, cmd):
+        if self.status != 0x05 or not self.approve:
+            self._reply(cmd, b'\x00')
+            return
+        self._memory_management = True
+        self._reply(cmd, b'\x01')
+
+    def _set_param(self, cmd, param, value):
+        self.params[param] = value
+        self._reply(cmd, b'\x01')
+
+    def _get_param(self, cmd, param):
+        self._reply_value(cmd, self.params.get(param, 0))
+
+    def _get_status(self, cmd):
+        self._reply_value(cmd, self.status)
+
+    def _set_date(self, cmd, date):
+        self._reply(cmd, b'\x01')
+
+    def _set_data_context(self, cmd, name):
+        self._data_context = self._find_parent(self.data_starting_parent, name)
+        self._write_addr = 0
+        self._write_block = 0
+        self._read_addr = None
+        self._read_block = 0
+        self._reply_bool(cmd, self._data_context)
+
+    def _add_data_context(self, cmd, name):
+        if self.status != 0x05 or not self.approve or \
+                self._find_parent(self.data_starting_parent, name):
+            self._reply(cmd, b'\x00')
+            return
+        self._reply_bool(cmd, self._add_parent(NODE_PARENT_DATA, name))
+
+    def _write_32b(self, cmd, eod, data):
+        """Append a 32 byte block to the current data context.
+
+        The number of blocks used in each data node is kept in the low
+        bits of the node flags so the context can be read back.
+        """
+        if not self._data_context:
+            self._reply(cmd, b'\x00')
+            return
+
+        if not self._write_addr:
+            # A context can only be written once; refuse to append to
+            # one which already holds data.
+            if self._addr_at(self._data_context, 6):
+                self._reply(cmd, b'\x00')
+                return
+
+        if not self._write_addr or self._write_block == DATA_BLOCKS_PER_NODE:
+            addr = self._allocate(NODE_CHILD_DATA)
+            if not addr:
+                self._reply(cmd, b'\x00')
+                return
+            if self._write_addr:
+                self._set_addr_at(self._write_addr, 2, addr)
+            else:
+                self._set_addr_at(self._data_context, 6, addr)
+            self._write_addr = addr
+            self._write_block = 0
+
+        node = self.node(self._write_addr)
+        block = data[:DATA_BLOCK_SIZE].ljust(DATA_BLOCK_SIZE, b'\x00')
+        offset = 4 + self._write_block * DATA_BLOCK_SIZE
+        node[offset:offset+DATA_BLOCK_SIZE] = block
+        self._write_block += 1
+        flags = self._flags(self._write_addr) & ~0x000F
+        struct.pack_into('<H', node, 0, flags | self._write_block)
+
+        if eod:
+            # End of data; the next write would be refused.
+            self._write_addr = 0
+            self._write_block = 0
+            self._data_context = 0
+        self._reply(cmd, b'\x01')
+
+    def _read_32b(self, cmd):
+        if not self._data_context:
+            self._reply(cmd, b'\x00')
+            return
+        if self._read_addr is None:
+            self._read_addr = self._addr_at(self._data_context, 6)
+            self._read_block = 0
+        if not self._read_addr:
+            self._reply(cmd, b'\x00')
+            return
+
+        node = self.node(self._read_addr)
+        offset = 4 + self._read_block * DATA_BLOCK_SIZE
+        self._reply_value(cmd, node[offset:offset+DATA_BLOCK_SIZE])
+        self._read_block += 1
+        if self._read_block >= self._flags(self._read_addr) & 0x000F:
+            self._read_addr = self._addr_at(self._read_addr, 2)
+            self._read_block = 0
+
+    def _get_card_cpz(self, cmd):
+        if self.status != 0x05:
+            self._reply(cmd, b'\x00')
+            return
+        self._reply_value(cmd, self.cpz)
+
+    def _cancel_user_request(self, cmd):
+        pass
+
+    def _read_node(self, cmd, addr):
+        if not self._memory_management or not self._owned(addr):
+            self._reply(cmd, b'\x00')
+            return
+        for payload in COMMANDS[cmd].response.pack(self.node(addr)):
+            self._reply(cmd, payload)
+
+    def _write_node(self, cmd, addr, chunk, payload):
+        """Write one of three chunks of a node.
+
+        Chunks 0 and 1 hold 59 bytes and chunk 2 the remaining 14. Each
+        chunk is written to flash as it is received.
+        """
+        offset = self._offset(addr)
+        if not self._memory_management or offset is None or chunk > 2 or \
+                not (self.is_free(addr) or self._owned(addr)):
+            self._reply(cmd, b'\x00')
+            return
+        start = chunk * 59
+        length = 59 if chunk < 2 else NODE_SIZE - 2 * 59
+        payload = payload[:length]
+        if len(payload) != length:
+            self._reply(cmd, b'\x00')
+            return
+        self.flash[offset+start:offset+start+length] = payload
+        if chunk == 0 and not self.is_free(addr):
+            # The firmware stamps the current user into the flags
+            flags = (self._flags(addr) & ~NODE_USER_MASK) | (self.user_id << 8)
+            struct.pack_into('<H', self.flash, offset, flags)
+        self._reply(cmd, b'\x01')
+
+    def _get_favorite(self, cmd, slot_id):
+        if not self._memory_management or slot_id >= FAVORITE_COUNT:
+            self._reply(cmd, b'\x00')
+            return
+        self._reply_value(cmd, *self.favorites[slot_id])
+
+    def _set_favorite(self, cmd, slot_id, parent_addr, child_addr):
+        if not self._memory_management or slot_id >= FAVORITE_COUNT:
+            self._reply(cmd, b'\x00')
+            return
+        self.favorites[slot_id] = (parent_addr, child_addr)
+        self._reply(cmd, b'\x01')
+
+    def _get_starting_parent(self, cmd):
+        if not self._memory_management:
+            self._reply(cmd, b'\x00')
+            return
+        self._reply_value(cmd, self.starting_parent)
+
+    def _set_starting_parent(self, cmd, addr):
+        if not self._memory_management:
+            self._reply(cmd, b'\x00')
+            return
+        self.starting_parent = addr
+        self._reply(cmd, b'\x01')
+
+    def _get_ctr(self, cmd):
+        if not self._memory_management:
+            self._reply(cmd, b'\x00')
+            return
+        self._reply_value(cmd, self.ctr)
+
+    def _set_ctr(self, cmd, ctr):
+        if not self._memory_management:
+            self._reply(cmd, b'\x00')
+            return
+        self.ctr = int.from_bytes(ctr, 'big')
+        self._reply(cmd, b'\x01')
+
+    def _get_free_slots(self, cmd, start_addr):
+        if not self._memory_management:
+            self._reply(cmd, b'\x00')
+            return
+        free = []
+        for addr in self.node_addrs(start_addr):
+            if self.is_free(addr):
+                free.append(addr)
+                if len(free) == 31:
+                    break
+        self._reply_value(cmd, free)
+
+    def _get_data_starting_parent(self, cmd):
+        if not self._memory_management:
+            self._reply(cmd, b'\x00')
+            return
+        self._reply_value(cmd, self.data_starting_parent)
+
+    def _set_data_starting_parent(self, cmd, addr):
+        if not self._memory_management:
+            self._reply(cmd, b'\x00')
+            return
+        self.data_starting_parent = addr
+        self._reply(cmd, b'\x01')
+
+    def _end_memory_management(self, cmd):
+        self._reply_bool(cmd, self._memory_management)
+        self._memory_management = False
@@ -20,16 +20,20 @@
 from array import array
 
 import logging
+import os
 import platform
 import struct
 import sys
+import threading
 import time
 
 import usb.core
 
+from .commands import COMMANDS, NODE_CHUNK_SIZE, NODE_CHUNKS
+from .compression import LENGTH_MASK
 from .constants import *
 
-from collections import namedtuple
+from collections import deque, namedtuple
 
 ENCODING = 'ascii'
 def str_from_array(arr):
@@ -38,6 +42,74 @@ def str_from_array(arr):
     # interpret as ASCII:
     return arr.tobytes().partition(b'\0')[0].decode(ENCODING)
 
+_PACKET_SIZE = 64
+_ZEROS = memoryview(bytes(_PACKET_SIZE))
+
+def _debug_enabled():
+    """Only render packet dumps when they will be logged."""
+    return logging.root.isEnabledFor(logging.DEBUG)
+
+# Data contexts are written and read in blocks of this many bytes
+DATA_BLOCK_SIZE = 32
+
+# Bytes in the Code Protected Zone identifying a card
+CPZ_SIZE = 8
+
+# Commands a batch writes before reading replies. Real hardware NAKs and
+# stalls when too many requests are outstanding, so keep this small.
+BATCH_WINDOW = 8
+
+def iter_chunks(source, chunk_size=DATA_BLOCK_SIZE):
+    """Return an iterator of bytes-like chunks from source.
+
+    Arguments:
+        source -- binary file-like object, read chunk_size bytes at a
+                time, or an iterable of bytes-like chunks.
+    """
+    if hasattr(source, 'read'):
+        return iter(lambda: source.read(chunk_size), b'')
+    return iter(source)
+
+def _data_blocks(chunks, length):
+    """Yield the first length bytes of chunks in DATA_BLOCK_SIZE blocks.
+
+    The last block may be shorter. Whole blocks inside a chunk are
+    yielded as slices of it; others are assembled in a buffer reused
+    for every block, so each must be used before asking for the next.
+    """
+    block = bytearray(DATA_BLOCK_SIZE)
+    pending = 0
+    remaining = length
+    for chunk in chunks:
+        if not remaining:
+            break
+        try:
+            view = memoryview(chunk).cast('B')
+        except TypeError:
+            # Not bytes-like (e.g. a list of ints)
+            view = memoryview(array('B', chunk))
+        view = view[:remaining]
+        remaining -= len(view)
+        if pending:
+            n = min(DATA_BLOCK_SIZE - pending, len(view))
+            block[pending:pending+n] = view[:n]
+            pending += n
+            view = view[n:]
+            if pending < DATA_BLOCK_SIZE:
+                continue
+            yield memoryview(block)
+            pending = 0
+        while len(view) >= DATA_BLOCK_SIZE:
+            yield view[:DATA_BLOCK_SIZE]
+            view = view[DATA_BLOCK_SIZE:]
+        block[:len(view)] = view
+        pending = len(view)
+    if pending:
+        yield memoryview(block)[:pending]
+
+# Timeouts raise USBTimeoutError on pyusb >= 1.1 and USBError before
+_USBTimeoutError = getattr(usb.core, 'USBTimeoutError', usb.core.USBError)
+
 MooltipassParam = namedtuple("MooltipassParam",
                              "param, formatter, allowed_range, default_value")
 
@@ -92,17 +164,57 @@ class _Mooltipass:
     _CMD_INDEX = 0x01
     _DATA_INDEX = 0x02
 
+    # Nodes are 132 bytes and read back in packets of up to 62 bytes.
+    _NODE_SIZE = 132
+    _NODE_PACKET_SIZE = 62
+
     _epin = None
     _epout = None
     _hid_device = None
 
+    # The most recently sent _Batch, for inspecting its round trips
+    last_batch = None
+
     _intf = None
 
-    def __init__(self):
+    _tx_len = 0
+
+    def __init__(self, device=None, use_daemon=True):
         """Create object representing a Mooltipass.
 
+        Keyword arguments:
+            device -- object providing epin / epout endpoints to talk to
+                    instead of a USB device, e.g. a MooltipassEmulator.
+            use_daemon -- if no device is given, talk to a running
+                    mooltipy daemon when one is listening (default True).
+
+        Without a device or daemon, an emulator is created when the
+        MOOLTIPY_EMULATOR environment variable names a state file and
+        the USB device is used otherwise.
+
         Raises RuntimeError on failure.
         """
+        # Every packet sent is assembled in this buffer
+        self._tx_buffer = array('B', bytes(_PACKET_SIZE))
+        self._tx_view = memoryview(self._tx_buffer)
+        # Held for each command and its reply, so node iterators can
+        # read ahead on worker threads
+        self._io_lock = threading.RLock()
+
+        if device is None and use_daemon:
+            from .daemon import connect
+            device = connect()
+
+        if device is None and os.environ.get('MOOLTIPY_EMULATOR'):
+            from .emulator import MooltipassEmulator
+            device = MooltipassEmulator(os.environ['MOOLTIPY_EMULATOR'])
+
+        if device is not None:
+            self._hid_device = device
+            self._epin = device.epin
+            self._epout = device.epout
+            return
+
         # Mostly ripped out of mooltipas_coms.py from the mooltipass
         # project originally written by Mathieu Stephan
         # https://github.com/limpkin/mooltipass/tools/python_comms/mooltipass_coms.py
@@ -156,40 +268,103 @@ class _Mooltipass:
     def send_packet(self, cmd=0x00, data=None):
         """Sends a packet to our mooltipass.
 
+        The packet is assembled in a transmit buffer reused for every
+        packet, so nothing is allocated per packet on the way out.
+
         Keyword arguments:
             cmd -- command to send
-            data -- array [or struct?]
+            data -- bytes-like payload (e.g. array, bytes, memoryview)
+                    or a tuple of ints & bytes-like parts written one
+                    after another
         """
-
-        data_len = 0
-        if data is not None:
-            data_len = len(data)
-
         # Data sent over to the generic HID should be in 64 byte packets and in
         # the following array structure:
         #   buffer[0]  = length of data
         #   buffer[1]  = command identifier for this packet
         #   buffer[2:] = packet data
-        arraytosend = array('B')
-        if cmd > 0x00:
-            arraytosend.append(data_len)
-            arraytosend.append(cmd)
+        view = self._tx_view
+        pos = self._DATA_INDEX if cmd > 0x00 else 0
 
-        if data is not None:
-            arraytosend.extend(data)
+        if data is None:
+            parts = ()
+        elif isinstance(data, tuple):
+            parts = data
+        else:
+            parts = (data,)
+
+        for part in parts:
+            if isinstance(part, int):
+                view[pos] = part
+                pos += 1
+                continue
+            if pos + len(part) > _PACKET_SIZE:
+                raise RuntimeError('Packets can not exceed {} bytes.'.format(_PACKET_SIZE))
+            try:
+                view[pos:pos+len(part)] = part
+            except TypeError:
+                # Not bytes-like (e.g. a list of ints)
+                view[pos:pos+len(part)] = array('B', part)
+            pos += len(part)
 
-        logging.debug('TX Packet: \n{}'.format(arraytosend))
+        if cmd > 0x00:
+            view[self._PKT_LEN_INDEX] = pos - self._DATA_INDEX
+            view[self._CMD_INDEX] = cmd
 
-        self._epout.write(arraytosend)
+        self._transmit(pos)
 
-    def recv_packet(self, timeout=17500):
-        """Receives a packet from the mooltipass.
+    def _send_command(self, cmd, args=()):
+        """Send a command with args packed as per COMMANDS."""
+        command = COMMANDS[cmd]
+        view = self._tx_view
+        try:
+            length = command.request.pack_into(view, self._DATA_INDEX, *args)
+        except (ValueError, IndexError):
+            raise RuntimeError('Packets can not exceed {} bytes.'.format(_PACKET_SIZE))
+        view[self._PKT_LEN_INDEX] = length
+        view[self._CMD_INDEX] = cmd
+        if _debug_enabled():
+            logging.debug('TX {}{}'.format(command.name, args))
+        self._transmit(self._DATA_INDEX + length)
+
+    def _transmit(self, pos):
+        """Write the transmit buffer holding a packet of pos bytes."""
+        view = self._tx_view
+        # Clear whatever a longer previous packet left behind
+        if pos < self._tx_len:
+            view[pos:self._tx_len] = _ZEROS[:self._tx_len-pos]
+        self._tx_len = pos
+
+        if _debug_enabled():
+            logging.debug('TX Packet: \n{}'.format(self._tx_buffer[:pos]))
+
+        self._epout.write(self._tx_buffer)
+
+    def _command(self, cmd, *args, timeout=17500):
+        """Send a command and return its decoded reply.
+
+        The request and reply layouts come from COMMANDS. Replies
+        spanning several packets are read until complete, allowing one
+        second for each packet after the first; a reply which stops
+        short is left to the codec to reject.
+        """
+        response = COMMANDS[cmd].response
+        with self._io_lock:
+            self._send_command(cmd, args)
+            if response is None:
+                return None
+            packets = [self._read_packet(timeout)]
+            while not response.complete(packets):
+                try:
+                    packets.append(self._read_packet(1000))
+                except usb.core.USBError:
+                    break
+        return response.decode(packets)
 
-        Returns a tuple (data, data_length_indicator).
+    def _read_packet(self, timeout=17500):
+        """Read a whole packet, including length & command bytes.
 
-        Keyword arguments:
-            timeout -- how long to wait for user to complete entering pin
-                    (default 17500 coincides with Mootipass GUI timeout)
+        Debug and resend (0xC4) packets are handled here; see
+        recv_packet().
         """
         recv = None
         while True:
@@ -232,8 +407,21 @@ class _Mooltipass:
                 else:
                     break
             time.sleep(.5)
-        logging.debug('RX Packet - CMD:0x{:x} Length:{}'.format(recv[self._CMD_INDEX], recv[self._PKT_LEN_INDEX]))
-        logging.debug('{}'.format(recv[self._DATA_INDEX:]))
+        if _debug_enabled():
+            logging.debug('RX Packet - CMD:0x{:x} Length:{}'.format(recv[self._CMD_INDEX], recv[self._PKT_LEN_INDEX]))
+            logging.debug('{}'.format(recv[self._DATA_INDEX:]))
+        return recv
+
+    def recv_packet(self, timeout=17500):
+        """Receives a packet from the mooltipass.
+
+        Returns a tuple (data, data_length_indicator).
+
+        Keyword arguments:
+            timeout -- how long to wait for user to complete entering pin
+                    (default 17500 coincides with Mootipass GUI timeout)
+        """
+        recv = self._read_packet(timeout)
         # Data sent out of the generic HID is in the form of a 64 byte packet.
         # In most cases information is returned in the data portion of a packet
         # (the trailing 62 bytes). However, the first byte (byte 0) may contain
@@ -246,6 +434,48 @@ class _Mooltipass:
         # Packet len includes the cmd byte, so subtract 1 to match the data len
         return recv[self._DATA_INDEX:], recv[self._PKT_LEN_INDEX]-1
 
+    def batch(self, window=None):
+        """Return a _Batch for sending many commands back-to-back.
+
+        Keyword argument:
+            window -- most commands written before reading replies
+                    (default BATCH_WINDOW).
+        """
+        return _Batch(self, window)
+
+    def get_params(self, params):
+        """Get several settings in one batch.
+
+        Returns a list of values in the order of params.
+        """
+        batch = self.batch()
+        for param in params:
+            batch.get_param(param)
+        return batch.send()
+
+    def get_favorites(self, slot_ids):
+        """Get several favorites in one batch.
+
+        Returns a list of parent_addr, child_addr tuples in the order of
+        slot_ids.
+        """
+        batch = self.batch()
+        for slot_id in slot_ids:
+            batch.get_favorite(slot_id)
+        return batch.send()
+
+    def read_nodes(self, node_numbers, strict=True):
+        """Read several nodes in one batch.
+
+        Returns a list of nodes as arrays in the order of node_numbers.
+        Raises RuntimeError if any read is refused or garbled, unless
+        strict is False, when such nodes are returned as None.
+        """
+        batch = self.batch()
+        for node_number in node_numbers:
+            batch.read_node(node_number)
+        return batch.send(strict=strict)
+
     def ping(self, data):
         """Ping the mooltipass. (0xA1)
 
@@ -268,24 +498,18 @@ class _Mooltipass:
             communication with. Failure to ping after connecting to
             the mooltipass can result in unpredictable responses.
         """
-        self.send_packet(CMD_PING, data)
+        self._send_command(CMD_PING, (data,))
         return None
 
     def get_version(self):
         """Get mooltipass firmware version. (0xA2)
 
-        Returns response from mooltipass:
-            recv[0]  -- Size of response
-            recv[1]  -- Response Command ID
-            recv[2]  -- Byte contains the FLASH_CHIP define
-                        specifying how much memory the unit has.
-                        Eg. 4 == 4Mb
-            recv[3:] -- String identifying the version.
-                        Eg. "v1"
+        Returns a tuple (flash_size, version):
+            flash_size -- the FLASH_CHIP define specifying how much
+                    memory the unit has. Eg. 4 == 4Mb
+            version -- string identifying the version. Eg. "v1"
         """
-        self.send_packet(CMD_VERSION, None)
-        recv, data_len = self.recv_packet()
-        return str_from_array(recv[:data_len])
+        return self._command(CMD_VERSION)
 
     def set_context(self, context):
         """Set mooltipass context. (0xA3)
@@ -299,51 +523,35 @@ class _Mooltipass:
             3 -- No card inserted into mooltipass
         """
 
-        self.send_packet(CMD_CONTEXT, array('B', bytes(context, ENCODING) + b'\x00'))
-        recv, _ = self.recv_packet(10000)
-        return recv[0]
+        return self._command(CMD_CONTEXT, context, timeout=10000)
 
     def get_login(self):
         """Get the login for current context. (0xA4)
 
         Returns the login as a string or 0 on failure.
         """
-        self.send_packet(CMD_GET_LOGIN, None)
-        recv, data_len = self.recv_packet()
-        if recv[0] == 0:
-            return 0
-        else:
-            return str_from_array(recv[:data_len])
+        return self._command(CMD_GET_LOGIN)
 
     def get_password(self):
         """Get the password for current context. (0xA5)
 
         Returns the password as a string or 0 on failure.
         """
-        self.send_packet(CMD_GET_PASSWORD, None)
-        recv, data_len = self.recv_packet()
-        if recv[0] == 0:
-            return 0
-        else:
-            return str_from_array(recv[:data_len])
+        return self._command(CMD_GET_PASSWORD)
 
     def set_login(self, login):
         """Set a login. (0xA6)
 
         Return 1 or 0 indicating success or failure.
         """
-        self.send_packet(CMD_SET_LOGIN, array('B', bytes(login, ENCODING) + b'\x00'))
-        recv, _ = self.recv_packet()
-        return recv[0]
+        return self._command(CMD_SET_LOGIN, login)
 
     def set_password(self, password):
         """Set a password for current context. (0xA7)
 
         Return 1 or 0 indicating success or failure.
         """
-        self.send_packet(CMD_SET_PASSWORD, array('B', bytes(password, ENCODING) + b'\x00'))
-        recv, _ = self.recv_packet()
-        return recv[0]
+        return self._command(CMD_SET_PASSWORD, password)
 
     def check_password(self, password):
         """Compare given password to set password for context. (0xA8)
@@ -357,9 +565,7 @@ class _Mooltipass:
         # A timer blocks repeated checking of passwords.
         # A return of 0x02 means the timer is still counting down.
         while recv is None or recv == 0x02:
-            self.send_packet(CMD_CHECK_PASSWORD, array('B', bytes(password, ENCODING) + b'\x00'))
-            recv, _ = self.recv_packet()
-            recv = recv[0]
+            recv = self._command(CMD_CHECK_PASSWORD, password)
             time.sleep(.2)
 
         return recv
@@ -369,9 +575,7 @@ class _Mooltipass:
 
         Return 1 or 0 indicating success or failure.
         """
-        self.send_packet(CMD_ADD_CONTEXT, array('B', bytes(context, ENCODING) + b'\x00'))
-        recv, _ = self.recv_packet()
-        return recv[0]
+        return self._command(CMD_ADD_CONTEXT, context)
 
     def _set_bootloader_password(self, password):
         """??? (0xAA)"""
@@ -383,9 +587,7 @@ class _Mooltipass:
 
     def get_random_number(self):
         """Get 32 random bytes. (0xAC)"""
-        self.send_packet(CMD_GET_RANDOM_NUMBER, None)
-        recv, _ = self.recv_packet()
-        return recv[0]
+        return self._command(CMD_GET_RANDOM_NUMBER)[0]
 
     def start_memory_management(self, timeout=20000):
         """Enter memory management mode. (0xAD)
@@ -397,9 +599,7 @@ class _Mooltipass:
             Note: Mooltipass times out after ~17.5 seconds of inaction.
         """
         print('Accept memory management mode to continue...')
-        self.send_packet(CMD_START_MEMORYMGMT, None)
-        recv, _ = self.recv_packet(timeout)
-        return recv[0]
+        return self._command(CMD_START_MEMORYMGMT, timeout=timeout)
 
     def _start_media_import(self):
         """Request send media to Mooltipass. (0xAE)
@@ -517,9 +717,7 @@ class _Mooltipass:
         # TODO: Interpret all bits; see /source_code/src/USB
         # Make constants, create list of invalid combinations and raise
         # error if encountered.
-        self.send_packet(CMD_MOOLTIPASS_STATUS, None)
-        recv, _ = self.recv_packet()
-        return recv[0]
+        return self._command(CMD_MOOLTIPASS_STATUS)
 
     # Where is 0xBA?
 
@@ -540,9 +738,7 @@ class _Mooltipass:
 
         Return 1 or 0 indicating success or failure.
         """
-        self.send_packet(CMD_SET_DATA_SERVICE, array('B', bytes(context, ENCODING) + b'\x00'))
-        recv, _ = self.recv_packet()
-        return recv[0]
+        return self._command(CMD_SET_DATA_SERVICE, context)
 
     def add_data_context(self, context):
         """Add a data context. (0xBF)
@@ -553,9 +749,7 @@ class _Mooltipass:
         Return 1 or 0 indicating success or failure.
         """
         print('sending ' + context)
-        self.send_packet(CMD_ADD_DATA_SERVICE, array('B', bytes(context, ENCODING) + b'\x00'))
-        recv, _ = self.recv_packet()
-        return recv[0]
+        return self._command(CMD_ADD_DATA_SERVICE, context)
 
     def write_data_context(self, data, callback=None):
         """Write to data context in blocks of 32 bytes. (0xC0)
@@ -578,27 +772,54 @@ class _Mooltipass:
         response is received from the mooltipass.
         """
 
-        BLOCK_SIZE = 32
+        return self.write_data_stream([data], len(data), callback)
+
+    def write_data_stream(self, source, length, callback=None):
+        """Write length bytes from source to the data context. (0xC0)
 
+        Blocks are pulled from source as they are sent, so the data is
+        never held in memory as a whole. See write_data_context().
+
+        Arguments:
+            source -- binary file-like object or iterable of bytes-like
+                    chunks, e.g. a pipe.
+            length -- number of bytes to write; anything source holds
+                    past length is not read.
+            callback -- as for write_data_context().
+
+        Return true on success or raises RuntimeError if source ends
+        before length bytes or an unexpected response is received from
+        the mooltipass.
+        """
+        sent = 0
         try:
-            for i in range(0,len(data),BLOCK_SIZE):
-                eod = (lambda byte: 0 if (len(data) - byte > BLOCK_SIZE) else 1)(i)
-                packet = array('B')
-                packet.append(eod)
-                packet.extend(data[i:i+BLOCK_SIZE])
-                self.send_packet(CMD_WRITE_32B_IN_DN, packet)
-                if eod == 0 and not self.recv_packet()[0][0]:
+            for block in _data_blocks(iter_chunks(source), length):
+                sent += len(block)
+                eod = 1 if sent >= length else 0
+                # The final block is acknowledged too; leaving its reply
+                # unread would answer the next command sent.
+                if not self._command(CMD_WRITE_32B_IN_DN, eod, block):
                     raise RuntimeError('Unexpected return')
                 if callback:
-                    callback((i+32, len(data)))
+                    callback((sent, length))
 
+            if sent < length:
+                self._terminate_data_write()
+                raise RuntimeError('Data ended after {} of {} bytes.'.format(sent, length))
             return True
 
         except (KeyboardInterrupt, SystemExit):
-            self.send_packet(CMD_WRITE_32B_IN_DN, array('B').append(0))
+            self._terminate_data_write()
             print('SENT TERMINATE')
             raise
 
+    def _terminate_data_write(self):
+        """Send an empty block to abandon a data write, reading its ack."""
+        try:
+            self._command(CMD_WRITE_32B_IN_DN, 0, b'', timeout=5000)
+        except usb.core.USBError:
+            pass
+
     def read_data_context(self, callback=None):
         """Read data from context in blocks of 32 bytes. (0xC1)
 
@@ -607,29 +828,42 @@ class _Mooltipass:
         Return data or None on error.
         """
         data = array('B')
+        for block in self.iter_data_context(callback):
+            data.extend(block)
+        return data
 
+    def iter_data_context(self, callback=None):
+        """Yield the blocks of the data context as they are read. (0xC1)
+
+        Arguments:
+            callback -- function to receive tuple containing progress
+                    in tuple form (x, y) where x is bytes read and y
+                    is the size in the length header of the data.
+        """
+        received = 0
         while True:
-            self.send_packet(CMD_READ_32B_IN_DN, None)
-            recv, data_len = self.recv_packet(5000)
-            if data_len == 0x00:
+            block = self._command(CMD_READ_32B_IN_DN, timeout=5000)
+            # A lone 0 marks the end of the data
+            if len(block) == 1:
                 break
-            data.extend(recv[:32])
             if callback:
-                if len(data) == 32:
-                    full_size = struct.unpack('>L', data[:4])[0]
-                callback((len(data), full_size))
-
-        return data
+                if received == 0:
+                    full_size = struct.unpack('>L', block[:4])[0] & LENGTH_MASK
+                received += len(block)
+                callback((received, full_size))
+            yield block
 
     def _get_current_card_cpz(self):
-        """Return CPZ of currently inserted card.
+        """Return CPZ of currently inserted card. (0xC2)
 
-        Card Protected Zone (CPZ)??? Returns None or data.
+        The Code Protected Zone (CPZ) is 8 bytes unique to each card.
+        Returns the CPZ as bytes, or None without an unlocked card.
         """
-        logging.info('Not yet implemented')
-        # CPZ should be returned... presumably in 32 byte chunks in a
-        # fashion similar to reading data until 0x00 is encountered.
+        cpz = self._command(CMD_GET_CUR_CARD_CPZ)
         # Mooltipass returns just 0x00 on error.
+        if len(cpz) != CPZ_SIZE:
+            return None
+        return bytes(cpz)
 
     def cancel_user_request(self):
         """Cancel user input request. (0xC3)
@@ -638,69 +872,61 @@ class _Mooltipass:
         There's no receiving involved in this command, so None is
         always returned.
         """
-        self.send_packet(CMD_CANCEL_USER_REQUEST, None)
+        self._command(CMD_CANCEL_USER_REQUEST)
 
     # 0xC4 is reserved for response from Mooltipass.
 
     def read_node(self, node_number):
         """Read a node in flash. (0xC5)
 
+        The mooltipass replies with the node split over three packets
+        of 62, 62 and 8 bytes. Packets are read until exactly 132 bytes
+        have arrived; nothing is left to wait on once the node is
+        complete.
+
         Arguments:
             node_number - two bytes indicating node number
 
-        Return the node or 0x00 on error.
+        Return the node as an array. Raises RuntimeError if the
+        mooltipass refuses the read or sends a short or garbled node.
         """
-        node_addr = struct.pack('<H', node_number)
-        data = array('B', node_addr)
-        self.send_packet(CMD_READ_FLASH_NODE, data)
-
-        recv, data_len = self.recv_packet()
         try:
+            return self._command(CMD_READ_FLASH_NODE, node_number)
+        except ValueError as e:
+            raise RuntimeError('{} (node 0x{:x}).'.format(e, node_number))
 
-            # This is not right:
-            #   data_len is 61 when we receive 62 bytes... I still think
-            #   this is a problem when assuming data_len is returned
-            #   in recv_packet instead of considering it a "ctrl byte"
-            #
-            #   Consider if data_len - 1 because the mooltipass is counting
-            #    null terminator? Something is funky.
-
-            while True:
-                recv_extra, data_len = self.recv_packet()
-                recv.extend(recv_extra[:data_len+1])
-                if data_len == 7:
-                    break
-        except usb.core.USBError:
-            # Skip timeout once all packets are received
-            pass
-
-        return recv
-
-    def _write_node(self, node_number, node_data):
+    def _write_node(self, node_number, node_data, chunks=None):
         """Write a node in flash. (0xC6)
 
         Arguments:
             node_number -- two bytes indicating the node number
             node_data -- raw array of data that is the node
 
-        Return 1 or 0 indicating success or failure.
+        Keyword argument:
+            chunks -- numbers (0-2) of the chunks to send; default all.
+                    Whether the device commits chunks sent on their own
+                    depends on the firmware; see MooltipassClient.
+
+        Raises RuntimeError on failure.
         """
-        if not len(node_data) == 132:
+        if not len(node_data) == self._NODE_SIZE:
             raise RuntimeError('Nodes are expected to be 132 bytes; found {}.'.format(
                 len(node_data)))
-        c = 0
-        for i in range(0, len(node_data), 59):
+        try:
+            view = memoryview(node_data)
+        except TypeError:
+            view = memoryview(array('B', node_data))
+        if chunks is None:
+            chunks = range(NODE_CHUNKS)
+        for c in chunks:
             # Nodes are written by sending a series of packets up to 62 bytes
             # in size. The first two bytes contain the node address. A third
             # byte contains the packet number. Then the remaining bytes (up to
             # 59 of them) contain a chunk of the node data.
-            packet = array('B', struct.pack('<H', node_number))
-            packet.append(c)
-            packet.extend(node_data[i:i+59])
-            c += 1
-            self.send_packet(CMD_WRITE_FLASH_NODE, packet)
-            recv, _ = self.recv_packet()
-            if recv[0] == 0:
+            i = c * NODE_CHUNK_SIZE
+            recv = self._command(CMD_WRITE_FLASH_NODE, node_number, c,
+                                 view[i:i+NODE_CHUNK_SIZE])
+            if recv == 0:
                 raise RuntimeError('Write node failed')
 
     def get_favorite(self, slot_id):
@@ -712,9 +938,7 @@ class _Mooltipass:
         Return None on error or parent_addr, child_addr tuple (each
         address is 2 bytes).
         """
-        self.send_packet(CMD_GET_FAVORITE, array('B', [slot_id]))
-        recv, _ = self.recv_packet()
-        return struct.unpack('<HH', recv[0:4])
+        return self._command(CMD_GET_FAVORITE, slot_id)
 
     def set_favorite(self, slot_id, addr_tuple):
         """Set a favorite. (0xC8)
@@ -729,21 +953,14 @@ class _Mooltipass:
                       slot_id,
                       addr_tuple[0]&0xFF, (addr_tuple[0]&0xFF00)>>8,
                       addr_tuple[1]&0xFF, (addr_tuple[1]&0xFF00)>>8))
-        self.send_packet(CMD_SET_FAVORITE,
-                         array('B', [slot_id, addr_tuple[0]&0xFF, (addr_tuple[0]&0xFF00)>>8, addr_tuple[1]&0xFF, (addr_tuple[1]&0xFF00)>>8]))
-        recv, _ = self.recv_packet()
-        return recv
+        return self._command(CMD_SET_FAVORITE, slot_id, addr_tuple[0], addr_tuple[1])
 
     def get_starting_parent_address(self):
         """Get the address of starting parent? (0xC9)
 
         Return slot address or None on failure.
         """
-        self.send_packet(CMD_GET_STARTING_PARENT, None)
-        recv, _ = self.recv_packet()
-        parent_addr = \
-            struct.unpack('h', recv[:2])[0]
-        return (lambda ret: None if 0 else ret)(parent_addr)
+        return self._command(CMD_GET_STARTING_PARENT)
 
     def _set_starting_parent(self, parent_addr):
         """Set starting parent address. (0xCA)
@@ -753,18 +970,17 @@ class _Mooltipass:
 
         Return 1 or 0 indicating success or failure.
         """
-        # firmware expects 2 bytes starting parent address (LSB)
-        self.send_packet(CMD_SET_STARTING_PARENT,
-                array('B', struct.pack('<H', parent_addr)))
-        recv, _ = self.recv_packet()
-        return recv[0]
+        return self._command(CMD_SET_STARTING_PARENT, parent_addr)
 
     def _get_ctr_value(self):
         """Get the current user CTR value. (0xCB)
 
-        Returns CTR value or None on error.
+        Only available in memory management mode. The CTR is
+        incremented by the card every time a password is encrypted.
+
+        Returns the CTR value as an int.
         """
-        logging.info('Not yet implemented')
+        return self._command(CMD_GET_CTRVALUE)
 
     def _set_ctr_value(self, ctr_value):
         """Set new CTR value. (0xCC)
@@ -774,7 +990,7 @@ class _Mooltipass:
 
         Return 1 or 0 indicating success or failure.
         """
-        logging.info('Not yet implemented')
+        return self._command(CMD_SET_CTRVALUE, ctr_value.to_bytes(3, 'big'))
 
     def add_cpz_ctr_value(self, cpz, ctr):
         pass
@@ -783,36 +999,25 @@ class _Mooltipass:
     def cpz_ctr_packet_export(self):
         pass
 
-    def get_free_slot_addresses(self, start_addr):
+    def get_free_slot_addresses(self, start_addr=0):
         """Scan for free slot addresses. (0xD0)
 
-        Arguments:
-            start_address - Address to start scanning from (if in doubt
-                            0x00, 0x00).
-
-        Return 31 slot addresses max otherwise (see payload length
-        field)??? or None on error.
-        """
-        packet = array('B',struct.pack('<H', start_addr))
-        self.send_packet(CMD_GET_30_FREE_SLOTS, packet)
-        recv, data_len = self.recv_packet()
-        print(recv)
-        for i in range(0,(data_len+1)*2,4):
-            print(struct.unpack('<H', recv[i:i+2])[0])
-        print('*'*80)
-        print(data_len)
-        print('*'*80)
+        Only available in memory management mode.
+
+        Keyword argument:
+            start_addr -- address to start scanning from (default 0).
+
+        Return a list of up to 31 free node addresses from start_addr
+        on, in flash order; empty if there are none or on failure.
+        """
+        return self._command(CMD_GET_30_FREE_SLOTS, start_addr)
 
     def get_starting_data_parent_address(self):
         """Get the address of the data starting parent. (0xD1)
 
         Return slot address or None on failure.
         """
-        self.send_packet(CMD_GET_DN_START_PARENT, None)
-        recv, _ = self.recv_packet()
-        parent_addr = \
-            struct.unpack('h', recv[:2])[0]
-        return (lambda ret: None if 0 else ret)(parent_addr)
+        return self._command(CMD_GET_DN_START_PARENT)
 
     def _set_starting_data_parent_addr(self, parent_addr):
         """Set the first address for data nodes. (0xD2)
@@ -822,33 +1027,148 @@ class _Mooltipass:
 
         Return 1 or 0 indicating success or failure.
         """
-        # firmware expects 2 bytes starting parent address (LSB)
-        self.send_packet(CMD_SET_DN_START_PARENT,
-                array('B', struct.pack('<H', parent_addr)))
-        recv, _ = self.recv_packet()
-        return recv[0]
+        return self._command(CMD_SET_DN_START_PARENT, parent_addr)
 
     def end_memory_management(self):
         """End memory management mode. (0xD3)
 
         Return 1 or 0 indicating success or failure."""
         print('Exiting memory management mode.')
-        self.send_packet(CMD_END_MEMORYMGMT, None)
-        recv, _ = self.recv_packet()
-        return recv[0]
+        return self._command(CMD_END_MEMORYMGMT)
 
     def set_param(self, param, value):
         """Sets a setting on the mooltipass
 
         Returns 1 or 0 indicating success or failure."""
-        self.send_packet(CMD_SET_MOOLTIPASS_PARM, array("B", [param, value]))
-        recv, _ = self.recv_packet()
-        return recv[0]
+        return self._command(CMD_SET_MOOLTIPASS_PARM, param, value)
 
     def get_param(self, param):
         """Gets the value of a setting on the mooltipass
 
         Returns the setting value."""
-        self.send_packet(CMD_GET_MOOLTIPASS_PARM, array("B", [param]))
-        recv, _ = self.recv_packet()
-        return recv[0]
+        return self._command(CMD_GET_MOOLTIPASS_PARM, param)
+
+
+class _Batch:
+    """Commands written back-to-back with replies read afterwards.
+
+    Most commands are a request followed by an immediate reply, so the
+    USB round trip dominates when many are sent in a row. A batch writes
+    up to window commands before reading any reply and matches replies
+    to commands by command byte, paying the round trip once per window
+    instead of once per command.
+
+    Only queue commands the mooltipass answers without user interaction.
+
+    Attributes:
+        round_trips -- number of write-then-read cycles the last send()
+                took.
+        elapsed -- seconds the last send() took.
+    """
+
+    def __init__(self, mooltipass, window=None):
+        self._mooltipass = mooltipass
+        self.window = window or BATCH_WINDOW
+        self._commands = []
+        self.round_trips = 0
+        self.elapsed = 0
+
+    def __len__(self):
+        return len(self._commands)
+
+    def add(self, cmd, *args):
+        """Queue a command.
+
+        Arguments:
+            cmd -- command to send
+            args -- command arguments, packed as per COMMANDS
+
+        Returns the index of the command's decoded reply in send().
+        """
+        if COMMANDS[cmd].response is None:
+            raise RuntimeError('{} has no reply to batch.'.format(COMMANDS[cmd].name))
+        self._commands.append((cmd, args))
+        return len(self._commands) - 1
+
+    def get_param(self, param):
+        return self.add(CMD_GET_MOOLTIPASS_PARM, param)
+
+    def get_favorite(self, slot_id):
+        return self.add(CMD_GET_FAVORITE, slot_id)
+
+    def read_node(self, node_number):
+        return self.add(CMD_READ_FLASH_NODE, node_number)
+
+    def set_context(self, context):
+        return self.add(CMD_CONTEXT, context)
+
+    def set_login(self, login):
+        return self.add(CMD_SET_LOGIN, login)
+
+    def send(self, timeout=5000, strict=True):
+        """Send queued commands and return their results in order.
+
+        Keyword arguments:
+            timeout -- ms to wait for each reply.
+            strict -- set False to return None for replies which can not
+                    be decoded (e.g. a refused node read) instead of
+                    raising RuntimeError. A lone refusal byte in reply to
+                    a command answering with more, such as the CTR or a
+                    starting parent outside memory management mode,
+                    counts as such.
+
+        Raises RuntimeError if a reply is missing; a smaller window may
+        help if the device drops replies.
+        """
+        start_time = time.time()
+        self.round_trips = 0
+        window = self.window
+        results = [None] * len(self._commands)
+
+        with self._mooltipass._io_lock:
+            for first in range(0, len(self._commands), window):
+                indexes = range(first, min(first + window, len(self._commands)))
+                pending = {}
+                packets = {}
+                for i in indexes:
+                    cmd, args = self._commands[i]
+                    self._mooltipass._send_command(cmd, args)
+                    pending.setdefault(cmd, deque()).append(i)
+                    packets[i] = []
+                self.round_trips += 1
+
+                remaining = len(indexes)
+                while remaining:
+                    try:
+                        recv = self._mooltipass._read_packet(timeout)
+                    except usb.core.USBError:
+                        raise RuntimeError('{} of {} batched replies missing.'.format(
+                                remaining, len(indexes)))
+                    cmd = recv[_Mooltipass._CMD_INDEX]
+                    if not pending.get(cmd):
+                        logging.debug('Dropping unexpected packet CMD:0x{:x}'.format(cmd))
+                        continue
+                    i = pending[cmd][0]
+                    packets[i].append(recv)
+                    if COMMANDS[cmd].response.complete(packets[i]):
+                        pending[cmd].popleft()
+                        remaining -= 1
+
+                for i in indexes:
+                    cmd, args = self._commands[i]
+                    response = COMMANDS[cmd].response
+                    try:
+                        result = response.decode(packets[i])
+                        if response.refused(packets[i]):
+                            raise ValueError('Mooltipass refused the command')
+                        results[i] = result
+                    except ValueError as e:
+                        if not strict:
+                            continue
+                        raise RuntimeError('{} ({}{}).'.format(e, COMMANDS[cmd].name, args))
+
+        self.elapsed = time.time() - start_time
+        self._mooltipass.last_batch = self
+        logging.debug('Sent {} commands in {} round trips ({:.3f}s)'.format(
+                len(self._commands), self.round_trips, self.elapsed))
+        return results
@@ -14,18 +14,45 @@
 # along with Mooltipy.  If not, see <http://www.gnu.org/licenses/>.
 
 from array import array
+from collections import OrderedDict
+import bisect
+import contextlib
+import datetime
+import itertools
+import json
+import os
+import queue
 import random
 import struct
 import logging
+import threading
+import time
 import weakref
 
+from .constants import *
 from .mooltipass import _Mooltipass
-from .mooltipass import str_from_array, ENCODING
+from .mooltipass import ENCODING, DATA_BLOCK_SIZE, iter_chunks
+from .commands import NODE_CHUNK_SIZE, NODE_CHUNKS, FREE_SLOTS_PER_REPLY
+from .compression import CONTAINER_FLAG, DIGEST_FLAG, DIGEST_SIZE, LENGTH_MASK, METHODS
+from .compression import Decompressor, compress, new_digest
+from .node_graph import NodeGraph, _NodeIndex, NODE_TYPES, cache_enabled, cache_path
+from .node_graph import child_info, parent_info
 
 PARENT_NODE = 0x0000
 CHILD_NODE = 0x4000
 PARENT_DATA = 0x8000
 CHILD_DATA = 0xC000
+NODE_INVALID = 0x2000
+# The device stamps the user id into these bits of the flags
+NODE_USER_MASK = 0x1F00
+
+# Data nodes hold 4 blocks; the flags count those in use
+DATA_NODE_SIZE = 128
+DATA_NODE_BLOCKS = 0x000F
+
+# Bytes of a bundle stored in each of its chunk contexts
+BUNDLE_CHUNK_SIZE = 4096
+BUNDLE_VERSION = 1
 
 
 class MooltipassClient(_Mooltipass):
@@ -37,15 +64,44 @@ class MooltipassClient(_Mooltipass):
 
     MooltipassClient is meant to be used by an application, extending
     the _Mooltipass class.
+
+    Nodes read in memory management mode are kept in a least recently
+    used cache of node_cache_size entries, so walking the same parents
+    again costs no USB reads. Writing a node drops it from the cache and
+    leaving memory management mode empties it; node_cache_hits and
+    node_cache_misses count reads served from the cache and the device.
+
+    The free node addresses are likewise fetched once per session by
+    free_slots() and kept up to date as nodes are written, so
+    allocate_nodes() hands out addresses without asking the device.
     """
 
-    def __init__(self):
-        super().__init__()
+    node_cache_size = 256
+
+    # Directory for node graphs saved by node_graph(); None for default
+    node_graph_dir = None
+
+    # Nodes the parent & child node iterators read ahead on a worker
+    # thread; 0 reads each node when it is asked for.
+    read_ahead = 0
+
+    # Whether the device commits node chunks written on their own. None
+    # until the first partial write has been read back; set False to
+    # always write whole nodes.
+    partial_node_writes = None
+
+    def __init__(self, device=None, use_daemon=True):
+        super().__init__(device, use_daemon)
+        self._node_cache = OrderedDict()
+        self._snapshot = None
+        self._free_slots = None
+        self._graph_written = False
+        self._card_cpz = None
+        self.node_cache_hits = 0
+        self.node_cache_misses = 0
         if not self.ping():
             raise RuntimeError('Mooltipass did not respond to ping.')
-        version_info = self.get_version()
-        self.flash_size = version_info[0]
-        self.version = version_info[1]
+        self.flash_size, self.version = self.get_version()
         logging.debug('Connected to Mooltipass {} w/ {} Mb Flash'.format(
                 self.version,
                 self.flash_size))
@@ -119,13 +175,52 @@ class MooltipassClient(_Mooltipass):
             raise RuntimeError('Cannot enter memory management mode; ' + \
                     'mooltipass not unlocked.')
 
+        # The card is named outside memory management mode only, or by a
+        # daemon keeping the session open (see daemon.py)
+        self._card_cpz = self._get_current_card_cpz()
+
         # Already in memory management mode if we can get starting parent
         if super().get_starting_parent_address():
             return True
 
+        # Nodes, or the card, may have changed since any earlier session
+        self.clear_node_cache()
         return super().start_memory_management(timeout)
 
-    def write_data_context(self, data, callback=None):
+    def end_memory_management(self):
+        """End memory management mode, emptying the node cache.
+
+        Return 1 or 0 indicating success or failure.
+        """
+        logging.debug('Node cache: {} hits, {} misses'.format(
+                self.node_cache_hits, self.node_cache_misses))
+        self.clear_node_cache()
+        return super().end_memory_management()
+
+    def clear_node_cache(self):
+        """Forget all cached nodes, the last snapshot and free slots."""
+        with self._io_lock:
+            self._node_cache.clear()
+            self._snapshot = None
+            self._free_slots = None
+
+    def _cached_node(self, node_addr):
+        """Return a copy of a cached node or None."""
+        recv = self._node_cache.get(node_addr)
+        if recv is None:
+            return None
+        self._node_cache.move_to_end(node_addr)
+        self.node_cache_hits += 1
+        return recv[:]
+
+    def _cache_node(self, node_addr, recv):
+        self.node_cache_misses += 1
+        self._node_cache[node_addr] = recv[:]
+        self._node_cache.move_to_end(node_addr)
+        while len(self._node_cache) > self.node_cache_size:
+            self._node_cache.popitem(last=False)
+
+    def write_data_context(self, data, callback=None, compression=None, digest=False):
         """Write to mooltipass data context.
 
         Adds a layer to data which is necessary to enable retrieval.
@@ -135,19 +230,62 @@ class MooltipassClient(_Mooltipass):
             callback -- function to receive tuple containing progress
                     in tuple form (x, y) where x is bytes sent and y
                     is size of transmission.
+            compression -- see write_data_stream().
+            digest -- see write_data_stream().
 
         Return true/false on success/error.
         """
+        return self.write_data_stream([data], len(data), callback, compression, digest)
+
+    def write_data_stream(self, source, length, callback=None, compression=None,
+                          digest=False):
+        """Write length bytes from source to mooltipass data context.
+
+        Adds the same layer as write_data_context(), without holding
+        the data in memory as a whole.
+
+        Arguments:
+            source -- binary file-like object or iterable of bytes-like
+                    chunks.
+            length -- number of bytes to write.
+            callback -- as for write_data_context().
+            compression -- None to store the data as is, 'zlib' or
+                    'lzma' to compress it, or 'auto' for whichever
+                    compresses best. With 'auto' the data is stored as
+                    is if compressing does not make it smaller and
+                    source can be read again (see compression.py).
+            digest -- whether to store a digest of the data with it (see
+                    read_data_digest()). The digest goes ahead of the
+                    data, so unless it is compressed source must be one
+                    which can be read twice. Mooltipy versions older
+                    than the digest can not read such contexts.
+
+        Return true on success; raises RuntimeError if source ends
+        before length bytes or a digest is asked for which can not be
+        worked out.
+        """
+        with _framed_data(source, length, compression, digest) as (chunks, size):
+            return super().write_data_stream(chunks, size, callback)
+
+    def read_data_digest(self):
+        """Return the digest stored with the data of the context.
 
-        # Prefix a length indicator to the start of our data. Reading
-        # back from the mooltipass provides 32 byte blocks and the unit
-        # has no concept of where in the final block our last byte is
-        # located. Use this lenth indicator to find the end byte.
-        lod = struct.pack('>L', len(data))
-        ext_data = array('B', lod)
-        ext_data.extend(data)
+        Only the first block of the context is read, so comparing
+        data_digest() of some data with this tells in one round trip
+        whether the context already holds it. Call set_data_context()
+        before, and again before reading the data.
 
-        return super().write_data_context(ext_data, callback)
+        Return the digest as bytes, or None if the context is empty or
+        was written without one.
+        """
+        block = self._command(CMD_READ_32B_IN_DN, timeout=5000)
+        # A lone 0 marks the end of the data
+        if len(block) == 1:
+            return None
+        lod = struct.unpack('>L', block[:4])[0]
+        if not lod & DIGEST_FLAG:
+            return None
+        return bytes(block[4:4+DIGEST_SIZE])
 
     def read_data_context(self, callback=None):
         """Read data from context.
@@ -159,16 +297,261 @@ class MooltipassClient(_Mooltipass):
 
         Return data as array or None.
         """
+        data = array('B')
+        for block in self.iter_data_context(callback):
+            data.frombytes(block)
+        return data
+
+    def export_data_contexts(self, contexts=None, read_ahead=4):
+        """Yield (context, data) for data contexts, read node by node.
+
+        Must be called in memory management mode. Rather than reading
+        32 bytes per command with read_data_context(), each context is
+        rebuilt from the 128 bytes of data in each of its data nodes,
+        read down the chain with read-ahead, so backing up many contexts
+        takes a fraction of the round trips. The data is taken as the
+        nodes store it.
+
+        Keyword arguments:
+            contexts -- names of the contexts to export (default all).
+            read_ahead -- data nodes to read ahead on a worker thread.
+
+        data is an array as read_data_context() returns. Raises
+        RuntimeError, once the others are exported, for contexts which
+        do not exist, and as read_data_context() does.
+        """
+        wanted = None if contexts is None else set(contexts)
+        found = set()
+        for pnode in self.parent_nodes('data'):
+            if wanted is not None and pnode.service_name not in wanted:
+                continue
+            found.add(pnode.service_name)
+            data = array('B')
+            dnodes = pnode.child_nodes(read_ahead=read_ahead)
+            for block in _stored_data(dnode.data for dnode in dnodes):
+                data.frombytes(block)
+            yield pnode.service_name, data
+        if wanted is not None and wanted - found:
+            raise RuntimeError('No such data context: {}'.format(
+                    ', '.join(sorted(wanted - found))))
+
+    def read_data_context_into(self, buffer, callback=None):
+        """Read data from context into a preallocated buffer.
+
+        The blocks read are copied straight into buffer, so a caller
+        fetching the same data repeatedly can reuse one buffer.
+
+        Arguments:
+            buffer -- writable bytes-like object, e.g. a bytearray.
+            callback -- see read_data_context().
+
+        Return the number of bytes read into buffer. Raises
+        RuntimeError if the data does not fit, after reading it all.
+        """
+        view = memoryview(buffer).cast('B')
+        size = 0
+        for block in self.iter_data_context(callback):
+            end = size + len(block)
+            if end <= len(view):
+                view[size:end] = block
+            size = end
+        if size > len(view):
+            raise RuntimeError('{} bytes of data do not fit in a {} byte buffer.'.format(
+                    size, len(view)))
+        return size
+
+    def iter_data_context(self, callback=None):
+        """Yield the data of the context as it is read, in blocks.
+
+        The blocks are memoryviews trimmed to the length written ahead
+        of the data (see write_data_stream()); the padding after it is
+        read but not yielded. Compressed data is decompressed as it is
+        read and yielded in bytes of any length.
 
-        data = super().read_data_context(callback)
-        # See write_data_context for explanation of lod
-        lod = struct.unpack('>L', data[:4])[0]
-        logging.debug('Expecting: ' + str(lod) + ' bytes...')
-        if not lod <= len(data):
-            raise RuntimeError('The size of data received from the device ' + \
-                    'does not match what was expected. This can happen if ' + \
-                    'a data transfer was cancelled.')
-        return data[4:lod+4]
+        Arguments:
+            callback -- see read_data_context().
+
+        Raises RuntimeError, after the last block, if the context holds
+        less data than its length says.
+        """
+        return _stored_data(super().iter_data_context(callback))
+
+    def read_data_stream(self, sink, callback=None):
+        """Write the data of the context to sink as it is read.
+
+        Arguments:
+            sink -- binary file-like object, e.g. sys.stdout.buffer.
+            callback -- see read_data_context().
+
+        Return the number of bytes written. Raises RuntimeError as
+        iter_data_context() does, once the data read has been written.
+        """
+        written = 0
+        for block in self.iter_data_context(callback):
+            sink.write(block)
+            written += len(block)
+        return written
+
+    def write_bundle(self, name, files, chunk_size=BUNDLE_CHUNK_SIZE,
+                     callback=None, compression='auto'):
+        """Store files in a bundle of data contexts with a manifest.
+
+        A data context can only be read from its start, so one holding
+        many files has to be read whole to get at any of them. A bundle
+        instead splits the files, one after the other, over chunk
+        contexts named by bundle_chunk_name() of chunk_size bytes each,
+        and stores a manifest of where each file is in the context name.
+        read_bundle_file() then reads only the chunks holding a file.
+
+        Every context is added with add_data_context(), so each needs
+        confirming on the device. The manifest is written last.
+
+        Arguments:
+            name -- name of the bundle, which must not exist yet.
+            files -- iterable of (path, source, length) tuples, where
+                    source and length are as for write_data_stream().
+
+        Keyword arguments:
+            chunk_size -- bytes of the files stored in each chunk; read
+                    in memory one chunk at a time.
+            callback -- function to receive tuple containing progress
+                    in tuple form (x, y) where x is bytes of the files
+                    stored and y their total size, after each chunk.
+            compression -- as for write_data_stream(), for each chunk.
+
+        Return the manifest. Raises RuntimeError if a context exists or
+        can not be added, or a source ends early.
+        """
+        files = list(files)
+        total = sum(length for path, source, length in files)
+        manifest = OrderedDict([
+            ('version', BUNDLE_VERSION),
+            ('chunk_size', chunk_size),
+            ('size', total),
+            ('chunks', []),
+            ('files', OrderedDict()),
+        ])
+        chunk = bytearray()
+        stored = 0
+
+        def write_chunk():
+            nonlocal stored
+            context = bundle_chunk_name(name, len(manifest['chunks']))
+            self._add_bundle_context(context)
+            self.write_data_context(bytes(chunk), compression=compression)
+            manifest['chunks'].append(context)
+            stored += len(chunk)
+            del chunk[:]
+            if callback:
+                callback((stored, total))
+
+        for path, source, length in files:
+            if path in manifest['files']:
+                raise RuntimeError('{} is in the bundle twice.'.format(path))
+            manifest['files'][path] = [stored + len(chunk), length]
+            remaining = length
+            for data in iter_chunks(source, 1 << 16):
+                data = memoryview(data).cast('B')[:remaining]
+                remaining -= len(data)
+                while data:
+                    take = chunk_size - len(chunk)
+                    chunk += data[:take]
+                    data = data[take:]
+                    if len(chunk) == chunk_size:
+                        write_chunk()
+                if not remaining:
+                    break
+            if remaining:
+                raise RuntimeError('{} ended after {} of {} bytes.'.format(
+                        path, length - remaining, length))
+        if chunk:
+            write_chunk()
+
+        self._add_bundle_context(name)
+        self.write_data_context(json.dumps(manifest).encode(), compression='auto')
+        logging.debug('Bundled {} files, {} bytes, in {} chunks'.format(
+                len(files), total, len(manifest['chunks'])))
+        return manifest
+
+    def _add_bundle_context(self, context):
+        """Add and set a data context for a bundle."""
+        if self.set_data_context(context):
+            raise RuntimeError('Data context {} already exists.'.format(context))
+        if not self.add_data_context(context) or not self.set_data_context(context):
+            raise RuntimeError('Request to add context {} denied or timed out.'.format(
+                    context))
+
+    def read_bundle_manifest(self, name):
+        """Return the manifest of a bundle (see write_bundle()).
+
+        The manifest is a dict; 'files' maps each path to its
+        [offset, length] in the bundle, 'chunks' lists the chunk
+        contexts in order and 'chunk_size' gives the bytes in each.
+
+        Raises RuntimeError if name does not exist or is not a bundle.
+        """
+        if not self.set_data_context(name):
+            raise RuntimeError('No such data context: {}'.format(name))
+        try:
+            manifest = json.loads(self.read_data_context().tobytes().decode(),
+                                  object_pairs_hook=OrderedDict)
+        except ValueError:
+            manifest = None
+        if not isinstance(manifest, dict) or \
+                not {'version', 'chunk_size', 'chunks', 'files'} <= set(manifest):
+            raise RuntimeError('{} is not a bundle.'.format(name))
+        if manifest['version'] != BUNDLE_VERSION:
+            raise RuntimeError('Unsupported bundle manifest (version {}).'.format(
+                    manifest['version']))
+        return manifest
+
+    def read_bundle_file(self, name, path, sink, manifest=None):
+        """Write one file of a bundle to sink, reading only its chunks.
+
+        Reading stops at the end of the file, so only the chunks before
+        it are read whole.
+
+        Arguments:
+            name -- name of the bundle.
+            path -- path of the file in the bundle's manifest.
+            sink -- binary file-like object, e.g. sys.stdout.buffer.
+
+        Keyword argument:
+            manifest -- the bundle's manifest, if already read (see
+                    read_bundle_manifest()).
+
+        Return the number of bytes written. Raises RuntimeError if the
+        file is not in the bundle or a chunk is missing or too short.
+        """
+        if manifest is None:
+            manifest = self.read_bundle_manifest(name)
+        if path not in manifest['files']:
+            raise RuntimeError('No such file in bundle {}: {}'.format(name, path))
+        offset, length = manifest['files'][path]
+        chunk_size = manifest['chunk_size']
+        end = offset + length
+        written = 0
+        chunks = range(offset // chunk_size, -(-end // chunk_size)) if length else ()
+        for index in chunks:
+            context = manifest['chunks'][index]
+            if not self.set_data_context(context):
+                raise RuntimeError('Bundle chunk {} is missing.'.format(context))
+            # The part of the file in this chunk
+            start = max(offset - index * chunk_size, 0)
+            stop = min(end - index * chunk_size, chunk_size)
+            position = 0
+            for block in self.iter_data_context():
+                if position + len(block) > start:
+                    piece = block[max(start - position, 0):stop - position]
+                    sink.write(piece)
+                    written += len(piece)
+                position += len(block)
+                if position >= stop:
+                    break
+        if written != length:
+            raise RuntimeError('Only {} of {} bytes of {} found in bundle {}.'.format(
+                    written, length, path, name))
+        return written
 
     def read_node(self, node_addr, parent_weak_ref=None):
         """Extend Mooltipass class to return a Node object.
@@ -180,34 +563,308 @@ class MooltipassClient(_Mooltipass):
                 functions & variables. Optional, and default assumes
                 the parent object is Mooltipassclient.
         """
-        recv = super().read_node(node_addr)
+        with self._io_lock:
+            recv = self._cached_node(node_addr)
+            if recv is None:
+                recv = super().read_node(node_addr)
+                self._cache_node(node_addr, recv)
         if parent_weak_ref == None:
             parent_weak_ref = weakref.ref(self)()
-        # Use flags to figure out the node type
-        flags = struct.unpack('<H', recv[:2])[0]
-        if flags & 0xC000 == PARENT_NODE:
-            # This is a parent node
-            return ParentNode(node_addr, recv, parent_weak_ref)
-        elif flags & 0xC000 == CHILD_NODE:
-            # This is a credential child node
-            return ChildNode(node_addr, recv, parent_weak_ref)
-        elif flags & 0xC000 == PARENT_DATA:
-            return ParentNode(node_addr, recv, parent_weak_ref)
-        else:
-            return DataNode(node_addr, recv, parent_weak_ref)
+        return make_node(node_addr, recv, parent_weak_ref)
+
+    def read_nodes(self, node_addrs, parent_weak_ref=None, strict=True):
+        """Read several nodes in one batch; return Node objects.
+
+        See read_node() for arguments. With strict False, nodes the
+        device refuses to read are returned as None.
+        """
+        recvs = {}
+        with self._io_lock:
+            for addr in node_addrs:
+                if addr not in recvs:
+                    recvs[addr] = self._cached_node(addr)
+            missing = [addr for addr, recv in recvs.items() if recv is None]
+            if missing:
+                for addr, recv in zip(missing, super().read_nodes(missing, strict)):
+                    if recv is not None:
+                        self._cache_node(addr, recv)
+                    recvs[addr] = recv
+        if parent_weak_ref == None:
+            parent_weak_ref = weakref.ref(self)()
+        return [None if recvs[addr] is None else make_node(addr, recvs[addr][:], parent_weak_ref)
+                for addr in node_addrs]
+
+    def _write_node(self, node_number, node_data, chunks=None):
+        """Write a node, dropping it from the node cache.
+
+        Keyword argument:
+            chunks -- numbers of the chunks which changed (see
+                    Node.dirty_chunks); default all.
+
+        Only the given chunks are sent while partial_node_writes allows.
+        The first partial write is read back to find out whether the
+        device commits chunks written on their own; if not, the whole
+        node is written and partial_node_writes set False.
+        """
+        # Held until the node is written, so a read ahead worker can not
+        # cache the old node again in between
+        with self._io_lock:
+            self._node_cache.pop(node_number, None)
+            self._snapshot = None
+            if chunks is None or 0 in chunks:
+                # The flags, in chunk 0, say whether the node is in use
+                self._update_free_slots(node_number,
+                        (node_data[0] | node_data[1] << 8) & NODE_INVALID)
+            if not self._graph_written:
+                # Nodes can be rewritten in place without moving the
+                # fingerprint, so never trust a saved graph after a write.
+                self._graph_written = True
+                path = self._node_graph_path()
+                try:
+                    if path is not None:
+                        os.unlink(path)
+                except OSError:
+                    pass
+
+            if chunks is not None and len(chunks) < NODE_CHUNKS and \
+                    self.partial_node_writes is not False:
+                if not chunks:
+                    return
+                try:
+                    super()._write_node(node_number, node_data, chunks)
+                except RuntimeError:
+                    written = False
+                else:
+                    written = self.partial_node_writes or \
+                            self._node_matches(node_number, node_data)
+                if written:
+                    self.partial_node_writes = True
+                    return
+                logging.debug('Partial node writes not committed; writing whole nodes.')
+                self.partial_node_writes = False
+
+            return super()._write_node(node_number, node_data)
+
+    def _node_matches(self, node_number, node_data):
+        """Read a node back; return True if it holds node_data.
+
+        The whole node is compared, as the chunks not sent must hold
+        what they did too, bar the user id bits of the flags.
+        """
+        recv = super().read_node(node_number)
+        expected = array('B', node_data)
+        mask = ~NODE_USER_MASK >> 8 & 0xFF
+        recv[1] &= mask
+        expected[1] &= mask
+        return recv == expected
 
     def write_node(self, node):
-        """Write to a node in memory."""
-        return super()._write_node(node.addr, node.raw)
+        """Write to a node in memory, sending only its dirty chunks."""
+        return node._write(self)
 
-    def parent_nodes(self, node_type=None):
+    def parent_nodes(self, node_type=None, read_ahead=None):
         """Return a ParentNodes iter.
 
         Arguments:
             node_type = [login|data]
+
+        Keyword argument:
+            read_ahead -- nodes to read ahead on a worker thread
+                    (default self.read_ahead).
         """
         # TODO: Comment and make a property too?
-        return _ParentNodes(node_type, self)
+        return _ParentNodes(node_type, self, read_ahead)
+
+    def snapshot(self):
+        """Read every login & data node once; return a NodeSnapshot.
+
+        Must be called in memory management mode. The snapshot is kept
+        until a node is written or memory management mode is left, and
+        is used meanwhile to validate starting parent addresses.
+        """
+        self._snapshot = NodeSnapshot(self)
+        return self._snapshot
+
+    def free_slots(self):
+        """Return the addresses of every free node, in flash order.
+
+        Must be called in memory management mode. The first call pages
+        through the whole flash 31 slots at a time; the list is then
+        kept up to date as nodes are written or deleted, until memory
+        management mode is left.
+        """
+        if self._free_slots is None:
+            free = []
+            start_addr = 0
+            while True:
+                addrs = super().get_free_slot_addresses(start_addr)
+                free.extend(addrs)
+                if len(addrs) < FREE_SLOTS_PER_REPLY:
+                    break
+                start_addr = addrs[-1] + 1
+            logging.debug('{} free node slots'.format(len(free)))
+            self._free_slots = free
+        return list(self._free_slots)
+
+    def allocate_nodes(self, count):
+        """Reserve count free nodes; return their addresses.
+
+        Addresses are handed out in flash order from free_slots() and
+        are not offered again unless written back as free. Nothing is
+        written to the device until the nodes are.
+
+        Raises RuntimeError if fewer than count nodes are free.
+        """
+        free = self.free_slots()
+        if count > len(free):
+            raise RuntimeError('Only {} free nodes; {} needed.'.format(len(free), count))
+        del self._free_slots[:count]
+        return free[:count]
+
+    def _update_free_slots(self, node_addr, free):
+        """Record whether node_addr is free in the free slot list."""
+        if self._free_slots is None:
+            return
+        i = bisect.bisect_left(self._free_slots, node_addr)
+        present = i < len(self._free_slots) and self._free_slots[i] == node_addr
+        if free and not present:
+            self._free_slots.insert(i, node_addr)
+        elif not free and present:
+            del self._free_slots[i]
+
+    def _node_graph_path(self):
+        """Return the node graph file of the card, None if unknown."""
+        if self._card_cpz is None:
+            return None
+        return cache_path(self._card_cpz.hex(), self.node_graph_dir)
+
+    def _fingerprint(self):
+        """Return values which change whenever the node graph does.
+
+        The CTR moves whenever a password is written and the starting
+        parents & free slots whenever nodes are added or deleted. Raises
+        RuntimeError if the mooltipass refuses them, i.e. it is not in
+        memory management mode.
+        """
+        batch = self.batch()
+        batch.add(CMD_GET_CTRVALUE)
+        batch.add(CMD_GET_STARTING_PARENT)
+        batch.add(CMD_GET_DN_START_PARENT)
+        batch.add(CMD_GET_30_FREE_SLOTS, 0)
+        return batch.send()
+
+    def node_graph(self, use_cache=None):
+        """Return a NodeGraph of every login & data node.
+
+        Must be called in memory management mode. The graph saved for
+        the card by the last call is brought up to date rather than
+        read again (see _refresh_graph()), then saved for next time.
+
+        Keyword argument:
+            use_cache -- set False to read every node and neither load
+                    nor save a graph; default True unless
+                    MOOLTIPY_NO_CACHE is set (see node_graph.py).
+        """
+        if use_cache is None:
+            use_cache = cache_enabled()
+        path = self._node_graph_path() if use_cache else None
+        fingerprint = self._fingerprint()
+        graph = NodeGraph.load(path) if path is not None else None
+        if graph is None or graph.fingerprint is None:
+            graph = NodeGraph.from_snapshot(self.snapshot(), fingerprint)
+        elif graph.fingerprint != fingerprint:
+            graph = self._refresh_graph(graph, fingerprint)
+        else:
+            logging.debug('Using node graph cached in {}'.format(path))
+            return graph
+        if path is None:
+            return graph
+        try:
+            graph.save(path)
+            self._graph_written = False
+        except OSError as e:
+            logging.debug('Could not save node graph: {}'.format(e))
+        return graph
+
+    def _refresh_graph(self, graph, fingerprint):
+        """Return graph brought up to date with the device.
+
+        If a starting parent or the free slots moved, nodes were added
+        or deleted, so the chains of that type (login or data) are
+        walked again. Otherwise, if the CTR moved, passwords were
+        written, which changes the dates of login child nodes, so those
+        are read again. Either way the nodes in graph are read in
+        batches first and only nodes new to it one at a time.
+        """
+        old = graph.fingerprint
+        slots_moved = old[3] != fingerprint[3]
+        parents = {}
+        children = {}
+        for i, node_type in enumerate(NODE_TYPES):
+            pnodes = graph.parent_nodes(node_type)
+            addrs = [cnode.addr for pnode in pnodes for cnode in graph.child_nodes(pnode)]
+            if slots_moved or old[1 + i] != fingerprint[1 + i]:
+                logging.debug('Walking the {} nodes again'.format(node_type))
+                addrs.extend(pnode.addr for pnode in pnodes)
+                known = {}
+            elif node_type == 'login' and old[0] != fingerprint[0]:
+                logging.debug('Reading the login child nodes again')
+                # Only child nodes change when passwords are written
+                known = {pnode.addr: pnode for pnode in pnodes}
+            else:
+                parents[node_type] = list(pnodes)
+                for pnode in pnodes:
+                    children[pnode.addr] = list(graph.child_nodes(pnode))
+                continue
+            # Nodes deleted since are refused and left out
+            for node in self.read_nodes(addrs, strict=False):
+                if node is not None:
+                    known[node.addr] = node
+            parents[node_type], type_children = self._walk_graph(
+                    node_type, fingerprint[1 + i], known)
+            children.update(type_children)
+        return NodeGraph(parents, children, fingerprint)
+
+    def _walk_graph(self, node_type, start_addr, known):
+        """Return (parents, children) metadata down the chains of node_type.
+
+        Arguments:
+            node_type -- login or data.
+            start_addr -- address of the starting parent.
+            known -- nodes or metadata by address, used rather than
+                    reading the node.
+        """
+        def node(addr):
+            if addr not in known:
+                known[addr] = self.read_node(addr)
+            return known[addr]
+
+        parents = []
+        children = {}
+        addr = start_addr
+        while addr:
+            pnode = node(addr)
+            parents.append(parent_info(pnode))
+            cnodes = []
+            child_addr = pnode.next_child_addr
+            while child_addr:
+                cnode = node(child_addr)
+                cnodes.append(child_info(node_type, cnode))
+                if node_type == 'data':
+                    child_addr = cnode.next_data_addr
+                else:
+                    child_addr = cnode.next_child_addr
+            children[pnode.addr] = cnodes
+            addr = pnode.next_parent_addr
+        return parents, children
+
+    def _parent_addrs(self, node_type):
+        """Return the addresses of node_type parents, plus 0 for none."""
+        if self._snapshot is not None:
+            pnodes = self._snapshot.parent_nodes(node_type)
+        else:
+            pnodes = self.parent_nodes(node_type)
+        return {0} | {pnode.addr for pnode in pnodes}
 
     def set_starting_parent(self, parent_addr):
         """Set the starting parent node.
@@ -215,9 +872,7 @@ class MooltipassClient(_Mooltipass):
         Overrides mooltipass._set_starting_parent() and add some protection
         to the call by ensuring the address specified is valid.
         """
-        valid_addresses = [0]
-        for pnode in self.parent_nodes('login'):
-            valid_addresses.append(pnode.addr)
+        valid_addresses = self._parent_addrs('login')
 
         # You can brick your mooltipass by providing an invalid starting parent.
         if not parent_addr in valid_addresses:
@@ -231,15 +886,454 @@ class MooltipassClient(_Mooltipass):
         Overrides mooltipass._set_starting_data_parent_addr() and add some
         protection to the call by ensuring the address specified is valid.
         """
-        valid_addresses = [0]
-        for pnode in self.parent_nodes('data'):
-            valid_addresses.append(pnode.addr)
+        valid_addresses = self._parent_addrs('data')
 
         if not parent_addr in valid_addresses:
             raise RuntimeError('Can not set the starting parent to an invalid node address!')
 
         return super()._set_starting_data_parent_addr(parent_addr)
 
+    def delete_nodes(self, nodes):
+        """Delete several parent and/or child nodes at once.
+
+        Deleting a parent deletes its child or data nodes too. The links
+        of the surviving nodes are worked out once from a snapshot, then
+        each surviving node whose links changed is written once, the
+        starting parents set at most once each, and finally the deleted
+        nodes are erased. Must be called in memory management mode.
+
+        Arguments:
+            nodes -- iterable of ParentNode and ChildNode objects.
+
+        Returns the number of nodes erased. Raises RuntimeError for
+        nodes which are not linked from a starting parent and for data
+        nodes whose data parent is kept.
+        """
+        snapshot = self._snapshot or self.snapshot()
+        doomed = set()
+        for node in nodes:
+            if node.addr not in snapshot.nodes:
+                raise RuntimeError('Node 0x{:x} is not linked from a starting parent.'.format(
+                        node.addr))
+            doomed.add(node.addr)
+
+        changed = {}
+
+        def relink(chain, prev_attr, next_attr):
+            survivors = [n for n in chain if n.addr not in doomed]
+            return _relink(survivors, prev_attr, next_attr, changed)
+
+        starting_parents = {}
+        for node_type in NODE_TYPES:
+            pnodes = snapshot.parent_nodes(node_type)
+            for pnode in pnodes:
+                cnodes = snapshot.child_nodes(pnode)
+                if pnode.addr in doomed:
+                    doomed.update(cnode.addr for cnode in cnodes)
+                    continue
+                if node_type == 'data':
+                    if any(cnode.addr in doomed for cnode in cnodes):
+                        raise RuntimeError('Data nodes can only be deleted with their data context.')
+                    continue
+                first_child = relink(cnodes, 'prev_child_addr', 'next_child_addr')
+                if pnode.next_child_addr != first_child:
+                    pnode.next_child_addr = first_child
+                    changed[pnode.addr] = pnode
+            first_parent = relink(pnodes, 'prev_parent_addr', 'next_parent_addr')
+            if pnodes and pnodes[0].addr != first_parent:
+                starting_parents[node_type] = first_parent
+
+        # Unlink before erasing so the chains never lead to erased nodes
+        for node in changed.values():
+            node.write()
+        if 'login' in starting_parents:
+            super()._set_starting_parent(starting_parents['login'])
+        if 'data' in starting_parents:
+            super()._set_starting_data_parent_addr(starting_parents['data'])
+        for addr in doomed:
+            node = snapshot.nodes[addr]
+            node.raw = array('B', b'\xff'*132)
+            node.write()
+        return len(doomed)
+
+    def import_logins(self, logins):
+        """Create login contexts & logins by writing their nodes directly.
+
+        Must be called in memory management mode, so entering it is the
+        only confirmation needed. The nodes of contexts and logins which
+        do not exist yet are written to free slots, sorted in among the
+        existing nodes as the mooltipass sorts them. The new nodes are
+        written first, then each existing node whose links changed once
+        and the starting parent at most once.
+
+        The new logins have no password; only the card can encrypt one,
+        so set them afterwards with set_context(), set_login() and
+        set_password() outside memory management mode.
+
+        Arguments:
+            logins -- iterable of (service_name, login) string tuples.
+
+        Returns the list of (service_name, login) tuples created, in the
+        order given. Raises RuntimeError for names which do not fit in a
+        node or if there are not enough free nodes.
+        """
+        snapshot = self._snapshot or self.snapshot()
+
+        wanted = OrderedDict()
+        for service_name, login in logins:
+            if not service_name or len(service_name) > 57:
+                raise RuntimeError('Context must be 1 to 57 characters long: {}'.format(
+                        service_name))
+            if len(login) > 62:
+                raise RuntimeError('Login can not exceed 62 characters: {}'.format(login))
+            if snapshot.child(service_name, login) is None:
+                wanted.setdefault(service_name, OrderedDict())[login] = None
+        created = [(service_name, login)
+                   for service_name, new_logins in wanted.items() for login in new_logins]
+        if not created:
+            return created
+
+        new_parents = [name for name in wanted if snapshot.parent(name) is None]
+        addrs = iter(self.allocate_nodes(len(new_parents) + len(created)))
+        parent_weak_ref = weakref.ref(self)()
+        date = encode_date()
+        pnodes = list(snapshot.parent_nodes('login'))
+        starting_parent = pnodes[0].addr if pnodes else 0
+        children = {}
+        new_nodes = []
+
+        def insert_sorted(chain, node, key):
+            # Before the first node which does not sort lower, as the
+            # mooltipass inserts
+            i = 0
+            while i < len(chain) and getattr(chain[i], key) < getattr(node, key):
+                i += 1
+            chain.insert(i, node)
+
+        for pnode in pnodes:
+            children[pnode.addr] = list(snapshot.child_nodes(pnode))
+        for service_name in sorted(new_parents):
+            raw = array('B', ParentNode._STRUCT.pack(PARENT_NODE, 0, 0, 0,
+                    service_name.encode(ENCODING)))
+            pnode = ParentNode(next(addrs), raw, parent_weak_ref)
+            new_nodes.append(pnode)
+            insert_sorted(pnodes, pnode, 'service_name')
+            children[pnode.addr] = []
+
+        changed = {}
+        for pnode in pnodes:
+            for login in sorted(wanted.get(pnode.service_name, ())):
+                raw = array('B', ChildNode._STRUCT.pack(CHILD_NODE, 0, 0, b'',
+                        date, date, bytes(3), login.encode(ENCODING), b''))
+                cnode = ChildNode(next(addrs), raw, pnode)
+                new_nodes.append(cnode)
+                insert_sorted(children[pnode.addr], cnode, 'login')
+            first_child = _relink(children[pnode.addr],
+                                  'prev_child_addr', 'next_child_addr', changed)
+            if pnode.next_child_addr != first_child:
+                pnode.next_child_addr = first_child
+                changed[pnode.addr] = pnode
+        first_parent = _relink(pnodes, 'prev_parent_addr', 'next_parent_addr', changed)
+
+        # Write the new nodes before linking them in so the chains never
+        # lead to unwritten nodes
+        for node in new_nodes:
+            changed.pop(node.addr, None)
+            self._write_node(node.addr, node.raw)
+        for node in changed.values():
+            node.write()
+        if first_parent != starting_parent:
+            super()._set_starting_parent(first_parent)
+        logging.debug('Imported {} logins into {} new nodes'.format(
+                len(created), len(new_nodes)))
+        return created
+
+    def update_data_context(self, context, data, compression=None, digest=False):
+        """Replace the data of a context, writing only what changed.
+
+        Must be called in memory management mode. The data nodes of the
+        context are read and compared with data laid out as
+        write_data_context() stores it, length first; only nodes which
+        differ are written, and within them only the chunks which
+        changed. Nodes are allocated or erased at the end of the chain
+        when the length changes. Changing a few bytes of a large context
+        thus writes a node or two instead of sending all of it.
+
+        Arguments:
+            context -- name of an existing data context.
+            data -- bytes-like data to store.
+
+        Keyword arguments:
+            compression -- as for write_data_stream(). A small change to
+                    compressed data changes most of the stream after
+                    it, so this mostly helps uncompressed contexts.
+            digest -- as for write_data_stream().
+
+        Return the number of nodes written or erased. Raises
+        RuntimeError if the context does not exist or there are not
+        enough free nodes.
+        """
+        for pnode in self.parent_nodes('data'):
+            if pnode.service_name == context:
+                break
+        else:
+            raise RuntimeError('No such data context: {}'.format(context))
+
+        data = memoryview(data).cast('B')
+        if digest:
+            digest = new_digest()
+            digest.update(data)
+        else:
+            digest = None
+        stored = _data_header(len(data), digest) + data
+        if compression is not None:
+            spool, size = compress([data], len(data), _compression_methods(compression))
+            with spool:
+                if compression != 'auto' or size < len(data):
+                    stored = _data_header(size | CONTAINER_FLAG, digest) + spool.read()
+        pieces = [stored[i:i+DATA_NODE_SIZE] for i in range(0, len(stored), DATA_NODE_SIZE)]
+
+        dnodes = list(pnode.child_nodes())
+        kept = dnodes[:len(pieces)]
+        new_addrs = self.allocate_nodes(len(pieces) - len(kept)) if len(pieces) > len(kept) else []
+        addrs = [dnode.addr for dnode in kept] + new_addrs + [0]
+
+        def blocks(piece):
+            return -(-len(piece) // DATA_BLOCK_SIZE)
+
+        # Write the new nodes before linking them in so the chain never
+        # leads to unwritten nodes, then erase the old ones after
+        # unlinking them.
+        written = 0
+        for i in range(len(kept), len(pieces)):
+            raw = array('B', DataNode._STRUCT.pack(CHILD_DATA | blocks(pieces[i]),
+                    addrs[i+1], pieces[i]))
+            self._write_node(addrs[i], raw)
+            written += 1
+        for i, dnode in enumerate(kept):
+            dnode.data = pieces[i]
+            if dnode.blocks != blocks(pieces[i]):
+                dnode.blocks = blocks(pieces[i])
+            if dnode.next_data_addr != addrs[i+1]:
+                dnode.next_data_addr = addrs[i+1]
+            if dnode.dirty_chunks:
+                dnode.write()
+                written += 1
+        if not kept:
+            pnode.next_child_addr = addrs[0]
+            pnode.write()
+            written += 1
+        for dnode in dnodes[len(pieces):]:
+            dnode.raw = array('B', b'\xff'*132)
+            dnode.write()
+            written += 1
+        logging.debug('Updated {} of {} data nodes'.format(written, len(pieces)))
+        return written
+
+
+def _stored_data(blocks):
+    """Yield the data stored behind the length header of blocks.
+
+    See MooltipassClient.iter_data_context().
+    """
+    lod = None
+    remaining = 0
+    container = None
+    for block in blocks:
+        block = memoryview(block)
+        if lod is None:
+            # See _data_header() for explanation of lod
+            lod = struct.unpack('>L', block[:4])[0]
+            if lod & CONTAINER_FLAG:
+                container = Decompressor()
+            block = block[4+DIGEST_SIZE:] if lod & DIGEST_FLAG else block[4:]
+            lod &= LENGTH_MASK
+            logging.debug('Expecting: ' + str(lod) + ' bytes...')
+            remaining = lod
+        if remaining:
+            block = block[:remaining]
+            remaining -= len(block)
+            if container is not None:
+                block = container.decompress(block)
+                if not block:
+                    continue
+            yield block
+    if lod is None or remaining:
+        raise RuntimeError('The size of data received from the device ' + \
+                'does not match what was expected. This can happen if ' + \
+                'a data transfer was cancelled.')
+    if container is not None:
+        container.finish()
+
+
+def bundle_chunk_name(name, index):
+    """Return the name of a chunk context of a bundle."""
+    return '{}#{}'.format(name, index)
+
+
+def _data_header(lod, digest=None):
+    """Return the header written ahead of the data of a context.
+
+    Prefix a length indicator to the start of our data. Reading back
+    from the mooltipass provides 32 byte blocks and the unit has no
+    concept of where in the final block our last byte is located. Use
+    this length indicator to find the end byte. The digest, if any,
+    follows it (see compression.py).
+    """
+    if digest is None:
+        return struct.pack('>L', lod)
+    return struct.pack('>L', lod | DIGEST_FLAG) + digest.digest()
+
+
+@contextlib.contextmanager
+def _framed_data(source, length, compression=None, digest=False):
+    """Yield (chunks, size) of what to write to a data context.
+
+    chunks is an iterator of the header and the (compressed) data, size
+    the number of bytes in it. Arguments are as for
+    MooltipassClient.write_data_stream().
+    """
+    digest = new_digest() if digest else None
+    if compression is not None:
+        methods = _compression_methods(compression)
+        rewind = _rewinder(source) if compression == 'auto' else None
+        spool, size = compress(iter_chunks(source, 1 << 16), length, methods, digest)
+        with spool:
+            if rewind is None or size < length:
+                header = _data_header(size | CONTAINER_FLAG, digest)
+                yield itertools.chain([header], iter_chunks(spool, 1 << 12)), size + len(header)
+                return
+        logging.debug('Compressing does not help; storing {} bytes as is'.format(length))
+        rewind()
+    elif digest is not None:
+        # The digest goes ahead of the data, so it is read twice
+        rewind = _rewinder(source)
+        if rewind is None:
+            raise RuntimeError('A digest needs data which can be read twice or compressed.')
+        _update_digest(digest, iter_chunks(source, 1 << 16), length)
+        rewind()
+
+    header = _data_header(length, digest)
+    yield itertools.chain([header], iter_chunks(source)), length + len(header)
+
+
+def _framed_bytes(data, compression=None, digest=False):
+    """Return data as write_data_context() stores it, as bytes.
+
+    Arguments are as for MooltipassClient.write_data_context().
+    """
+    with _framed_data([data], len(data), compression, digest) as (chunks, size):
+        framed = bytearray()
+        for chunk in chunks:
+            try:
+                framed += memoryview(chunk).cast('B')
+            except TypeError:
+                # Not bytes-like (e.g. a list of ints)
+                framed += bytes(chunk)
+        return bytes(framed[:size])
+
+
+def _update_digest(digest, chunks, length):
+    """Update digest with the first length bytes of chunks."""
+    for chunk in chunks:
+        try:
+            chunk = memoryview(chunk).cast('B')
+        except TypeError:
+            # Not bytes-like (e.g. a list of ints)
+            chunk = memoryview(bytes(chunk))
+        digest.update(chunk[:length])
+        length -= len(chunk)
+        if length <= 0:
+            break
+
+
+def data_digest(source, length):
+    """Return the digest stored with length bytes of source.
+
+    Arguments:
+        source -- binary file-like object or iterable of bytes-like
+                chunks, as for MooltipassClient.write_data_stream().
+        length -- number of bytes of data.
+
+    Compare with MooltipassClient.read_data_digest().
+    """
+    digest = new_digest()
+    _update_digest(digest, iter_chunks(source, 1 << 16), length)
+    return digest.digest()
+
+
+def _compression_methods(compression):
+    """Return the methods to try for a compression argument."""
+    if compression == 'auto':
+        return list(METHODS)
+    if compression in METHODS:
+        return [compression]
+    raise RuntimeError('Unknown compression method {}.'.format(compression))
+
+
+def _rewinder(source):
+    """Return a function to read source again from here, or None."""
+    if hasattr(source, 'read'):
+        if not (hasattr(source, 'seekable') and source.seekable()):
+            return None
+        start = source.tell()
+        return lambda: source.seek(start)
+    if iter(source) is source:
+        # An iterator can only be read once
+        return None
+    return lambda: None
+
+
+def _relink(chain, prev_attr, next_attr, changed):
+    """Link the nodes of chain in order; return the first one's address.
+
+    Nodes whose prev_attr or next_attr changed are added to changed.
+    """
+    for i, node in enumerate(chain):
+        prev_addr = chain[i-1].addr if i > 0 else 0
+        next_addr = chain[i+1].addr if i + 1 < len(chain) else 0
+        if getattr(node, prev_attr) != prev_addr:
+            setattr(node, prev_attr, prev_addr)
+            changed[node.addr] = node
+        if getattr(node, next_attr) != next_addr:
+            setattr(node, next_attr, next_addr)
+            changed[node.addr] = node
+    return chain[0].addr if chain else 0
+
+
+def encode_date(when=None):
+    """Return a date (default today) encoded as in child nodes.
+
+    Keyword argument:
+        when -- seconds since the epoch, as for time.localtime().
+    """
+    when = time.localtime(when)
+    return ((when.tm_year - 2010) << 9) | (when.tm_mon << 5) | when.tm_mday
+
+
+def decode_date(value):
+    """Return a child node date as a datetime.date, None if unset."""
+    try:
+        return datetime.date((value >> 9) + 2010, (value >> 5) & 0x0F, value & 0x1F)
+    except ValueError:
+        return None
+
+
+def make_node(node_addr, recv, parent_weak_ref=None):
+    """Return a Parent/Child/DataNode for raw node data."""
+    # Use flags to figure out the node type
+    flags = struct.unpack('<H', recv[:2])[0]
+    if flags & 0xC000 == PARENT_NODE:
+        # This is a parent node
+        return ParentNode(node_addr, recv, parent_weak_ref)
+    elif flags & 0xC000 == CHILD_NODE:
+        # This is a credential child node
+        return ChildNode(node_addr, recv, parent_weak_ref)
+    elif flags & 0xC000 == PARENT_DATA:
+        return ParentNode(node_addr, recv, parent_weak_ref)
+    else:
+        return DataNode(node_addr, recv, parent_weak_ref)
+
 
 class Node:
     """Parent/Child/Data nodes have some similar, overlapping structure.
@@ -248,20 +1342,83 @@ class Node:
     """
     # Node should accept a raw array of data from read_node(). Access to
     # each element contained within a node should be controlled through
-    # properties. This is not a typical design in Python, but in our case
-    # manipulation of nodes should be minimal (so performance is not a
-    # concern), separate properties will help clearly delineate values
-    # from the contiguous array of bytes provided by read_node(), and
-    # properties will be necessary for bound checking to aide in adhering
-    # to the constraints of the Mooltipass's node structure.
+    # properties, which help clearly delineate values from the contiguous
+    # array of bytes provided by read_node() and will be necessary for
+    # bound checking to aide in adhering to the constraints of the
+    # Mooltipass's node structure.
+    #
+    # Each node type unpacks raw with a single precompiled struct the first
+    # time a field is read; strings are decoded once when first read.
+    # Setters pack into raw, discard both and mark the chunks they touched
+    # dirty so write() only sends those.
 
-    addr = None
-    raw = None
-    _parent = None
+    __slots__ = ('addr', '_raw', '_view', '_fields', '_strings', '_dirty',
+                 '_parent', '__weakref__')
+
+    _ALL_CHUNKS = (1 << NODE_CHUNKS) - 1
+
+    # Flags and one address, then bytes depending on the node type
+    _STRUCT = struct.Struct('<HH128s')
+    _ADDR = struct.Struct('<H')
+
+    _FLAGS = 0
+    _FIRST_ADDR = 1
+
+    def __init__(self, node_addr, recv, parent_weak_ref = None):
+        self.addr = node_addr
+        self.raw = recv
+        self._dirty = 0
+        self._parent = parent_weak_ref
+
+    @property
+    def raw(self):
+        return self._raw
+
+    @raw.setter
+    def raw(self, value):
+        self._raw = value
+        self._view = memoryview(value)
+        self._fields = None
+        self._strings = None
+        self._dirty = self._ALL_CHUNKS
+
+    @property
+    def dirty_chunks(self):
+        """Numbers of the write chunks changed since read or written."""
+        return [c for c in range(NODE_CHUNKS) if self._dirty & (1 << c)]
+
+    def _touch(self, start, end):
+        """Mark the chunks holding raw[start:end] dirty."""
+        for c in range(start // NODE_CHUNK_SIZE, (end - 1) // NODE_CHUNK_SIZE + 1):
+            self._dirty |= 1 << c
+
+    def _field(self, index):
+        if self._fields is None:
+            self._fields = self._STRUCT.unpack_from(self._view)
+        return self._fields[index]
+
+    def _string(self, index):
+        if self._strings is None:
+            self._strings = {}
+        elif index in self._strings:
+            return self._strings[index]
+        value = self._field(index).partition(b'\0')[0].decode(ENCODING)
+        self._strings[index] = value
+        return value
+
+    def _set_addr(self, offset, value):
+        self._ADDR.pack_into(self._view, offset, value)
+        self._fields = None
+        self._touch(offset, offset + self._ADDR.size)
+
+    def _write(self, mooltipass):
+        ret = mooltipass._write_node(self.addr, self.raw, self.dirty_chunks)
+        self._dirty = 0
+        return ret
 
     @property
     def flags(self):
-        return struct.unpack('<H', self.raw[:2])[0]
+        return self._field(self._FLAGS)
 
     @property
     def first_addr(self):
@@ -270,16 +1427,11 @@ class Node:
         #  * ParentNode.prev_parent_addr
         #  * ChildNode.prev_child_addr
         #  * DataNode.next_data_addr
-        return struct.unpack('<H', self.raw[2:4])[0]
+        return self._field(self._FIRST_ADDR)
 
     @first_addr.setter
     def first_addr(self, value):
-        self.raw[2:4] = array('B', struct.pack('<H', value))
-
-    def __init__(self, node_addr, recv, parent_weak_ref = None):
-        self.addr = node_addr
-        self.raw = recv
-        self._parent = parent_weak_ref
+        self._set_addr(2, value)
 
 
 class ParentNode(Node):
@@ -288,46 +1440,51 @@ class ParentNode(Node):
     Inherits Node.
     """
 
-    @property
-    def flags(self):
-        return super().flags
+    __slots__ = ()
+
+    # flags, prev parent, next parent, next child, service name
+    _STRUCT = struct.Struct('<4H58s66x')
+
+    _NEXT_PARENT_ADDR = 2
+    _NEXT_CHILD_ADDR = 3
+    _SERVICE_NAME = 4
 
     @property
     def prev_parent_addr(self):
-        return super().first_addr
+        return self.first_addr
 
     @prev_parent_addr.setter
     def prev_parent_addr(self, value):
-        super(ParentNode, ParentNode).first_addr.__set__(self, value)
+        self.first_addr = value
 
     @property
     def next_parent_addr(self):
-        return struct.unpack('<H', self.raw[4:6])[0]
+        return self._field(self._NEXT_PARENT_ADDR)
 
     @next_parent_addr.setter
     def next_parent_addr(self, value):
-        self.raw[4:6] = array('B', struct.pack('<H', value))
+        self._set_addr(4, value)
 
     @property
     def next_child_addr(self):
-        return struct.unpack('<H', self.raw[6:8])[0]
+        return self._field(self._NEXT_CHILD_ADDR)
 
     @next_child_addr.setter
     def next_child_addr(self, value):
-        self.raw[6:8] = array('B', struct.pack('<H', value))
+        self._set_addr(6, value)
 
     @property
     def service_name(self):
-        return str_from_array(self.raw[8:66])
+        return self._string(self._SERVICE_NAME)
 
     def __str__(self):
-        return "<{}: Address:0x{:x}, PrevParent:0x{:x}, NextParent:0x{:x}, NextChild:0x{:x}, ServiceName:{}>".format(self.__class__.__name__, self.node_addr, self.prev_parent_addr, self.next_parent_addr, self.next_child_addr, self.service_name)
+        return "<{}: Address:0x{:x}, PrevParent:0x{:x}, NextParent:0x{:x}, NextChild:0x{:x}, ServiceName:{}>".format(self.__class__.__name__, self.addr, self.prev_parent_addr, self.next_parent_addr, self.next_child_addr, self.service_name)
 
     def __repr__(self):
         return str(self)
 
     def write(self):
-        return self._parent._write_node(self.addr, self.raw)
+        return self._write(self._parent)
 
     def delete(self):
         """Delete a parent node."""
@@ -353,15 +1510,18 @@ class ParentNode(Node):
             next_node.prev_parent_addr = self.prev_parent_addr
             next_node.write()
 
-        # Fill node; zero addresses
+        # Fill node
         self.raw = array('B', b'\xff'*132)
-        self.prev_parent_node = 0
-        self.next_parent_node = 0
         self.write()
 
-    def child_nodes(self):
-        """Return a child node iter."""
-        return _ChildNodes(self)
+    def child_nodes(self, read_ahead=None):
+        """Return a child node iter.
+
+        Keyword argument:
+            read_ahead -- nodes to read ahead on a worker thread
+                    (default MooltipassClient.read_ahead).
+        """
+        return _ChildNodes(self, read_ahead)
 
 
 class ChildNode(Node):
@@ -370,67 +1530,79 @@ class ChildNode(Node):
     Inherits Node.
     """
 
-    @property
-    def flags(self):
-        return super().flags
+    __slots__ = ()
+
+    # flags, prev child, next child, description, date created, date last
+    # used, ctr, login, password
+    _STRUCT = struct.Struct('<3H24sHH3s63s32s')
+
+    _NEXT_CHILD_ADDR = 2
+    _DESCRIPTION = 3
+    _DATE_CREATED = 4
+    _DATE_LAST_USED = 5
+    _CTR = 6
+    _LOGIN = 7
+    _PASSWORD = 8
+
+    _LOGIN_STRUCT = struct.Struct('<63s')
 
     @property
     def prev_child_addr(self):
-        return super().first_addr
+        return self.first_addr
 
     @prev_child_addr.setter
     def prev_child_addr(self, value):
-        super(ChildNode, ChildNode).first_addr.__set__(self, value)
+        self.first_addr = value
 
     @property
     def next_child_addr(self):
-        return struct.unpack('<H', self.raw[4:6])[0]
+        return self._field(self._NEXT_CHILD_ADDR)
 
     @next_child_addr.setter
     def next_child_addr(self, value):
-        self.raw[4:6] = array('B', struct.pack('<H', value))
+        self._set_addr(4, value)
 
     @property
     def description(self):
-        return str_from_array(self.raw[6:30])
+        return self._string(self._DESCRIPTION)
 
     @property
     def date_created(self):
-        return struct.unpack('<H', self.raw[30:32])[0]
+        return self._field(self._DATE_CREATED)
 
     @property
     def date_last_used(self):
-        return struct.unpack('<H', self.raw[32:34])[0]
+        return self._field(self._DATE_LAST_USED)
 
     @property
     def ctr(self):
-        c1, c2, c3 = struct.unpack('<3b', self.raw[34:37])[0]
-        # I have no idea if this is correct
-        return (c1 << 16) + (c2 << 8) + c3
+        return int.from_bytes(self._field(self._CTR), 'big')
 
     @property
     def login(self):
-        return str_from_array(self.raw[37:100])
+        return self._string(self._LOGIN)
 
     @login.setter
     def login(self, value):
         if len(value) > 62:
             raise RuntimeError('Login can not exceed 62 characters.')
-        self.raw[37:100] = array('B',
-                                 struct.pack('<63s', value.encode(ENCODING)))
+        self._LOGIN_STRUCT.pack_into(self._view, 37, value.encode(ENCODING))
+        self._fields = None
+        self._strings = None
+        self._touch(37, 37 + self._LOGIN_STRUCT.size)
 
     @property
     def password(self):
-        return str_from_array(self.raw[100:132])
+        return self._string(self._PASSWORD)
 
     def __str__(self):
-        return "<{}: Address:0x{:x} PrevChild:0x{:x} NextChild:0x{:x} Login:{}>".format(self.__class__.__name__, self.node_addr, self.prev_child_addr, self.next_child_addr, self.login)
+        return "<{}: Address:0x{:x} PrevChild:0x{:x} NextChild:0x{:x} Login:{}>".format(self.__class__.__name__, self.addr, self.prev_child_addr, self.next_child_addr, self.login)
 
     def __repr__(self):
         return str(self)
 
     def write(self):
-        return self._parent._parent._write_node(self.addr, self.raw)
+        return self._write(self._parent._parent)
 
     def delete(self):
         """Delete a child node."""
@@ -462,20 +1634,51 @@ class DataNode(Node):
     Inherits Node.
     """
 
-    @property
-    def flags(self):
-        return super().flags
+    __slots__ = ()
+
+    # flags, next data, data
+    _DATA = 2
 
     @property
     def next_data_addr(self):
-        return super().first_addr
+        return self.first_addr
+
+    @next_data_addr.setter
+    def next_data_addr(self, value):
+        self.first_addr = value
+
+    @property
+    def blocks(self):
+        """Number of 32 byte blocks of data in use."""
+        return self.flags & DATA_NODE_BLOCKS
+
+    @blocks.setter
+    def blocks(self, value):
+        flags = (self.flags & ~DATA_NODE_BLOCKS) | value
+        self._ADDR.pack_into(self._view, 0, flags)
+        self._fields = None
+        self._touch(0, 2)
 
     @property
     def data(self):
-        return self.raw[4:132].tobytes()
+        return self._field(self._DATA)
+
+    @data.setter
+    def data(self, value):
+        if len(value) > DATA_NODE_SIZE:
+            raise RuntimeError('Data nodes hold {} bytes.'.format(DATA_NODE_SIZE))
+        value = bytes(value).ljust(DATA_NODE_SIZE, b'\0')
+        old = self.data
+        changed = [i for i in range(DATA_NODE_SIZE) if old[i] != value[i]]
+        if not changed:
+            return
+        self._view[4:4+DATA_NODE_SIZE] = value
+        self._fields = None
+        # Only the chunks holding changed bytes need writing
+        self._touch(4 + changed[0], 5 + changed[-1])
 
     def write(self):
-        return self._parent._parent._write_node(self.addr, self.raw)
+        return self._write(self._parent._parent)
 
     def delete(self):
         """Delete this data node."""
@@ -489,6 +1692,100 @@ class DataNode(Node):
         self.write()
 
 
+class NodeSnapshot(_NodeIndex):
+    """Every login & data node read in one pass, with indexes.
+
+    Returned by MooltipassClient.snapshot(). The nodes are the usual
+    ParentNode, ChildNode & DataNode objects and can be modified or
+    deleted, but the snapshot is not updated when they are.
+
+    Attributes:
+        nodes -- dictionary of node address to node.
+    """
+
+    def __init__(self, mooltipass):
+        parents = {}
+        children = {}
+        for node_type in NODE_TYPES:
+            parents[node_type] = list(mooltipass.parent_nodes(node_type))
+            for pnode in parents[node_type]:
+                children[pnode.addr] = list(pnode.child_nodes())
+        self._index(parents, children)
+
+
+class _ReadAhead:
+    """Reads a chain of nodes on a worker thread.
+
+    The worker reads the next node as soon as the previous one gives its
+    address and queues up to depth nodes, so USB latency overlaps with
+    whatever the consumer does with each node. Errors, including
+    SystemExit and KeyboardInterrupt, are raised to the consumer when it
+    reaches them.
+
+    Arguments:
+        addr -- address of the first node (0 for none).
+        read -- function returning the node at an address.
+        next_addr -- function returning the address after a node.
+        depth -- number of nodes to queue.
+    """
+
+    _END = object()
+
+    def __init__(self, addr, read, next_addr, depth):
+        self._queue = queue.Queue(depth)
+        self._stop = threading.Event()
+        self._done = False
+        threading.Thread(target=self._run, daemon=True,
+                args=(self._queue, self._stop, addr, read, next_addr)).start()
+
+    @classmethod
+    def _run(cls, nodes, stop, addr, read, next_addr):
+        # Hold no reference to the _ReadAhead so an abandoned one is
+        # collected, stopping the worker.
+        def put(item):
+            while not stop.is_set():
+                try:
+                    nodes.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            while addr:
+                node = read(addr)
+                addr = next_addr(node)
+                if not put(node):
+                    return
+        except BaseException as e:
+            # Anything the worker dies of must reach the consumer, which
+            # would otherwise wait on the queue forever.
+            put(e)
+            return
+        put(cls._END)
+
+    def next(self):
+        """Return the next node; raise StopIteration after the last."""
+        if self._done:
+            raise StopIteration()
+        item = self._queue.get()
+        if item is self._END or isinstance(item, BaseException):
+            self._done = True
+            self._stop.set()
+            if item is self._END:
+                raise StopIteration()
+            raise item
+        return item
+
+    def close(self):
+        """Stop the worker."""
+        self._done = True
+        self._stop.set()
+
+    def __del__(self):
+        self._stop.set()
+
+
 class _ParentNodes:
     """Parent node iterator.
 
@@ -499,12 +1796,16 @@ class _ParentNodes:
     current_node = None
     next_parent_addr = None
 
-    def __init__(self, node_type=None, parent=None):
+    def __init__(self, node_type=None, parent=None, read_ahead=None):
         """Instantiate a parent node iterator.
 
         Arguments:
             node_type = [login|data]
             parent = Reference to parent object (i.e. Mooltipass)
+
+        Keyword argument:
+            read_ahead -- nodes to read ahead on a worker thread
+                    (default parent.read_ahead).
         """
         # TODO: Allow None and iterate all nodes starting at 0; identify by flags.
         if not node_type in ['login','data']:
@@ -516,15 +1817,24 @@ class _ParentNodes:
             self.next_parent_addr = self._parent.get_starting_parent_address()
         else:
             self.next_parent_addr = self._parent.get_starting_data_parent_address()
+        if read_ahead is None:
+            read_ahead = self._parent.read_ahead
+        self._read_ahead = None
+        if read_ahead > 0:
+            self._read_ahead = _ReadAhead(self.next_parent_addr,
+                    self._parent.read_node,
+                    lambda node: node.next_parent_addr, read_ahead)
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        if self.next_parent_addr == 0:
+        if self._read_ahead is not None:
+            self.current_node = self._read_ahead.next()
+        elif self.next_parent_addr == 0:
             raise StopIteration()
-
-        self.current_node = self._parent.read_node(self.next_parent_addr)
+        else:
+            self.current_node = self._parent.read_node(self.next_parent_addr)
         self.next_parent_addr = self.current_node.next_parent_addr
         return self.current_node
 
@@ -544,28 +1854,41 @@ class _ChildNodes:
     current_node = None
     next_addr = None
 
-    def __init__(self, parent):
+    def __init__(self, parent, read_ahead=None):
         self._parent_ref = weakref.ref(parent)
         self._parent = self._parent_ref()
         self.next_addr = self._parent.next_child_addr
 
-    def __iter__(self):
-        return self
-
-    def __next__(self):
-        if self.next_addr == 0:
-            raise StopIteration()
+        # Child nodes store the next address in .next_child_addr while data
+        # nodes use .next_data_addr
+        if self._parent.flags & 0xC000 == PARENT_DATA:
+            self._next_addr = lambda node: node.next_data_addr
+        else:
+            self._next_addr = lambda node: node.next_child_addr
 
         # The Mooltipass node structure goes Mooltipass.ParentNode.ChildNode
         # and ._parent points up one level up therefore:
         # self._parent._parent.read_node() == \
         #       _ChildNodes.ParentNode.Mooltipass.read_node()
-        self.current_node = self._parent._parent.read_node(self.next_addr, self._parent)
+        mooltipass = self._parent._parent
+        if read_ahead is None:
+            read_ahead = mooltipass.read_ahead
+        self._read_ahead = None
+        if read_ahead > 0:
+            pnode = self._parent
+            self._read_ahead = _ReadAhead(self.next_addr,
+                    lambda addr: mooltipass.read_node(addr, pnode),
+                    self._next_addr, read_ahead)
 
-        # Child nodes store the next address in .next_child_addr while data
-        # nodes use .next_data_addr
-        if self._parent.flags & 0xC000 == PARENT_NODE:
-            self.next_addr = self.current_node.next_child_addr
-        elif self._parent.flags & 0xC000 == PARENT_DATA:
-            self.next_addr = self.current_node.next_data_addr
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._read_ahead is not None:
+            self.current_node = self._read_ahead.next()
+        elif self.next_addr == 0:
+            raise StopIteration()
+        else:
+            self.current_node = self._parent._parent.read_node(self.next_addr, self._parent)
+        self.next_addr = self._next_addr(self.current_node)
         return self.current_node
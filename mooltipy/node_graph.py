@@ -0,0 +1,207 @@
+# This file is part of Mooltipy.
+#
+# Mooltipy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Mooltipy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Mooltipy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Node metadata kept on disk between runs.
+
+A NodeGraph holds what listing and lookups need from the node graph
+(addresses, flags, service names, logins and dates, never passwords or
+data) and is saved under the cache directory by MooltipassClient, one
+file per card, named after a hash of the card's CPZ. It is brought up
+to date from the device's fingerprint: the card's CTR value, which
+moves whenever a password is written, the two starting parent addresses
+and the first free node slots, which move whenever nodes are added or
+deleted.
+
+The cache directory is $MOOLTIPY_CACHE, or mooltipy under
+$XDG_CACHE_HOME (default ~/.cache). Service names and logins are saved
+in plain text, readable by the current user only; set
+$MOOLTIPY_NO_CACHE to keep nothing on disk.
+"""
+
+from collections import namedtuple
+
+import hashlib
+import json
+import logging
+import os
+
+ParentInfo = namedtuple('ParentInfo',
+        'addr, flags, prev_parent_addr, next_parent_addr, next_child_addr, service_name')
+ChildInfo = namedtuple('ChildInfo',
+        'addr, flags, prev_child_addr, next_child_addr, description, '
+        'date_created, date_last_used, login')
+DataInfo = namedtuple('DataInfo', 'addr, flags, next_data_addr')
+
+NODE_TYPES = ['login', 'data']
+
+
+def default_cache_dir():
+    """Return the cache directory from MOOLTIPY_CACHE or XDG default."""
+    path = os.environ.get('MOOLTIPY_CACHE')
+    if path:
+        return path
+    cache_home = os.environ.get('XDG_CACHE_HOME') or \
+            os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'mooltipy')
+
+
+def cache_enabled():
+    """Return False if MOOLTIPY_NO_CACHE is set."""
+    return not os.environ.get('MOOLTIPY_NO_CACHE')
+
+
+def cache_path(identity, cache_dir=None):
+    """Return the cache file for a device identity string."""
+    digest = hashlib.sha1(identity.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cache_dir or default_cache_dir(), 'graph-{}.json'.format(digest))
+
+
+def parent_info(pnode):
+    """Return the ParentInfo of a parent node (or ParentInfo)."""
+    return ParentInfo(pnode.addr, pnode.flags, pnode.prev_parent_addr,
+            pnode.next_parent_addr, pnode.next_child_addr, pnode.service_name)
+
+
+def child_info(node_type, cnode):
+    """Return the ChildInfo or DataInfo of a node of node_type."""
+    if node_type == 'login':
+        return ChildInfo(cnode.addr, cnode.flags, cnode.prev_child_addr,
+                cnode.next_child_addr, cnode.description, cnode.date_created,
+                cnode.date_last_used, cnode.login)
+    return DataInfo(cnode.addr, cnode.flags, cnode.next_data_addr)
+
+
+class _NodeIndex:
+    """Lookups shared by NodeSnapshot and NodeGraph.
+
+    Subclasses pass parents ({node_type: [parent, ...]}) and children
+    ({parent addr: [child, ...]}) to _index().
+
+    Attributes:
+        nodes -- dictionary of node address to node.
+    """
+
+    def _index(self, parents, children):
+        self._parents = parents
+        self._children = children
+        self.nodes = {}
+        self._by_service = {}
+        self._by_login = {}
+        for node_type in NODE_TYPES:
+            self._by_service[node_type] = {}
+            for pnode in parents[node_type]:
+                self._by_service[node_type][pnode.service_name] = pnode
+                self.nodes[pnode.addr] = pnode
+                for cnode in children[pnode.addr]:
+                    self.nodes[cnode.addr] = cnode
+                    if node_type == 'login':
+                        self._by_login[(pnode.service_name, cnode.login)] = cnode
+
+    def parent_nodes(self, node_type):
+        """Return the list of parent nodes of node_type, in order.
+
+        Arguments:
+            node_type = [login|data]
+        """
+        return self._parents[node_type]
+
+    def child_nodes(self, pnode):
+        """Return the list of child or data nodes of pnode, in order."""
+        return self._children[pnode.addr]
+
+    def parent(self, service_name, node_type='login'):
+        """Return the parent node named service_name or None."""
+        return self._by_service[node_type].get(service_name)
+
+    def child(self, service_name, login):
+        """Return the child node for a login of a context or None."""
+        return self._by_login.get((service_name, login))
+
+    def data_nodes(self, context):
+        """Return the list of data nodes of a data context.
+
+        Raises KeyError if the context does not exist.
+        """
+        return self._children[self._by_service['data'][context].addr]
+
+    def logins(self):
+        """Return a list of (parent, child) node tuples, in order."""
+        return [(pnode, cnode)
+                for pnode in self._parents['login']
+                for cnode in self._children[pnode.addr]]
+
+
+class NodeGraph(_NodeIndex):
+    """Metadata of every login & data node, without the nodes.
+
+    Offers the lookups of NodeSnapshot, returning ParentInfo, ChildInfo
+    and DataInfo tuples instead of nodes.
+
+    Attributes:
+        fingerprint -- device state the graph was read in.
+    """
+
+    def __init__(self, parents, children, fingerprint=None):
+        self.fingerprint = fingerprint
+        self._index(parents, children)
+
+    @classmethod
+    def from_snapshot(cls, snapshot, fingerprint=None):
+        """Return the metadata of a NodeSnapshot."""
+        parents = {}
+        children = {}
+        for node_type in NODE_TYPES:
+            parents[node_type] = []
+            for pnode in snapshot.parent_nodes(node_type):
+                parents[node_type].append(parent_info(pnode))
+                children[pnode.addr] = [child_info(node_type, cnode)
+                                        for cnode in snapshot.child_nodes(pnode)]
+        return cls(parents, children, fingerprint)
+
+    @classmethod
+    def load(cls, path):
+        """Load a graph saved by save(); return None if unreadable."""
+        try:
+            with open(path, 'r') as fin:
+                state = json.load(fin)
+            parents = {
+                'login': [ParentInfo(*p) for p in state['parents']['login']],
+                'data': [ParentInfo(*p) for p in state['parents']['data']],
+            }
+            children = {}
+            for pnode in parents['login']:
+                children[pnode.addr] = [ChildInfo(*c)
+                                        for c in state['children'][str(pnode.addr)]]
+            for pnode in parents['data']:
+                children[pnode.addr] = [DataInfo(*c)
+                                        for c in state['children'][str(pnode.addr)]]
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.debug('Ignoring node graph cache {}: {}'.format(path, e))
+            return None
+        return cls(parents, children, state.get('fingerprint'))
+
+    def save(self, path):
+        """Save the graph to path, readable by the current user only."""
+        state = {
+            'fingerprint': self.fingerprint,
+            'parents': self._parents,
+            'children': {str(addr): cnodes for addr, cnodes in self._children.items()},
+        }
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        tmp_path = path + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as fout:
+            json.dump(state, fout)
+        os.replace(tmp_path, path)
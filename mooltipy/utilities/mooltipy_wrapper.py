@@ -24,12 +24,14 @@ from mooltipy.utilities import mpdata
 from mooltipy.utilities import mplogin
 from mooltipy.utilities import mpfavorites
 from mooltipy.utilities import mpparams
+from mooltipy.utilities import mpdaemon
 
 utilities = {
     'data': mpdata,
     'login': mplogin,
     'favorites': mpfavorites,
     'parameters': mpparams,
+    'daemon': mpdaemon,
 }
 
 def main_options():
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+#
+# This file is part of Mooltipy.
+#
+# Mooltipy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Mooltipy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Mooltipy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Hold the Mooltipass open for faster successive commands."""
+
+import argparse
+import logging
+import os
+import signal
+import sys
+
+from mooltipy.daemon import MooltipassDaemon, DEFAULT_IDLE_TIMEOUT
+
+
+def main_options():
+    """Handles command-line interface, arguments & options."""
+
+    # If the wrapper was used to execute our utility instead of directly
+    util = ''
+    if os.path.split(sys.argv[0])[1] in ['./mooltipy.py', 'mooltipy']:
+        # Get the utility name contained in argv[1]
+        util = sys.argv[1]
+        del sys.argv[1]
+
+    # Create a string to represent the utility in help messages
+    cmd_util = (' '.join([os.path.split(sys.argv[0])[1], util])).strip()
+
+    description = 'Keep the Mooltipass connected and serve the other ' \
+            'utilities over a Unix socket until interrupted with ctrl-c.\n\n' \
+            'Examples:\n' \
+            '\t# Start the daemon in the background\n' \
+            '\t$ {cmd_util} &\n\n' \
+            '\t# Utilities now reuse the connection and an accepted\n' \
+            '\t# memory management session\n' \
+            '\t$ mplogin list\n' \
+            '\t$ mpdata list'
+
+    parser = argparse.ArgumentParser(
+            description = description.format(cmd_util = cmd_util),
+            formatter_class = argparse.RawDescriptionHelpFormatter,
+            prog = cmd_util)
+    parser.add_argument('-s', '--socket',
+            help = 'socket path; defaults to $MOOLTIPY_SOCKET or ' \
+                   'mooltipy-<uid>.sock in $XDG_RUNTIME_DIR',
+            default = None,
+            action = 'store')
+    parser.add_argument('-t', '--idle-timeout',
+            help = 'seconds without a client before leaving memory ' \
+                   'management mode (default {})'.format(DEFAULT_IDLE_TIMEOUT),
+            dest = 'idle_timeout',
+            type = int,
+            default = DEFAULT_IDLE_TIMEOUT,
+            action = 'store')
+
+    return parser.parse_args()
+
+def main():
+
+    logging.basicConfig(
+            format='%(message)s',
+            level=logging.INFO)
+
+    args = main_options()
+
+    # Clean up the socket & memory management session when terminated
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        daemon = MooltipassDaemon(args.socket, idle_timeout=args.idle_timeout)
+        daemon.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        print('')
+    except Exception as e:
+        print('An error occurred: \n{}'.format(e))
+        sys.exit(1)
+
+if __name__ == '__main__':
+
+    main()
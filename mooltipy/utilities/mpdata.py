@@ -18,13 +18,17 @@
 """Import & export small files to and from the Mooltipass."""
 
 import argparse
-from array import array
+import contextlib
 import logging
 import os
+import shutil
+import stat
+import tempfile
 import time
 import sys
 
-from mooltipy.mooltipass_client import MooltipassClient
+from mooltipy.mooltipass_client import MooltipassClient, BUNDLE_CHUNK_SIZE
+from mooltipy.mooltipass_client import bundle_chunk_name, data_digest
 
 
 def main_options():
@@ -42,7 +46,7 @@ def main_options():
 
     description = 'Manages mooltipass data contexts.'.format(
             cmd_util = cmd_util)
-    usage = '{cmd_util} [-h] ... {{get,set,del,list}} context'.format(
+    usage = '{cmd_util} [-h] ... {{get,set,del,list,export-all,bundle}} context'.format(
             cmd_util = cmd_util)
 
     # main
@@ -64,7 +68,9 @@ def main_options():
             help = 'retrieve data for a given context',
             description = description,
             prog = cmd_util+' get')
-    get_parser.add_argument('context', help='specify context')
+    get_parser.add_argument('context',
+            help = 'specify context, or bundle:path for a file in a bundle '
+                    '(bundle: lists the files)')
     get_parser.add_argument('filepath',
             nargs = '?',
             default = None,
@@ -94,16 +100,38 @@ def main_options():
             nargs = '?',
             default = None,
             help = 'file from which data should be read')
+    set_parser.add_argument('-s', '--size',
+            type = int,
+            default = None,
+            help = 'number of bytes to read from stdin; lets a pipe be '
+                    'uploaded as it is read instead of first being copied '
+                    'to a temporary file')
+    set_parser.add_argument('-z', '--compress',
+            default = None,
+            choices = ['auto', 'zlib', 'lzma', 'none'],
+            help = 'compress the data before uploading it, which older '
+                    'versions can not read; auto uses whichever method '
+                    'makes it smallest, if any (default none)')
+    set_parser.add_argument('-u', '--update',
+            action = 'store_true',
+            help = 'replace the data of an existing context in memory '
+                    'management mode, writing only the data nodes which '
+                    'changed')
+    set_parser.add_argument('-c', '--if-changed',
+            action = 'store_true',
+            help = 'store a digest with the data; if the context exists, '
+                    'upload nothing when the digest matches and otherwise '
+                    'rewrite the data nodes which changed (see --update)')
 
     # delete
     # ------
-    description = 'Delete a mooltipass data context.'
+    description = 'Delete one or more mooltipass data contexts.'
     del_parser = subparsers.add_parser(
             'del',
             help = 'delete a context',
             description = description,
             prog = cmd_util+' del')
-    del_parser.add_argument("context", help='specify context')
+    del_parser.add_argument("context", nargs='+', help='specify contexts')
 
     # list
     # ----
@@ -113,6 +141,48 @@ def main_options():
             help = 'list login contexts',
             description = description,
             prog = cmd_util + ' list')
+    list_parser.add_argument('--no-cache',
+            action = 'store_true',
+            help = 'read every node and keep no list of names on disk '
+                    '(also set by MOOLTIPY_NO_CACHE)')
+
+    # export-all
+    # ----------
+    description = 'Back up data contexts into a directory, one file per ' \
+            'context, reading whole data nodes in memory management mode ' \
+            'rather than 32 bytes at a time.'
+    export_parser = subparsers.add_parser(
+            'export-all',
+            help = 'back up data contexts to a directory',
+            description = description,
+            prog = cmd_util + ' export-all')
+    export_parser.add_argument('directory', help='directory to write files to')
+    export_parser.add_argument('context', nargs='*',
+            help='contexts to export; default all')
+
+    # bundle
+    # ------
+    description = 'Store files, or directories of them, in a bundle: a ' \
+            'manifest context named after the bundle and chunk contexts ' \
+            'holding the files, so "get bundle:path" reads only the chunks ' \
+            'of one file. Each context must be confirmed on the device.'
+    bundle_parser = subparsers.add_parser(
+            'bundle',
+            help = 'store files in a bundle of data contexts',
+            description = description,
+            prog = cmd_util + ' bundle')
+    bundle_parser.add_argument('context', help='name of the bundle')
+    bundle_parser.add_argument('paths', nargs='+', metavar='path',
+            help='files and directories to store')
+    bundle_parser.add_argument('-c', '--chunk-size',
+            type = int,
+            default = BUNDLE_CHUNK_SIZE,
+            help = 'bytes stored in each chunk context (default {})'.format(
+                    BUNDLE_CHUNK_SIZE))
+    bundle_parser.add_argument('-z', '--compress',
+            default = 'auto',
+            choices = ['auto', 'zlib', 'lzma', 'none'],
+            help = 'compress each chunk; see set')
 
     if not len(sys.argv) > 1:
         parser.print_help()
@@ -125,18 +195,65 @@ def main_options():
 
 def get_context(mooltipass, args):
     """Retrieve data from a data context."""
-    if not mooltipass.set_data_context(args.context):
+    # A name too long for a context may still name a file in a bundle
+    if len(args.context) > 57 or not mooltipass.set_data_context(args.context):
+        if ':' in args.context:
+            get_bundle_file(mooltipass, args)
+            return
         raise RuntimeError('Context does not exist; cannot get context.')
 
     if args.filepath is None:
-        data = mooltipass.read_data_context()
-        for c in data:
-            sys.stdout.write(chr(c))
-        sys.stdout.flush()
+        mooltipass.read_data_stream(sys.stdout.buffer)
+        sys.stdout.buffer.flush()
     else:
-        data = mooltipass.read_data_context(callback)
         with open(args.filepath, 'wb') as fout:
-            data.tofile(fout)
+            mooltipass.read_data_stream(fout, callback)
+
+def get_bundle_file(mooltipass, args):
+    """Retrieve a file from a bundle, or list the files if none given."""
+    bundle, _, path = args.context.partition(':')
+    manifest = mooltipass.read_bundle_manifest(bundle)
+    if not path:
+        for path, (offset, length) in manifest['files'].items():
+            print('{:<60}{:>10}'.format(path, length))
+        return
+
+    if args.filepath is None:
+        mooltipass.read_bundle_file(bundle, path, sys.stdout.buffer, manifest)
+        sys.stdout.buffer.flush()
+    else:
+        with open(args.filepath, 'wb') as fout:
+            mooltipass.read_bundle_file(bundle, path, fout, manifest)
+
+def bundle_files(paths):
+    """Yield (path, source, length) for files and directories in paths.
+
+    Files in a directory are named by their path from its parent.
+    """
+    def read_file(filepath):
+        # Opened only when the bundle reaches it
+        with open(filepath, 'rb') as fin:
+            yield from iter(lambda: fin.read(1 << 16), b'')
+
+    for path in paths:
+        if not os.path.isdir(path):
+            yield os.path.basename(path), read_file(path), os.path.getsize(path)
+            continue
+        top = os.path.dirname(os.path.normpath(path))
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                filepath = os.path.join(dirpath, filename)
+                name = os.path.relpath(filepath, top).replace(os.sep, '/')
+                yield name, read_file(filepath), os.path.getsize(filepath)
+
+def bundle_context(mooltipass, args):
+    """Store files in a bundle of data contexts."""
+    compression = None if args.compress == 'none' else args.compress
+    manifest = mooltipass.write_bundle(args.context, bundle_files(args.paths),
+            args.chunk_size, callback, compression)
+    print('\n{} files, {} bytes in {} chunks'.format(
+            len(manifest['files']), manifest['size'], len(manifest['chunks'])))
 
 def callback(progress):
     """Report progress of file transfer."""
@@ -152,29 +269,100 @@ def callback(progress):
 
 def set_context(mooltipass, args):
     """Create and import data to a data context."""
-    while not mooltipass.set_data_context(args.context):
-        if not mooltipass.add_data_context(args.context):
-            raise RuntimeError('Request to add context denied or timed out.')
+    if args.update:
+        update_context(mooltipass, args)
+        return
+
+    compression = None if args.compress in (None, 'none') else args.compress
+    with contextlib.ExitStack() as stack:
+        fin, size = open_source(args, stack)
+        if args.if_changed and mooltipass.set_data_context(args.context):
+            # A context can only be written once, so rewrite the nodes
+            # of one which changed
+            data = fin.read(size)
+            if len(data) < size:
+                raise RuntimeError('Data ended after {} of {} bytes.'.format(len(data), size))
+            update_context(mooltipass, args, data)
+            return
+
+        while not mooltipass.set_data_context(args.context):
+            if not mooltipass.add_data_context(args.context):
+                raise RuntimeError('Request to add context denied or timed out.')
+        mooltipass.write_data_stream(fin, size, callback, compression, args.if_changed)
+
+def open_source(args, stack):
+    """Return (file, size) for the data to set, opened on stack."""
+    if args.filepath is not None:
+        fin = stack.enter_context(open(args.filepath, 'rb'))
+        return fin, os.fstat(fin.fileno()).st_size
+
+    fin = sys.stdin.buffer
+    if args.size is not None and not args.if_changed:
+        return fin, args.size
+    if stat.S_ISREG(os.fstat(fin.fileno()).st_mode):
+        return fin, os.fstat(fin.fileno()).st_size - fin.tell()
+    # The size goes first and a digest needs the data read twice, so
+    # spool a pipe
+    spool = stack.enter_context(tempfile.TemporaryFile())
+    shutil.copyfileobj(fin, spool)
+    size = spool.tell() if args.size is None else args.size
+    spool.seek(0)
+    return spool, size
+
+def unchanged(mooltipass, context, digest):
+    """Return True, saying so, if context holds data with digest."""
+    if not mooltipass.set_data_context(context):
+        return False
+    if mooltipass.read_data_digest() != digest:
+        return False
+    print('{} is unchanged; nothing written.'.format(context))
+    return True
+
+def update_context(mooltipass, args, data=None):
+    """Rewrite the changed data nodes of an existing data context.
+
+    The data is read from the file or stdin unless given.
+    """
+    if not mooltipass.set_data_context(args.context):
+        raise RuntimeError('Context does not exist; cannot update context.')
 
-    if args.filepath is None:
-        data = array('B', sys.stdin.read())
-    else:
+    compression = None if args.compress in (None, 'none') else args.compress
+    if data is None and args.filepath is None:
+        data = sys.stdin.buffer.read()
+    elif data is None:
         with open(args.filepath, 'rb') as fin:
-            data = array('B',fin.read())
+            data = fin.read()
+    if args.if_changed and \
+            unchanged(mooltipass, args.context, data_digest([data], len(data))):
+        return
 
-    mooltipass.write_data_context(data, callback)
+    mooltipass.start_memory_management()
+    written = mooltipass.update_data_context(args.context, data, compression,
+            args.if_changed)
+    print('{} data nodes written'.format(written))
+    if args.skip_mgmt_exit == False:
+        mooltipass.end_memory_management()
 
 def del_context(mooltipass, args):
-    """Delete a data context."""
-
-    if not mooltipass.set_data_context(args.context):
-        raise RuntimeError('That context ({}) does not exist.'.format(args.context))
+    """Delete data contexts."""
+
+    contexts = []
+    for context in args.context:
+        if not mooltipass.set_data_context(context):
+            raise RuntimeError('That context ({}) does not exist.'.format(context))
+        contexts.append(context)
+        # Take the chunks of a bundle with it
+        if mooltipass.set_data_context(bundle_chunk_name(context, 0)):
+            try:
+                contexts.extend(mooltipass.read_bundle_manifest(context)['chunks'])
+            except RuntimeError:
+                pass
 
     mooltipass.start_memory_management()
 
-    for pnode in mooltipass.parent_nodes('data'):
-        if pnode.service_name == args.context:
-            pnode.delete()
+    snapshot = mooltipass.snapshot()
+    nodes = [snapshot.parent(context, 'data') for context in contexts]
+    mooltipass.delete_nodes(node for node in nodes if node is not None)
 
     if args.skip_mgmt_exit == False:
         mooltipass.end_memory_management()
@@ -184,16 +372,40 @@ def list_context(mooltipass, args):
     mooltipass.start_memory_management()
     s = '{:<40}{:<40}\n'.format('Context:','Approximate Size:')
     s += '{:<40}{:<40}\n'.format('--------','----------------')
-    for pnode in mooltipass.parent_nodes('data'):
-        service_name = pnode.service_name
-        c = 0
-        for cnode in pnode.child_nodes():
-            c += 1
-        s += '{:<40}{:<40}\n'.format(service_name, c*128)
+    graph = mooltipass.node_graph(False if args.no_cache else None)
+    for pnode in graph.parent_nodes('data'):
+        c = len(graph.child_nodes(pnode))
+        s += '{:<40}{:<40}\n'.format(pnode.service_name, c*128)
     print(s)
     if args.skip_mgmt_exit == False:
         mooltipass.end_memory_management()
 
+def export_filename(context):
+    """Return a file name for context which stays in the directory.
+
+    Path separators become '_' and names of directories, such as '..',
+    are prefixed with '_'.
+    """
+    filename = context
+    for sep in (os.sep, os.altsep):
+        if sep:
+            filename = filename.replace(sep, '_')
+    if filename in ('', os.curdir, os.pardir):
+        filename = '_' + filename
+    return filename
+
+def export_all(mooltipass, args):
+    """Write data contexts to files named after them in a directory."""
+    os.makedirs(args.directory, exist_ok=True)
+    mooltipass.start_memory_management()
+    for context, data in mooltipass.export_data_contexts(args.context or None):
+        filename = export_filename(context)
+        with open(os.path.join(args.directory, filename), 'wb') as fout:
+            data.tofile(fout)
+        print('{:<40}{:>10} bytes'.format(context, len(data)))
+    if args.skip_mgmt_exit == False:
+        mooltipass.end_memory_management()
+
 def main():
 
     logging.basicConfig(
@@ -206,7 +418,9 @@ def main():
         'get':get_context,
         'set':set_context,
         'del':del_context,
-        'list':list_context
+        'list':list_context,
+        'export-all':export_all,
+        'bundle':bundle_context
     }
 
     args = main_options()
@@ -229,7 +443,10 @@ def main():
         command_handlers[args.command](mooltipass, args)
         sys.exit(0)
     except (KeyboardInterrupt, SystemExit):
-        print('')
+        # End the progress bar line, but never add to data written
+        # to stdout
+        if args.command != 'get' or args.filepath is not None:
+            print('')
     except Exception as e:
         print('\nAn error occurred: \n{}'.format(e))
     finally:
@@ -27,16 +27,20 @@ from mooltipy.mooltipass_client import MooltipassClient
 
 def list_favorites(mooltipass, args):
     favorites = []
-    for slot in range(0, 14):
-        fav_slot_info = mooltipass.get_favorite(slot)
+    for slot, fav_slot_info in enumerate(mooltipass.get_favorites(range(0, 14))):
         if fav_slot_info[0] != 0:
             favorites.append((slot, fav_slot_info))
     if not len(favorites):
         print("No favorites configured!")
     else:
+        # Read every parent & child node in a single batch
+        addrs = []
         for favorite in favorites:
-            context_info = mooltipass.read_node(favorite[1][0])
-            child_info = mooltipass.read_node(favorite[1][1])
+            addrs.extend(favorite[1])
+        nodes = mooltipass.read_nodes(addrs)
+        for i, favorite in enumerate(favorites):
+            context_info = nodes[2*i]
+            child_info = nodes[2*i+1]
             print("Favorite Slot {} - {}:{}".format(favorite[0],
                                                     context_info.service_name,
                                                     child_info.login))
@@ -55,10 +59,7 @@ def get_favorite(mooltipass, args):
 
 def set_favorite(mooltipass, args):
     """Sets a context into a favorite slot"""
-    ctx_favorite_list = []
-    for pnode in mooltipass.parent_nodes('login'):
-        for cnode in pnode.child_nodes():
-            ctx_favorite_list.append((pnode, cnode))
+    ctx_favorite_list = mooltipass.snapshot().logins()
 
     for index, ctx in enumerate(ctx_favorite_list):
         print('{} - {}:{}'.format(index, ctx[0].service_name, ctx[1].login))
@@ -18,14 +18,23 @@
 """Manage contexts containing usernames & passwords."""
 
 import argparse
+import contextlib
+import csv
 import fnmatch
 import getpass
+import json
 import logging
 import os
 import sys
 import time
 
-from mooltipy.mooltipass_client import MooltipassClient
+from mooltipy.mooltipass_client import MooltipassClient, decode_date
+
+EXPORT_FIELDS = ['context', 'login', 'description', 'date_created',
+                 'date_last_used', 'parent_addr', 'child_addr']
+
+# Nodes read ahead while earlier ones are being written out
+EXPORT_READ_AHEAD = 4
 
 def main_options():
     """Handles command-line interface, arguments & options. """
@@ -42,7 +51,7 @@ def main_options():
 
     description = '{cmd_util} manages Mooltipass login contexts.'.format(
             cmd_util = cmd_util)
-    usage = '{cmd_util} [-h] ... {{get,set,del,list}} context'.format(
+    usage = '{cmd_util} [-h] ... {{get,set,del,list,import,export}} context'.format(
             cmd_util = cmd_util)
 
     # main
@@ -144,7 +153,7 @@ def main_options():
 
     # delete
     # ------
-    description = 'Delete a context or specific login from a context.'
+    description = 'Delete contexts or a specific login from contexts.'
     del_parser = subparsers.add_parser(
             'del',
             help='delete a context',
@@ -154,7 +163,8 @@ def main_options():
             help = 'optional username for the context',
             default = '',
             action = 'store')
-    del_parser.add_argument("context", help='specify context (e.g. tripod.com)')
+    del_parser.add_argument("context", nargs='+',
+            help='specify one or more contexts (e.g. tripod.com)')
 
     # list
     # ----
@@ -170,6 +180,52 @@ def main_options():
             default = '*',
             nargs = '?',
             help = 'supports shell-style wildcards; default is "*" showing all contexts.')
+    list_parser.add_argument('--no-cache',
+            action = 'store_true',
+            help = 'read every node and keep no list of names on disk '
+                    '(also set by MOOLTIPY_NO_CACHE)')
+
+    # import
+    # ------
+    description = 'Import many logins at once. The contexts and logins are ' \
+            'written straight to the node memory in one memory management ' \
+            'session, then the passwords are set one by one.\n\n' \
+            'A .csv file has a context,login,password row per login; a ' \
+            '.json file holds a list of {"context": ..., "login": ..., ' \
+            '"password": ...} objects. Logins without a password get a ' \
+            'random one.'
+    import_parser = subparsers.add_parser(
+            'import',
+            help = 'import logins from a .csv or .json file',
+            description = description,
+            prog = cmd_util+' import')
+    import_parser.add_argument("file", help='file to import (e.g. logins.csv)')
+    import_parser.set_defaults(length=31, charset=None)
+
+    # export
+    # ------
+    description = 'Write a record per login (no passwords) as soon as its ' \
+            'node is read, as JSON Lines or CSV.'
+    export_parser = subparsers.add_parser(
+            'export',
+            help = 'export login metadata',
+            description = description,
+            prog = cmd_util+' export')
+    export_parser.add_argument(
+            '-f', '--format',
+            help = 'output format (default jsonl)',
+            default = 'jsonl',
+            choices = ['jsonl', 'csv'])
+    export_parser.add_argument(
+            '-o', '--output',
+            help = 'file to write to (default stdout)',
+            default = None)
+    export_parser.add_argument(
+            'context',
+            action = 'store',
+            default = '*',
+            nargs = '?',
+            help = 'supports shell-style wildcards; default is "*" exporting all contexts.')
 
     if not len(sys.argv) > 1:
         parser.print_help()
@@ -214,10 +270,11 @@ def list_context(mooltipass, args):
 
     s = '{:<40}{:<40}\n'.format('Context:','Login(s):')
     s += '{:<40}{:<40}\n'.format('--------','---------')
-    for pnode in mooltipass.parent_nodes('login'):
+    graph = mooltipass.node_graph(False if args.no_cache else None)
+    for pnode in graph.parent_nodes('login'):
         if fnmatch.fnmatch(pnode.service_name, args.context):
             service_name = pnode.service_name
-            for cnode in pnode.child_nodes():
+            for cnode in graph.child_nodes(pnode):
                 s += '{:<40}{:<40}\n'.format(service_name, cnode.login)
                 service_name = ''
 
@@ -225,6 +282,49 @@ def list_context(mooltipass, args):
     if args.skip_mgmt_exit == False:
         mooltipass.end_memory_management()
 
+def export_records(mooltipass, pattern='*'):
+    """Yield a dict per login of contexts matching pattern, as read."""
+    for pnode in mooltipass.parent_nodes('login', read_ahead=EXPORT_READ_AHEAD):
+        if not fnmatch.fnmatch(pnode.service_name, pattern):
+            continue
+        for cnode in pnode.child_nodes(read_ahead=EXPORT_READ_AHEAD):
+            date_created = decode_date(cnode.date_created)
+            date_last_used = decode_date(cnode.date_last_used)
+            yield {
+                'context': pnode.service_name,
+                'login': cnode.login,
+                'description': cnode.description,
+                'date_created': date_created and date_created.isoformat(),
+                'date_last_used': date_last_used and date_last_used.isoformat(),
+                'parent_addr': pnode.addr,
+                'child_addr': cnode.addr,
+            }
+
+def export_context(mooltipass, args):
+    """Stream login metadata to stdout or a file."""
+    # Keep prompts out of the records when they go to stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        mooltipass.start_memory_management()
+
+    fout = open(args.output, 'w', newline='') if args.output else sys.stdout
+    try:
+        if args.format == 'csv':
+            writer = csv.DictWriter(fout, EXPORT_FIELDS)
+            writer.writeheader()
+            write = writer.writerow
+        else:
+            write = lambda record: fout.write(json.dumps(record) + '\n')
+        for record in export_records(mooltipass, args.context):
+            write(record)
+            fout.flush()
+    finally:
+        if fout is not sys.stdout:
+            fout.close()
+
+    if args.skip_mgmt_exit == False:
+        with contextlib.redirect_stdout(sys.stderr):
+            mooltipass.end_memory_management()
+
 def generate_random_password(args):
     """Generate and return a random password."""
     # TODO: Consider if passwords could stick around in memory after
@@ -283,25 +383,90 @@ def set_context(mooltipass, args):
         raise RuntimeError('Set password failed!')
 
 def del_context(mooltipass, args):
-    """Delete a context in its entirety."""
+    """Delete contexts in their entirety or a login from each."""
 
-    if not mooltipass.set_context(args.context):
-        raise RuntimeError('That context ({}) does not exist.'.format(args.context))
+    for context in args.context:
+        if not mooltipass.set_context(context):
+            raise RuntimeError('That context ({}) does not exist.'.format(context))
 
     mooltipass.start_memory_management()
 
-    for pnode in mooltipass.parent_nodes('login'):
-        if pnode.service_name == args.context:
-            if args.username:
-                for cnode in pnode.child_nodes():
-                    if cnode.login == args.username:
-                        cnode.delete()
-            else:
-                pnode.delete()
+    snapshot = mooltipass.snapshot()
+    if args.username:
+        nodes = [snapshot.child(context, args.username) for context in args.context]
+    else:
+        nodes = [snapshot.parent(context) for context in args.context]
+    mooltipass.delete_nodes(node for node in nodes if node is not None)
 
     if args.skip_mgmt_exit == False:
         mooltipass.end_memory_management()
 
+def read_import_file(path):
+    """Return a list of (context, login, password) tuples from a file.
+
+    CSV files start with a header naming the context and login columns
+    and optionally a password column; any others, e.g. those of an
+    exported file, are ignored. A missing password is returned as None.
+    """
+    with open(path, newline='') as fin:
+        if path.lower().endswith('.json'):
+            entries = json.load(fin)
+        else:
+            reader = csv.DictReader(fin)
+            if not {'context', 'login'} <= set(reader.fieldnames or []):
+                raise RuntimeError('{} must start with a context,login[,password] '
+                        'header.'.format(path))
+            entries = list(reader)
+    rows = [(entry['context'], entry.get('login') or '', entry.get('password') or None)
+            for entry in entries]
+    for context, login, password in rows:
+        if password is not None and len(password) > 31:
+            raise RuntimeError('Password for {}:{} must be <= 31 characters long!'.format(
+                    context, login))
+    return rows
+
+def import_contexts(mooltipass, args):
+    """Import logins, writing their nodes directly, then set passwords."""
+    rows = read_import_file(args.file)
+
+    mooltipass.start_memory_management()
+    created = mooltipass.import_logins((context, login) for context, login, _ in rows)
+    mooltipass.end_memory_management()
+    print('Created {} logins.'.format(len(created)))
+
+    # Logins which existed keep their password unless the file gives
+    # one; new logins without one get a random password.
+    created = set(created)
+    passwords = {}
+    for context, login, password in rows:
+        if password is not None:
+            passwords[(context, login)] = password
+        elif (context, login) in created and (context, login) not in passwords:
+            passwords[(context, login)] = generate_random_password(args)
+
+    # Passwords are encrypted by the card, so set them outside memory
+    # management mode, selecting each context once. Selecting the
+    # context and login go in one batch; set_password can not join it
+    # as it may ask for confirmation on the device and must only be sent
+    # once the right login is known to be selected.
+    context = None
+    count = 0
+    for (row_context, login), password in sorted(passwords.items()):
+        batch = mooltipass.batch()
+        if row_context != context:
+            context = row_context
+            batch.set_context(context)
+        batch.set_login(login)
+        results = batch.send(timeout=10000)
+        if len(results) == 2 and results[0] != 1:
+            raise RuntimeError('Context {} is missing.'.format(context))
+        if not results[-1]:
+            raise RuntimeError('Set username failed for {}:{}!'.format(context, login))
+        if not mooltipass.set_password(password):
+            raise RuntimeError('Set password failed for {}:{}!'.format(context, login))
+        count += 1
+    print('Set {} passwords.'.format(count))
+
 def main():
 
     logging.basicConfig(
@@ -313,7 +478,9 @@ def main():
         'get':get_context,
         'set':set_context,
         'del':del_context,
-        'list':list_context
+        'list':list_context,
+        'import':import_contexts,
+        'export':export_context
     }
 
     args = main_options()
@@ -340,7 +507,9 @@ def main():
     except Exception as e:
         print('An error occurred: \n{}'.format(e))
     finally:
-        print('')
+        # Never add to records exported to stdout
+        if args.command != 'export' or args.output:
+            print('')
 
 if __name__ == '__main__':
 
@@ -38,8 +38,9 @@ def set_param(mooltipass, args):
 def list_params(mooltipass, args):
     print("Parameter           : init : current")
     print("--------------------------------------")
-    for param_name, param in sorted(iter(mooltipass.valid_params.items())):
-        value = mooltipass.get_param(param.param)
+    params = sorted(iter(mooltipass.valid_params.items()))
+    values = mooltipass.get_params([param.param for _, param in params])
+    for (param_name, param), value in zip(params, values):
         print("{:<20}: {:<5}: {}".format(param_name, param.formatter(param.default_value), param.formatter(value)))
 
 def auto_int(x):
@@ -28,6 +28,7 @@ setup(
             'mplogin = mooltipy.utilities.mplogin:main',
             'mpfavorites = mooltipy.utilities.mpfavorites:main',
             'mpparams = mooltipy.utilities.mpparams:main',
+            'mpdaemon = mooltipy.utilities.mpdaemon:main',
         ],
     }
 )
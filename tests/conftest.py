@@ -0,0 +1,66 @@
+"""Fixtures running mooltipy against MooltipassEmulator."""
+
+import pytest
+
+from mooltipy import MooltipassClient, MooltipassEmulator
+from mooltipy.constants import CMD_READ_FLASH_NODE
+
+
+@pytest.fixture(autouse=True)
+def environment(monkeypatch, tmp_path):
+    """Keep tests away from any device, daemon or cache of the user."""
+    monkeypatch.setenv('MOOLTIPY_SOCKET', str(tmp_path / 'no-daemon.sock'))
+    monkeypatch.setenv('MOOLTIPY_CACHE', str(tmp_path / 'cache'))
+    monkeypatch.delenv('MOOLTIPY_EMULATOR', raising=False)
+    monkeypatch.delenv('MOOLTIPY_NO_CACHE', raising=False)
+
+
+@pytest.fixture
+def emulator():
+    return MooltipassEmulator(page_count=64)
+
+
+@pytest.fixture
+def mooltipass(emulator):
+    return MooltipassClient(emulator)
+
+
+@pytest.fixture
+def add_logins(mooltipass):
+    """Return a function adding {context: [login, ...]} the usual way.
+
+    Passwords are only set if given, as checking one takes a while.
+    """
+    def add_logins(logins, password=None):
+        for context, names in logins.items():
+            if not mooltipass.set_context(context):
+                assert mooltipass.add_context(context)
+                assert mooltipass.set_context(context)
+            for login in names:
+                assert mooltipass.set_login(login)
+                if password is not None:
+                    assert mooltipass.set_password(password)
+    return add_logins
+
+
+@pytest.fixture
+def add_data(mooltipass):
+    """Return a function adding a data context holding data."""
+    def add_data(context, data, **kwargs):
+        assert mooltipass.add_data_context(context)
+        assert mooltipass.set_data_context(context)
+        assert mooltipass.write_data_context(data, **kwargs)
+    return add_data
+
+
+@pytest.fixture
+def node_reads(emulator):
+    """Count the nodes read from the emulator; reset with [0] = 0."""
+    count = [0]
+    read_node = emulator._handlers[CMD_READ_FLASH_NODE]
+
+    def counting(cmd, *args):
+        count[0] += 1
+        return read_node(cmd, *args)
+    emulator._handlers[CMD_READ_FLASH_NODE] = counting
+    return count
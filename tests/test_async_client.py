@@ -0,0 +1,78 @@
+import asyncio
+
+import pytest
+
+from mooltipy import AsyncMooltipassClient
+from mooltipy.mooltipass_client import data_digest
+
+
+TEXT = b'The quick brown fox jumps over the lazy dog. ' * 100
+
+
+def run(emulator, coroutine):
+    async def main():
+        async with AsyncMooltipassClient(emulator, use_daemon=False) as mooltipass:
+            return await coroutine(mooltipass)
+    return asyncio.run(main())
+
+
+def test_version(emulator):
+    async def version(mooltipass):
+        return mooltipass.flash_size, mooltipass.version
+    assert run(emulator, version) == (4, 'v1.2')
+
+
+def test_logins(emulator):
+    async def logins(mooltipass):
+        assert await mooltipass.add_context('a.com')
+        assert await mooltipass.set_context('a.com')
+        assert await mooltipass.set_login('ann')
+        assert await mooltipass.set_context('a.com')
+        return await mooltipass.get_login()
+    assert run(emulator, logins) == 'ann'
+
+
+def test_nodes(emulator, mooltipass, add_logins):
+    add_logins({'a.com': ['ann', 'bob'], 'b.com': ['cat']})
+
+    async def walk(mooltipass):
+        await mooltipass.start_memory_management()
+        logins = {}
+        async for pnode in mooltipass.parent_nodes('login'):
+            logins[pnode.service_name] = \
+                    [cnode.login async for cnode in mooltipass.child_nodes(pnode)]
+        await mooltipass.end_memory_management()
+        return logins
+    assert run(emulator, walk) == {'a.com': ['ann', 'bob'], 'b.com': ['cat']}
+
+
+@pytest.mark.parametrize('kwargs', [
+        {},
+        {'compression': 'zlib'},
+        {'digest': True},
+        {'compression': 'auto', 'digest': True},
+])
+def test_data(emulator, mooltipass, kwargs):
+    async def write(mooltipass):
+        assert await mooltipass.add_data_context('data')
+        assert await mooltipass.set_data_context('data')
+        assert await mooltipass.write_data_context(TEXT, **kwargs)
+        assert await mooltipass.set_data_context('data')
+        return (await mooltipass.read_data_context()).tobytes()
+    assert run(emulator, write) == TEXT
+
+    # Stored as the blocking client stores it
+    assert mooltipass.set_data_context('data')
+    assert mooltipass.read_data_context().tobytes() == TEXT
+    assert mooltipass.set_data_context('data')
+    digest = data_digest([TEXT], len(TEXT)) if kwargs.get('digest') else None
+    assert mooltipass.read_data_digest() == digest
+
+
+def test_read_compressed(emulator, mooltipass, add_data):
+    add_data('data', TEXT, compression='zlib')
+
+    async def read(mooltipass):
+        assert await mooltipass.set_data_context('data')
+        return (await mooltipass.read_data_context()).tobytes()
+    assert run(emulator, read) == TEXT
@@ -0,0 +1,91 @@
+import pytest
+
+from mooltipy.constants import *
+from mooltipy.mooltipass import BATCH_WINDOW, _Mooltipass
+
+
+def test_params(mooltipass):
+    names = ['key_delay', 'lock_timeout', 'offline_mode']
+    params = [mooltipass.valid_params[name].param for name in names]
+    assert mooltipass.get_params(params) == \
+            [mooltipass.valid_params[name].default_value for name in names]
+    assert mooltipass.last_batch.round_trips == 1
+
+
+def test_results_in_order(mooltipass):
+    batch = mooltipass.batch()
+    batch.add(CMD_MOOLTIPASS_STATUS)
+    key_delay = batch.get_param(mooltipass.valid_params['key_delay'].param)
+    batch.add(CMD_MOOLTIPASS_STATUS)
+    results = batch.send()
+    assert len(results) == 3
+    assert results[key_delay] == mooltipass.valid_params['key_delay'].default_value
+
+
+def test_window(mooltipass):
+    batch = mooltipass.batch(8)
+    for _ in range(20):
+        batch.add(CMD_MOOLTIPASS_STATUS)
+    assert len(batch.send()) == 20
+    assert batch.round_trips == 3
+
+
+def test_default_window_is_bounded(mooltipass):
+    batch = mooltipass.batch()
+    for _ in range(20):
+        batch.add(CMD_MOOLTIPASS_STATUS)
+    assert len(batch.send()) == 20
+    assert batch.round_trips == -(-20 // BATCH_WINDOW)
+
+
+def test_larger_window(mooltipass):
+    batch = mooltipass.batch(32)
+    for _ in range(20):
+        batch.add(CMD_MOOLTIPASS_STATUS)
+    batch.send()
+    assert batch.round_trips == 1
+
+
+def test_read_nodes(mooltipass, emulator, add_logins):
+    add_logins({'a.com': ['ann'], 'b.com': ['bob']})
+    mooltipass.start_memory_management()
+    addrs = [pnode.addr for pnode in mooltipass.parent_nodes('login')]
+    nodes = _Mooltipass.read_nodes(mooltipass, addrs)
+    assert [node.tobytes() for node in nodes] == [bytes(emulator.node(addr)) for addr in addrs]
+    free = next(addr for addr in emulator.node_addrs() if emulator.is_free(addr))
+    with pytest.raises(RuntimeError):
+        _Mooltipass.read_nodes(mooltipass, [addrs[0], free])
+    mooltipass.end_memory_management()
+
+
+def test_replies_decoded(mooltipass, add_logins):
+    add_logins({'a.com': ['ann'], 'b.com': ['bob']})
+    batch = mooltipass.batch()
+    batch.add(CMD_CONTEXT, 'b.com')
+    batch.add(CMD_GET_LOGIN)
+    batch.add(CMD_CONTEXT, 'a.com')
+    batch.add(CMD_GET_LOGIN)
+    batch.add(CMD_CONTEXT, 'z.com')
+    assert batch.send() == [1, 'bob', 1, 'ann', 0]
+
+
+def test_refused_nodes(mooltipass, emulator, add_logins):
+    add_logins({'a.com': ['ann']})
+    mooltipass.start_memory_management()
+    addr = mooltipass.get_starting_parent_address()
+    free = mooltipass.free_slots()[0]
+    with pytest.raises(RuntimeError):
+        _Mooltipass.read_nodes(mooltipass, [addr, free])
+    recvs = _Mooltipass.read_nodes(mooltipass, [free, addr], strict=False)
+    assert recvs[0] is None
+    assert recvs[1].tobytes() == bytes(emulator.node(addr))
+    mooltipass.end_memory_management()
+
+
+def test_refused_outside_memory_management(mooltipass):
+    batch = mooltipass.batch()
+    batch.add(CMD_GET_CTRVALUE)
+    batch.add(CMD_GET_STARTING_PARENT)
+    with pytest.raises(RuntimeError):
+        batch.send()
+    assert batch.send(strict=False) == [None, None]
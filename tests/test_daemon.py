@@ -0,0 +1,133 @@
+import os
+import threading
+import time
+
+import pytest
+
+from mooltipy import MooltipassClient
+from mooltipy.constants import *
+from mooltipy.daemon import MooltipassDaemon, connect
+from mooltipy.mooltipass import _Mooltipass
+
+
+@pytest.fixture
+def daemon(emulator, tmp_path):
+    """Serve emulator from a daemon on a worker thread."""
+    daemon = MooltipassDaemon(str(tmp_path / 'daemon.sock'), device=emulator)
+    threading.Thread(target=daemon.serve_forever, daemon=True).start()
+    for _ in range(100):
+        if os.path.exists(daemon.path):
+            break
+        time.sleep(0.01)
+    return daemon
+
+
+@pytest.fixture
+def client(daemon):
+    """Return a function connecting a new client to the daemon.
+
+    The daemon serves one client at a time, so the last one connected
+    is disconnected first.
+    """
+    connections = []
+
+    def client(cls=MooltipassClient):
+        if connections:
+            connections.pop().close()
+        connections.append(connect(daemon.path))
+        return cls(connections[-1])
+    yield client
+    if connections:
+        connections.pop().close()
+
+
+def replies(mooltipass, count):
+    return [mooltipass._read_packet(2000)[_Mooltipass._CMD_INDEX] for _ in range(count)]
+
+
+def test_relays(emulator, daemon, client):
+    mooltipass = client()
+    assert mooltipass.add_context('a.com')
+    assert mooltipass.set_context('a.com')
+    assert mooltipass.set_login('ann')
+    assert client().set_context('a.com')
+
+
+def test_busy(daemon, client):
+    first = client()
+    with pytest.raises(RuntimeError, match='busy'):
+        connect(daemon.path, timeout=0.2)
+    assert first.set_context('a.com') == 0
+
+
+def test_idle_client_disconnected(daemon, client):
+    daemon.idle_timeout = 0.2
+    first = connect(daemon.path)
+    time.sleep(0.5)
+    assert client().ping()
+    first.close()
+
+
+def test_session_kept(emulator, daemon, client, mooltipass, add_logins):
+    add_logins({'a.com': ['ann']})
+    first = client()
+    first.start_memory_management()
+    assert [p.service_name for p in first.parent_nodes('login')] == ['a.com']
+    first.end_memory_management()
+    assert daemon._memory_management
+
+    # The next client needs no confirmation
+    emulator.approve = False
+    second = client()
+    second.start_memory_management()
+    assert [p.service_name for p in second.parent_nodes('login')] == ['a.com']
+    second.end_memory_management()
+
+    # Leaving the session for a context command
+    emulator.approve = True
+    assert second.set_context('a.com')
+    assert not daemon._memory_management
+
+
+def test_pipelined_acks_in_order(emulator, daemon, client, mooltipass, add_logins):
+    add_logins({'a.com': ['ann']})
+    raw = client(_Mooltipass)
+    assert raw._command(CMD_START_MEMORYMGMT, timeout=5000)
+    addr = raw._command(CMD_GET_STARTING_PARENT)
+
+    raw._send_command(CMD_READ_FLASH_NODE, (addr,))
+    raw._send_command(CMD_END_MEMORYMGMT)
+    raw._send_command(CMD_START_MEMORYMGMT)
+    raw._send_command(CMD_GET_CTRVALUE)
+    assert replies(raw, 6) == [CMD_READ_FLASH_NODE] * 3 + \
+            [CMD_END_MEMORYMGMT, CMD_START_MEMORYMGMT, CMD_GET_CTRVALUE]
+
+
+def test_pipelined_exit_in_order(emulator, daemon, client, mooltipass, add_logins):
+    add_logins({'a.com': ['ann']})
+    raw = client(_Mooltipass)
+    assert raw._command(CMD_START_MEMORYMGMT, timeout=5000)
+    addr = raw._command(CMD_GET_STARTING_PARENT)
+
+    raw._send_command(CMD_READ_FLASH_NODE, (addr,))
+    raw._send_command(CMD_END_MEMORYMGMT)
+    raw._send_command(CMD_CONTEXT, ('a.com',))
+    assert replies(raw, 5) == [CMD_READ_FLASH_NODE] * 3 + \
+            [CMD_END_MEMORYMGMT, CMD_CONTEXT]
+    assert not daemon._memory_management
+
+
+def test_node_graph_cached_between_clients(emulator, daemon, client, mooltipass, add_logins):
+    add_logins({'a.com': ['ann']})
+    first = client()
+    first.start_memory_management()
+    assert [p.service_name for p in first.node_graph().parent_nodes('login')] == ['a.com']
+    first.end_memory_management()
+
+    emulator.approve = False
+    second = client()
+    second.start_memory_management()
+    assert second._card_cpz == emulator.cpz
+    assert [p.service_name for p in second.node_graph().parent_nodes('login')] == ['a.com']
+    assert daemon._memory_management
+    second.end_memory_management()
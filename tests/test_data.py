@@ -0,0 +1,251 @@
+import io
+import os
+import struct
+
+import pytest
+
+from mooltipy.compression import CONTAINER_FLAG, DIGEST_FLAG, LENGTH_MASK
+from mooltipy.constants import CMD_READ_32B_IN_DN
+from mooltipy.mooltipass_client import bundle_chunk_name, data_digest
+
+
+TEXT = b'The quick brown fox jumps over the lazy dog. ' * 100
+NOISE = os.urandom(2000)
+
+
+def read(mooltipass, context):
+    assert mooltipass.set_data_context(context)
+    return mooltipass.read_data_context().tobytes()
+
+
+def header(mooltipass, context):
+    """Return the length word stored ahead of the data of context."""
+    assert mooltipass.set_data_context(context)
+    return struct.unpack('>L', bytes(mooltipass._command(CMD_READ_32B_IN_DN)[:4]))[0]
+
+
+@pytest.mark.parametrize('size', [0, 1, 28, 29, 124, 125, 1000])
+def test_round_trip(mooltipass, add_data, size):
+    data = NOISE[:size]
+    add_data('data', data)
+    assert read(mooltipass, 'data') == data
+    assert header(mooltipass, 'data') == size
+
+
+def test_context_written_once(mooltipass, add_data):
+    add_data('data', b'first')
+    assert mooltipass.set_data_context('data')
+    with pytest.raises(RuntimeError):
+        mooltipass.write_data_context(b'second')
+
+
+def test_stream(mooltipass):
+    assert mooltipass.add_data_context('data')
+    assert mooltipass.set_data_context('data')
+    progress = []
+    mooltipass.write_data_stream(io.BytesIO(NOISE), len(NOISE), progress.append)
+    assert progress[-1] == (len(NOISE) + 4, len(NOISE) + 4)
+
+    assert mooltipass.set_data_context('data')
+    sink = io.BytesIO()
+    assert mooltipass.read_data_stream(sink) == len(NOISE)
+    assert sink.getvalue() == NOISE
+
+
+def test_stream_chunks(mooltipass):
+    # Blocks both inside and across chunks
+    chunks = [NOISE[:5], NOISE[5:100], NOISE[100:101], NOISE[101:]]
+    assert mooltipass.add_data_context('data')
+    assert mooltipass.set_data_context('data')
+    mooltipass.write_data_stream(iter(chunks), len(NOISE))
+    assert read(mooltipass, 'data') == NOISE
+
+
+def test_stream_ends_early(mooltipass):
+    assert mooltipass.add_data_context('data')
+    assert mooltipass.set_data_context('data')
+    with pytest.raises(RuntimeError):
+        mooltipass.write_data_stream(io.BytesIO(NOISE[:100]), 200)
+    # The reply to the terminating block was read
+    assert mooltipass.status == 5
+    assert not mooltipass.set_data_context('other')
+
+
+def test_stream_interrupted(mooltipass):
+    def source():
+        yield NOISE[:40]
+        raise KeyboardInterrupt
+
+    assert mooltipass.add_data_context('data')
+    assert mooltipass.set_data_context('data')
+    with pytest.raises(KeyboardInterrupt):
+        mooltipass.write_data_stream(source(), 100)
+    assert mooltipass.status == 5
+    assert not mooltipass.set_data_context('other')
+
+
+def test_read_into(mooltipass, add_data):
+    add_data('data', NOISE[:300])
+    buffer = bytearray(512)
+    assert mooltipass.set_data_context('data')
+    assert mooltipass.read_data_context_into(buffer) == 300
+    assert buffer[:300] == NOISE[:300]
+
+    assert mooltipass.set_data_context('data')
+    with pytest.raises(RuntimeError):
+        mooltipass.read_data_context_into(bytearray(100))
+    # Read to the end regardless, so the next command is answered
+    assert read(mooltipass, 'data') == NOISE[:300]
+
+
+@pytest.mark.parametrize('compression', ['zlib', 'lzma', 'auto'])
+def test_compression(mooltipass, add_data, compression):
+    add_data('data', TEXT, compression=compression)
+    assert read(mooltipass, 'data') == TEXT
+    lod = header(mooltipass, 'data')
+    assert lod & CONTAINER_FLAG
+    assert lod & LENGTH_MASK < len(TEXT) // 4
+
+
+def test_incompressible(mooltipass, add_data):
+    add_data('data', NOISE, compression='auto')
+    assert read(mooltipass, 'data') == NOISE
+    assert header(mooltipass, 'data') == len(NOISE)
+
+
+def test_compressed_stream(mooltipass):
+    # A pipe can only be read once, so it is stored compressed
+    assert mooltipass.add_data_context('data')
+    assert mooltipass.set_data_context('data')
+    chunks = iter([TEXT[:1000], TEXT[1000:]])
+    mooltipass.write_data_stream(chunks, len(TEXT), compression='auto')
+    assert read(mooltipass, 'data') == TEXT
+
+
+def test_unknown_compression(mooltipass):
+    assert mooltipass.add_data_context('data')
+    assert mooltipass.set_data_context('data')
+    with pytest.raises(RuntimeError):
+        mooltipass.write_data_context(TEXT, compression='rle')
+
+
+def test_export(mooltipass, add_data):
+    add_data('a', TEXT)
+    add_data('b', TEXT, compression='zlib', digest=True)
+    add_data('c', b'')
+    mooltipass.start_memory_management()
+    exported = {name: data.tobytes() for name, data in mooltipass.export_data_contexts()}
+    assert exported == {'a': TEXT, 'b': TEXT, 'c': b''}
+    with pytest.raises(RuntimeError):
+        list(mooltipass.export_data_contexts(['a', 'missing']))
+    mooltipass.end_memory_management()
+
+
+def test_no_digest_by_default(mooltipass, add_data):
+    add_data('data', TEXT)
+    assert not header(mooltipass, 'data') & DIGEST_FLAG
+    assert mooltipass.set_data_context('data')
+    assert mooltipass.read_data_digest() is None
+
+
+@pytest.mark.parametrize('compression', [None, 'zlib'])
+def test_digest(mooltipass, add_data, compression):
+    add_data('data', TEXT, compression=compression, digest=True)
+    assert header(mooltipass, 'data') & DIGEST_FLAG
+    assert mooltipass.set_data_context('data')
+    assert mooltipass.read_data_digest() == data_digest([TEXT], len(TEXT))
+    assert read(mooltipass, 'data') == TEXT
+
+
+def test_digest_needs_data_twice(mooltipass):
+    assert mooltipass.add_data_context('data')
+    assert mooltipass.set_data_context('data')
+    with pytest.raises(RuntimeError):
+        mooltipass.write_data_stream(iter([TEXT]), len(TEXT), digest=True)
+
+
+def update(mooltipass, emulator, context, data):
+    """Update context to hold data; return (nodes written, nodes used)."""
+    mooltipass.start_memory_management()
+    written = mooltipass.update_data_context(context, data)
+    nodes = len(mooltipass.snapshot().data_nodes(context))
+    assert mooltipass.free_slots() == \
+            [addr for addr in emulator.node_addrs() if emulator.is_free(addr)]
+    mooltipass.end_memory_management()
+    assert read(mooltipass, context) == data
+    return written, nodes
+
+
+def test_update_one_byte(mooltipass, emulator, add_data):
+    add_data('data', TEXT)
+    new = TEXT[:1000] + b'!' + TEXT[1001:]
+    assert update(mooltipass, emulator, 'data', new)[0] == 1
+
+
+def test_update_grow(mooltipass, emulator, add_data):
+    add_data('data', TEXT)
+    written, nodes = update(mooltipass, emulator, 'data', TEXT + NOISE)
+    # The first node, holding the length, the last old one and the new ones
+    assert written == 2 + nodes - -(-(len(TEXT) + 4) // 128)
+
+
+def test_update_shrink(mooltipass, emulator, add_data):
+    add_data('data', TEXT)
+    written, nodes = update(mooltipass, emulator, 'data', TEXT[:100])
+    assert nodes == 1
+    # The first node and the erased ones
+    assert written == -(-(len(TEXT) + 4) // 128)
+
+
+def test_update_unchanged(mooltipass, add_data):
+    add_data('data', TEXT)
+    mooltipass.start_memory_management()
+    assert mooltipass.update_data_context('data', TEXT) == 0
+    mooltipass.end_memory_management()
+
+
+def test_update_empty_context(mooltipass):
+    assert mooltipass.add_data_context('data')
+    mooltipass.start_memory_management()
+    mooltipass.update_data_context('data', TEXT, digest=True)
+    mooltipass.end_memory_management()
+    assert read(mooltipass, 'data') == TEXT
+    assert mooltipass.set_data_context('data')
+    assert mooltipass.read_data_digest() == data_digest([TEXT], len(TEXT))
+
+
+def test_update_missing_context(mooltipass):
+    mooltipass.start_memory_management()
+    with pytest.raises(RuntimeError):
+        mooltipass.update_data_context('missing', TEXT)
+    mooltipass.end_memory_management()
+
+
+def test_bundle(mooltipass):
+    files = [('a.txt', TEXT), ('b.bin', NOISE), ('empty', b''), ('c.txt', TEXT[:10])]
+    manifest = mooltipass.write_bundle(
+            'bundle', [(path, io.BytesIO(data), len(data)) for path, data in files],
+            chunk_size=1024)
+    size = sum(len(data) for path, data in files)
+    assert manifest['chunks'] == [bundle_chunk_name('bundle', i)
+                                  for i in range(-(-size // 1024))]
+    assert mooltipass.read_bundle_manifest('bundle') == manifest
+
+    for path, data in files:
+        sink = io.BytesIO()
+        assert mooltipass.read_bundle_file('bundle', path, sink, manifest) == len(data)
+        assert sink.getvalue() == data
+    with pytest.raises(RuntimeError):
+        mooltipass.read_bundle_file('bundle', 'missing', io.BytesIO(), manifest)
+
+
+def test_bundle_exists(mooltipass, add_data):
+    add_data('bundle', b'')
+    with pytest.raises(RuntimeError):
+        mooltipass.write_bundle('bundle', [('a', io.BytesIO(TEXT), len(TEXT))])
+
+
+def test_not_a_bundle(mooltipass, add_data):
+    add_data('data', TEXT)
+    with pytest.raises(RuntimeError):
+        mooltipass.read_bundle_manifest('data')
@@ -0,0 +1,81 @@
+from mooltipy import MooltipassClient, MooltipassEmulator
+from mooltipy.commands import COMMANDS
+
+
+def test_version(mooltipass):
+    assert mooltipass.ping()
+    assert mooltipass.flash_size == 4
+    assert mooltipass.version == 'v1.2'
+
+
+def test_logins(mooltipass, add_logins):
+    add_logins({'example.com': ['alice', 'bob']}, 'secret')
+    assert mooltipass.set_context('example.com')
+    assert mooltipass.set_login('bob')
+    assert mooltipass.get_password() == 'secret'
+    assert mooltipass.set_context('missing.com') is False
+
+
+def test_refused_without_approval(mooltipass, emulator):
+    emulator.approve = False
+    assert not mooltipass.add_context('example.com')
+    assert not mooltipass.set_context('example.com')
+
+
+def test_no_card(mooltipass, emulator):
+    emulator.status = 0x00
+    assert mooltipass.get_status() == 0
+    assert mooltipass.set_context('example.com') is None
+    assert mooltipass._get_current_card_cpz() is None
+
+
+def test_params(mooltipass):
+    param = mooltipass.valid_params['key_delay'].param
+    assert mooltipass.set_param(param, 9)
+    assert mooltipass.get_param(param) == 9
+
+
+def test_state_file(tmp_path, add_logins, mooltipass, emulator):
+    path = str(tmp_path / 'emulator.json')
+    emulator.path = path
+    add_logins({'example.com': ['alice']})
+    loaded = MooltipassEmulator(path)
+    assert loaded.cpz == emulator.cpz
+    mooltipass = MooltipassClient(loaded)
+    assert mooltipass.set_context('example.com')
+    assert mooltipass.get_login() == 'alice'
+
+
+def test_emulator_from_environment(tmp_path, monkeypatch):
+    monkeypatch.setenv('MOOLTIPY_EMULATOR', str(tmp_path / 'emulator.json'))
+    assert MooltipassClient().add_context('example.com')
+    assert MooltipassClient().set_context('example.com')
+
+
+def test_cards_differ():
+    assert MooltipassEmulator().cpz != MooltipassEmulator().cpz
+
+
+def test_card_cpz(mooltipass, emulator):
+    assert mooltipass._get_current_card_cpz() == emulator.cpz
+
+
+def test_memory_management_refuses_context_commands(mooltipass):
+    mooltipass.start_memory_management()
+    assert not mooltipass.add_context('example.com')
+    mooltipass.end_memory_management()
+    assert mooltipass.add_context('example.com')
+
+
+def test_data_context(mooltipass):
+    assert mooltipass.add_data_context('data')
+    assert mooltipass.set_data_context('data')
+    assert mooltipass.write_data_context(b'x' * 100)
+    # The acknowledgement of the last block is read, not left queued
+    assert mooltipass.get_status() == 5
+    assert mooltipass.set_data_context('data')
+    assert mooltipass.read_data_context().tobytes() == b'x' * 100
+
+
+def test_emulated_commands_are_described(emulator):
+    assert set(emulator._handlers) <= set(COMMANDS)
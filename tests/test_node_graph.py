@@ -0,0 +1,99 @@
+import os
+
+import pytest
+
+from mooltipy.node_graph import NodeGraph, cache_path
+
+
+@pytest.fixture
+def graph(mooltipass, add_logins, add_data, node_reads):
+    """Return a function reading the graph, checked against the device.
+
+    The nodes node_graph() read are counted in graph.reads.
+    """
+    add_logins({'a.com': ['ann', 'bob'], 'b.com': ['cat'], 'c.com': ['dan']})
+    add_data('data', bytes(300))
+
+    def graph(use_cache=None):
+        mooltipass.start_memory_management()
+        node_reads[0] = 0
+        graph = mooltipass.node_graph(use_cache)
+        graph.reads = node_reads[0]
+        expected = NodeGraph.from_snapshot(mooltipass.snapshot())
+        mooltipass.end_memory_management()
+        assert graph._parents == expected._parents
+        assert graph._children == expected._children
+        return graph
+    return graph
+
+
+def cached(emulator):
+    return cache_path(emulator.cpz.hex())
+
+
+def test_cached_per_card(mooltipass, emulator, graph):
+    graph()
+    assert os.path.exists(cached(emulator))
+    assert os.listdir(os.path.dirname(cached(emulator))) == \
+            [os.path.basename(cached(emulator))]
+    cached_graph = graph()
+    assert cached_graph.reads == 0
+    assert cached_graph.parent('b.com').service_name == 'b.com'
+
+
+def test_other_card(mooltipass, emulator, graph):
+    graph()
+    emulator.cpz = os.urandom(len(emulator.cpz))
+    # A new session asks which card is inserted
+    assert graph().reads > 0
+    assert len(os.listdir(os.path.dirname(cached(emulator)))) == 2
+
+
+def test_password_changed(mooltipass, graph):
+    graph()
+    assert mooltipass.set_context('a.com')
+    assert mooltipass.set_login('bob')
+    assert mooltipass.set_password('new')
+    # Only the login nodes, whose dates may have changed, are read
+    assert graph().reads == 4
+
+
+def test_login_added(mooltipass, add_logins, graph):
+    graph()
+    add_logins({'b.com': ['abe'], '0.com': ['eve']})
+    assert graph().child('0.com', 'eve').login == 'eve'
+
+
+def test_login_deleted(mooltipass, graph):
+    graph()
+    mooltipass.start_memory_management()
+    snapshot = mooltipass.snapshot()
+    mooltipass.delete_nodes([snapshot.parent('a.com'), snapshot.child('b.com', 'cat')])
+    mooltipass.end_memory_management()
+    assert graph().parent('a.com') is None
+
+
+def test_data_added(mooltipass, add_data, graph):
+    graph()
+    add_data('more', bytes(1000))
+    assert len(graph().data_nodes('more')) == 8
+
+
+def test_no_cache(mooltipass, emulator, graph, monkeypatch):
+    graph(False)
+    assert not os.path.exists(cached(emulator))
+    monkeypatch.setenv('MOOLTIPY_NO_CACHE', '1')
+    graph()
+    assert not os.path.exists(cached(emulator))
+
+
+def test_no_card(mooltipass, emulator):
+    emulator.status = 0x00
+    mooltipass._card_cpz = None
+    assert mooltipass._node_graph_path() is None
+
+
+def test_refused(mooltipass, graph):
+    graph()
+    with pytest.raises(RuntimeError):
+        mooltipass.node_graph()
@@ -0,0 +1,337 @@
+from array import array
+import threading
+import time
+
+import pytest
+
+from mooltipy.commands import NODE_CHUNK_SIZE, NODE_CHUNKS
+from mooltipy.constants import CMD_WRITE_FLASH_NODE
+from mooltipy.mooltipass import _Mooltipass
+
+
+def test_read_node(mooltipass, emulator, add_logins):
+    add_logins({'a.com': ['ann']})
+    mooltipass.start_memory_management()
+    addr = mooltipass.get_starting_parent_address()
+    assert _Mooltipass.read_node(mooltipass, addr).tobytes() == bytes(emulator.node(addr))
+    mooltipass.end_memory_management()
+
+
+def test_refused_node_read_is_immediate(mooltipass, emulator):
+    mooltipass.start_memory_management()
+    start = time.time()
+    with pytest.raises(RuntimeError):
+        _Mooltipass.read_node(mooltipass, emulator.first_node_addr())
+    # A refusal is a short reply, not a USB timeout
+    assert time.time() - start < 0.5
+    mooltipass.end_memory_management()
+
+
+LOGINS = {
+    'a.com': ['ann', 'bob'],
+    'c.com': ['cat'],
+    'e.com': ['eve', 'fay', 'gus'],
+    'g.com': ['hal'],
+}
+
+
+def walk(mooltipass):
+    """Return {service: [login, ...]}, checking the links both ways."""
+    logins = {}
+    prev_parent = 0
+    for pnode in mooltipass.parent_nodes('login'):
+        assert pnode.prev_parent_addr == prev_parent
+        prev_parent = pnode.addr
+        prev_child = 0
+        logins[pnode.service_name] = []
+        for cnode in pnode.child_nodes():
+            assert cnode.prev_child_addr == prev_child
+            prev_child = cnode.addr
+            logins[pnode.service_name].append(cnode.login)
+    return logins
+
+
+@pytest.fixture
+def logins(mooltipass, add_logins):
+    add_logins(LOGINS)
+    mooltipass.start_memory_management()
+    yield mooltipass.snapshot()
+    mooltipass.end_memory_management()
+
+
+def test_snapshot(mooltipass, logins):
+    assert walk(mooltipass) == LOGINS
+    assert [p.service_name for p, c in logins.logins()].count('e.com') == 3
+    assert logins.child('e.com', 'fay').login == 'fay'
+    assert logins.child('e.com', 'zed') is None
+    assert logins.parent('g.com').service_name == 'g.com'
+    assert logins.nodes[logins.parent('c.com').addr].service_name == 'c.com'
+    assert logins.parent_nodes('data') == []
+
+
+def test_snapshot_dropped_when_written(mooltipass, logins):
+    assert mooltipass._snapshot is logins
+    cnode = logins.child('a.com', 'bob')
+    cnode.login = 'bea'
+    cnode.write()
+    assert mooltipass._snapshot is None
+    assert mooltipass.snapshot().child('a.com', 'bea').addr == cnode.addr
+
+
+def test_node_cache(mooltipass, logins):
+    pnode = next(iter(mooltipass.parent_nodes('login')))
+    mooltipass.clear_node_cache()
+    hits, misses = mooltipass.node_cache_hits, mooltipass.node_cache_misses
+    next(iter(pnode.child_nodes()))
+    cnode = next(iter(pnode.child_nodes()))
+    assert (mooltipass.node_cache_hits - hits, mooltipass.node_cache_misses - misses) == (1, 1)
+
+    # Copies are handed out, and writing drops the cached node
+    cnode.login = 'bea'
+    assert next(iter(pnode.child_nodes())).login == 'ann'
+    cnode.write()
+    assert next(iter(pnode.child_nodes())).login == 'bea'
+    assert (mooltipass.node_cache_hits - hits, mooltipass.node_cache_misses - misses) == (2, 2)
+
+
+def test_node_cache_dropped_under_io_lock(mooltipass, logins):
+    addr = mooltipass.get_starting_parent_address()
+    raw = mooltipass.read_node(addr).raw
+    held, release = threading.Event(), threading.Event()
+
+    def hold():
+        with mooltipass._io_lock:
+            held.set()
+            release.wait(5)
+    holder = threading.Thread(target=hold)
+    holder.start()
+    held.wait(5)
+    writer = threading.Thread(target=mooltipass._write_node, args=(addr, raw))
+    writer.start()
+    time.sleep(0.1)
+    # A read ahead worker holding the lock still sees the cached node
+    assert addr in mooltipass._node_cache
+    release.set()
+    writer.join()
+    holder.join()
+    assert addr not in mooltipass._node_cache
+
+
+def test_node_cache_cleared_between_sessions(mooltipass, logins):
+    mooltipass.read_node(mooltipass.get_starting_parent_address())
+    mooltipass.end_memory_management()
+    mooltipass.start_memory_management()
+    assert not mooltipass._node_cache
+
+
+def test_read_nodes(mooltipass, logins):
+    addrs = [pnode.addr for pnode in mooltipass.parent_nodes('login')]
+    mooltipass.clear_node_cache()
+    nodes = mooltipass.read_nodes(addrs)
+    assert [n.service_name for n in nodes] == list(LOGINS)
+    hits = mooltipass.node_cache_hits
+    mooltipass.read_nodes(addrs)
+    assert mooltipass.node_cache_hits - hits == len(LOGINS)
+
+    free = mooltipass.free_slots()[0]
+    with pytest.raises(RuntimeError):
+        mooltipass.read_nodes([addrs[0], free])
+    nodes = mooltipass.read_nodes([addrs[0], free], strict=False)
+    assert nodes[0].addr == addrs[0] and nodes[1] is None
+
+
+def test_node_round_trip(mooltipass, logins):
+    cnode = logins.child('a.com', 'bob')
+    raw = array('B', cnode.raw)
+    cnode.write()
+    mooltipass.clear_node_cache()
+    assert mooltipass.read_node(cnode.addr).raw == raw
+
+    cnode.login = 'bea'
+    assert cnode.login == 'bea'
+    cnode.write()
+    mooltipass.clear_node_cache()
+    assert mooltipass.read_node(cnode.addr).login == 'bea'
+
+
+def test_node_fields(logins):
+    pnode = logins.parent('e.com')
+    cnode = logins.child('e.com', 'fay')
+    assert pnode.next_child_addr == logins.child('e.com', 'eve').addr
+    assert cnode.next_child_addr == logins.child('e.com', 'gus').addr
+    assert isinstance(cnode.ctr, int)
+    assert 'fay' in str(cnode)
+    with pytest.raises(AttributeError):
+        cnode.unknown = 1
+
+
+def test_partial_writes(mooltipass, emulator, logins):
+    cnode = logins.child('e.com', 'fay')
+    cnode.login = 'fin'
+    assert len(cnode.dirty_chunks) < NODE_CHUNKS
+    cnode.write()
+    assert cnode.dirty_chunks == []
+    assert mooltipass.partial_node_writes
+    mooltipass.clear_node_cache()
+    assert mooltipass.read_node(cnode.addr).raw.tobytes() == bytes(emulator.node(cnode.addr))
+    assert walk(mooltipass)['e.com'] == ['eve', 'fin', 'gus']
+
+
+def test_partial_writes_not_committed(mooltipass, emulator, add_data):
+    # A device committing chunks only when written after the ones before
+    write_node = emulator._handlers[CMD_WRITE_FLASH_NODE]
+    last = [None]
+
+    def in_order_only(cmd, addr, chunk, payload):
+        if chunk == 0 or last[0] == (addr, chunk - 1):
+            write_node(cmd, addr, chunk, payload)
+        else:
+            emulator._reply(cmd, b'\x01')
+        last[0] = (addr, chunk)
+    emulator._handlers[CMD_WRITE_FLASH_NODE] = in_order_only
+
+    add_data('data', bytes(300))
+    mooltipass.start_memory_management()
+    dnode = mooltipass.snapshot().data_nodes('data')[0]
+    raw = array('B', dnode.raw)
+    raw[100] = 1
+    mooltipass._write_node(dnode.addr, raw, [1])
+    assert mooltipass.partial_node_writes is False
+    mooltipass.clear_node_cache()
+    assert mooltipass.read_node(dnode.addr).raw == raw
+    mooltipass.end_memory_management()
+
+
+def test_partial_writes_clear_other_chunks(mooltipass, emulator, add_data):
+    # A device erasing the last chunk when writing the one before
+    write_node = emulator._handlers[CMD_WRITE_FLASH_NODE]
+
+    def erasing(cmd, addr, chunk, payload):
+        if chunk == 1:
+            offset = emulator._offset(addr) + 2 * NODE_CHUNK_SIZE
+            emulator.flash[offset:offset+14] = bytes(14)
+        write_node(cmd, addr, chunk, payload)
+    emulator._handlers[CMD_WRITE_FLASH_NODE] = erasing
+
+    add_data('data', bytes(range(1, 256)))
+    mooltipass.start_memory_management()
+    dnode = mooltipass.snapshot().data_nodes('data')[0]
+    raw = array('B', dnode.raw)
+    raw[100] ^= 0xFF
+    mooltipass._write_node(dnode.addr, raw, [1])
+    assert mooltipass.partial_node_writes is False
+    mooltipass.clear_node_cache()
+    assert mooltipass.read_node(dnode.addr).raw == raw
+    mooltipass.end_memory_management()
+
+
+def test_free_slots(mooltipass, emulator, logins):
+    free = mooltipass.free_slots()
+    assert free == [addr for addr in emulator.node_addrs() if emulator.is_free(addr)]
+    allocated = mooltipass.allocate_nodes(3)
+    assert allocated == free[:3]
+    assert mooltipass.free_slots() == free[3:]
+    with pytest.raises(RuntimeError):
+        mooltipass.allocate_nodes(len(free))
+
+
+def test_delete_nodes(mooltipass, emulator, logins):
+    doomed = [logins.parent('a.com'), logins.child('e.com', 'eve'),
+              logins.child('e.com', 'gus'), logins.parent('g.com')]
+    addrs = [node.addr for node in doomed] + \
+            [cnode.addr for cnode in logins.child_nodes(logins.parent('a.com'))] + \
+            [cnode.addr for cnode in logins.child_nodes(logins.parent('g.com'))]
+    assert mooltipass.delete_nodes(doomed) == 7
+    assert all(emulator.is_free(addr) for addr in addrs)
+    mooltipass.clear_node_cache()
+    assert walk(mooltipass) == {'c.com': ['cat'], 'e.com': ['fay']}
+    assert sorted(mooltipass.free_slots()) == mooltipass.free_slots()
+    assert set(addrs) <= set(mooltipass.free_slots())
+
+
+def test_delete_nodes_not_linked(mooltipass, logins):
+    pnode = logins.parent('c.com')
+    mooltipass.delete_nodes([pnode])
+    with pytest.raises(RuntimeError):
+        mooltipass.delete_nodes([pnode])
+
+
+def test_import_logins(mooltipass, logins):
+    created = mooltipass.import_logins([
+            ('b.com', 'zoe'), ('a.com', 'amy'), ('e.com', 'gus'),
+            ('a.com', 'bob'), ('z.com', 'al'), ('0.com', 'x'), ('b.com', 'abe')])
+    assert created == [('b.com', 'zoe'), ('b.com', 'abe'), ('a.com', 'amy'),
+                       ('z.com', 'al'), ('0.com', 'x')]
+    mooltipass.clear_node_cache()
+    assert walk(mooltipass) == {
+        '0.com': ['x'],
+        'a.com': ['amy', 'ann', 'bob'],
+        'b.com': ['abe', 'zoe'],
+        'c.com': ['cat'],
+        'e.com': ['eve', 'fay', 'gus'],
+        'g.com': ['hal'],
+        'z.com': ['al'],
+    }
+    assert mooltipass.import_logins([('a.com', 'amy')]) == []
+
+    # The device finds the new logins as its own
+    mooltipass.end_memory_management()
+    assert mooltipass.set_context('b.com')
+    assert mooltipass.set_login('abe')
+    assert mooltipass.set_password('pw')
+    assert mooltipass.get_password() == 'pw'
+    mooltipass.start_memory_management()
+
+
+def test_import_logins_too_long(mooltipass, logins):
+    with pytest.raises(RuntimeError):
+        mooltipass.import_logins([('x' * 58, 'login')])
+
+
+@pytest.mark.parametrize('read_ahead', [1, 4])
+def test_read_ahead(mooltipass, logins, read_ahead):
+    mooltipass.clear_node_cache()
+    expected = walk(mooltipass)
+    mooltipass.clear_node_cache()
+    mooltipass.read_ahead = read_ahead
+    assert walk(mooltipass) == expected
+
+    # Abandoned iterators stop their worker
+    iterator = mooltipass.parent_nodes('login')
+    next(iterator)
+    del iterator
+
+
+def test_read_ahead_errors(mooltipass, logins):
+    pnode = logins.parent('c.com')
+    pnode.next_parent_addr = mooltipass.free_slots()[0]
+    pnode.write()
+    mooltipass.clear_node_cache()
+    with pytest.raises(RuntimeError):
+        list(mooltipass.parent_nodes('login', read_ahead=2))
+
+
+def test_read_ahead_passes_on_exit(mooltipass, logins):
+    # _read_packet exits on a debug packet; the consumer must see it
+    # rather than wait for the worker forever
+    read_node = mooltipass.read_node
+    reads = [0]
+
+    def exiting_read_node(addr, *args, **kwargs):
+        reads[0] += 1
+        if reads[0] == 2:
+            raise SystemExit('Debug packet')
+        return read_node(addr, *args, **kwargs)
+    mooltipass.read_node = exiting_read_node
+    mooltipass.clear_node_cache()
+    raised = []
+
+    def consume():
+        try:
+            list(mooltipass.parent_nodes('login', read_ahead=2))
+        except SystemExit as e:
+            raised.append(e)
+    consumer = threading.Thread(target=consume, daemon=True)
+    consumer.start()
+    consumer.join(5)
+    assert raised
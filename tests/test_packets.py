@@ -0,0 +1,32 @@
+import pytest
+
+from mooltipy.constants import *
+
+
+@pytest.fixture
+def sent(emulator, monkeypatch):
+    """Record every packet written to the emulator."""
+    packets = []
+    write = emulator.epout.write
+
+    def recording(data, timeout=None):
+        packets.append(bytes(data))
+        return write(data, timeout)
+    monkeypatch.setattr(emulator.epout, 'write', recording)
+    return packets
+
+
+def test_parts(mooltipass, sent):
+    mooltipass.send_packet(CMD_CONTEXT, (1, b'ab', memoryview(b'cd'), [0]))
+    assert sent[-1][:8] == bytes([6, CMD_CONTEXT, 1]) + b'abcd\0'
+
+
+def test_stale_tail_cleared(mooltipass, sent):
+    mooltipass.send_packet(CMD_CONTEXT, b'x' * 40)
+    mooltipass.send_packet(CMD_CONTEXT, b'y\0')
+    assert sent[-1] == bytes([2, CMD_CONTEXT]) + b'y' + bytes(61)
+
+
+def test_too_long(mooltipass):
+    with pytest.raises(RuntimeError):
+        mooltipass.send_packet(CMD_CONTEXT, (b'x' * 40, b'y' * 40))
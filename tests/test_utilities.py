@@ -0,0 +1,284 @@
+import csv
+import datetime
+import io
+import json
+import os
+import struct
+import sys
+
+import pytest
+
+from mooltipy import MooltipassClient, MooltipassEmulator
+from mooltipy.compression import CONTAINER_FLAG
+from mooltipy.constants import CMD_READ_32B_IN_DN
+from mooltipy.mooltipass_client import data_digest, decode_date, encode_date
+from mooltipy.utilities import mpdata, mplogin
+
+
+@pytest.fixture
+def state(tmp_path, monkeypatch):
+    """Run the utilities against an emulator saved in a state file."""
+    path = str(tmp_path / 'emulator.json')
+    monkeypatch.setenv('MOOLTIPY_EMULATOR', path)
+    return path
+
+
+def run(module, monkeypatch, capsys, *args):
+    """Run a utility; return what it wrote to stdout."""
+    capsys.readouterr()
+    monkeypatch.setattr(sys, 'argv', [module.__name__] + list(args))
+    module.main()
+    return capsys.readouterr().out
+
+
+def client(state):
+    return MooltipassClient(MooltipassEmulator(state))
+
+
+def password(mooltipass, context, login):
+    assert mooltipass.set_context(context)
+    assert mooltipass.set_login(login)
+    return mooltipass.get_password()
+
+
+def test_import(state, tmp_path, monkeypatch, capsys):
+    mooltipass = client(state)
+    assert mooltipass.add_context('a.com')
+    assert mooltipass.set_context('a.com')
+    for login in ('ann', 'bob'):
+        assert mooltipass.set_login(login)
+        assert mooltipass.set_password('old')
+
+    path = str(tmp_path / 'logins.csv')
+    with open(path, 'w', newline='') as fout:
+        csv.writer(fout).writerows([
+            ['context', 'login', 'password'],
+            ['a.com', 'ann'],
+            ['a.com', 'bob', 'changed'],
+            ['b.com', 'cat'],
+            ['b.com', 'dan', 'given'],
+        ])
+    out = run(mplogin, monkeypatch, capsys, 'import', path)
+    assert 'Created 2 logins.' in out
+    assert 'Set 3 passwords.' in out
+
+    mooltipass = client(state)
+    # Existing logins keep their password unless one is given
+    assert password(mooltipass, 'a.com', 'ann') == 'old'
+    assert password(mooltipass, 'a.com', 'bob') == 'changed'
+    assert len(password(mooltipass, 'b.com', 'cat')) == 31
+    assert password(mooltipass, 'b.com', 'dan') == 'given'
+
+
+def test_import_without_header(state, tmp_path, monkeypatch, capsys):
+    path = str(tmp_path / 'logins.csv')
+    with open(path, 'w', newline='') as fout:
+        csv.writer(fout).writerow(['a.com', 'ann', 'secret'])
+    out = run(mplogin, monkeypatch, capsys, 'import', path)
+    assert 'header' in out
+    assert not client(state).set_context('a.com')
+
+
+def test_import_exported(state, tmp_path, monkeypatch, capsys):
+    mooltipass = client(state)
+    assert mooltipass.add_context('a.com')
+    assert mooltipass.set_context('a.com')
+    assert mooltipass.set_login('ann')
+    assert mooltipass.set_password('old')
+
+    path = str(tmp_path / 'logins.csv')
+    run(mplogin, monkeypatch, capsys, 'export', '-f', 'csv', '-o', path)
+    out = run(mplogin, monkeypatch, capsys, 'import', path)
+    assert 'Created 0 logins.' in out
+    assert password(client(state), 'a.com', 'ann') == 'old'
+
+
+@pytest.mark.parametrize('fmt', ['jsonl', 'csv'])
+def test_export(state, tmp_path, monkeypatch, capsys, fmt):
+    mooltipass = client(state)
+    for context, login in (('a.com', 'ann'), ('b.com', 'bob')):
+        assert mooltipass.add_context(context)
+        assert mooltipass.set_context(context)
+        assert mooltipass.set_login(login)
+
+    path = str(tmp_path / 'logins')
+    run(mplogin, monkeypatch, capsys, 'export', '-f', fmt, '-o', path)
+    with open(path, newline='') as fin:
+        if fmt == 'jsonl':
+            records = [json.loads(line) for line in fin]
+        else:
+            records = list(csv.DictReader(fin))
+    assert [(r['context'], r['login']) for r in records] == [('a.com', 'ann'), ('b.com', 'bob')]
+    assert all('password' not in r for r in records)
+
+
+@pytest.mark.parametrize('fmt', ['jsonl', 'csv'])
+def test_export_to_stdout(state, monkeypatch, capsys, fmt):
+    mooltipass = client(state)
+    for context, login in (('a.com', 'ann'), ('b.com', 'bob')):
+        assert mooltipass.add_context(context)
+        assert mooltipass.set_context(context)
+        assert mooltipass.set_login(login)
+
+    out = run(mplogin, monkeypatch, capsys, 'export', '-f', fmt)
+    assert not out.endswith('\n\n')
+    if fmt == 'jsonl':
+        records = [json.loads(line) for line in out.splitlines()]
+    else:
+        records = list(csv.DictReader(io.StringIO(out)))
+    assert [(r['context'], r['login']) for r in records] == [('a.com', 'ann'), ('b.com', 'bob')]
+
+
+def test_list_without_cache(state, monkeypatch, capsys):
+    mooltipass = client(state)
+    assert mooltipass.add_context('a.com')
+    assert mooltipass.set_context('a.com')
+    assert mooltipass.set_login('ann')
+    cache = os.environ['MOOLTIPY_CACHE']
+
+    assert 'a.com' in run(mplogin, monkeypatch, capsys, 'list', '--no-cache')
+    assert not os.path.exists(cache)
+    assert 'a.com' in run(mplogin, monkeypatch, capsys, 'list')
+    assert os.listdir(cache)
+
+
+def test_dates():
+    assert decode_date(encode_date()) == datetime.date.today()
+    assert decode_date(0) is None
+
+
+@pytest.mark.parametrize('size', [[], ['-s', '1000']])
+def test_set_from_pipe(state, monkeypatch, capsys, size):
+    data = os.urandom(1000)
+    r, w = os.pipe()
+    with os.fdopen(w, 'wb') as fout:
+        fout.write(data)
+    monkeypatch.setattr(sys, 'stdin', io.TextIOWrapper(os.fdopen(r, 'rb')))
+    run(mpdata, monkeypatch, capsys, 'set', 'data', *size)
+
+    mooltipass = client(state)
+    assert mooltipass.set_data_context('data')
+    assert mooltipass.read_data_context().tobytes() == data
+
+
+@pytest.mark.parametrize('args, compressed', [([], False), (['-z', 'auto'], True)])
+def test_set_compressed(state, tmp_path, monkeypatch, capsys, args, compressed):
+    path = tmp_path / 'text'
+    path.write_bytes(b'text ' * 200)
+    run(mpdata, monkeypatch, capsys, 'set', 'data', str(path), *args)
+
+    mooltipass = client(state)
+    assert mooltipass.set_data_context('data')
+    lod = struct.unpack('>L', bytes(mooltipass._command(CMD_READ_32B_IN_DN)[:4]))[0]
+    assert bool(lod & CONTAINER_FLAG) == compressed
+    out = run(mpdata, monkeypatch, capsys, 'get', 'data')
+    assert out == 'text ' * 200
+
+
+def test_get_to_stdout(state, monkeypatch, capfdbinary):
+    mooltipass = client(state)
+    assert mooltipass.add_data_context('data')
+    assert mooltipass.set_data_context('data')
+    data = bytes(range(256)) * 4
+    assert mooltipass.write_data_context(data)
+
+    capfdbinary.readouterr()
+    monkeypatch.setattr(sys, 'argv', ['mpdata', 'get', 'data'])
+    mpdata.main()
+    assert capfdbinary.readouterr().out == data
+
+
+def test_export_all(state, tmp_path, monkeypatch, capsys):
+    mooltipass = client(state)
+    for context in ('a', 'b'):
+        assert mooltipass.add_data_context(context)
+        assert mooltipass.set_data_context(context)
+        assert mooltipass.write_data_context(context.encode() * 100)
+
+    out = str(tmp_path / 'out')
+    run(mpdata, monkeypatch, capsys, 'export-all', out)
+    for context in ('a', 'b'):
+        with open(os.path.join(out, context), 'rb') as fin:
+            assert fin.read() == context.encode() * 100
+
+
+def test_export_all_names(state, tmp_path, monkeypatch, capsys):
+    mooltipass = client(state)
+    for context in ('.', '..', 'a/b'):
+        assert mooltipass.add_data_context(context)
+        assert mooltipass.set_data_context(context)
+        assert mooltipass.write_data_context(b'data')
+
+    out = tmp_path / 'out'
+    run(mpdata, monkeypatch, capsys, 'export-all', str(out))
+    assert sorted(os.listdir(str(out))) == ['_.', '_..', 'a_b']
+    assert sorted(os.listdir(str(tmp_path))) == ['emulator.json', 'out']
+
+
+def test_set_update(state, tmp_path, monkeypatch, capsys):
+    path = str(tmp_path / 'data')
+    data = os.urandom(3000)
+    with open(path, 'wb') as fout:
+        fout.write(data)
+    run(mpdata, monkeypatch, capsys, 'set', 'data', path, '-z', 'none')
+
+    changed = data[:100] + b'!' + data[101:]
+    with open(path, 'wb') as fout:
+        fout.write(changed)
+    out = run(mpdata, monkeypatch, capsys, 'set', 'data', path, '--update')
+    assert '1 data nodes written' in out
+
+    mooltipass = client(state)
+    assert mooltipass.set_data_context('data')
+    assert mooltipass.read_data_context().tobytes() == changed
+
+
+def test_set_if_changed(state, tmp_path, monkeypatch, capsys):
+    path = str(tmp_path / 'data')
+    data = os.urandom(3000)
+    with open(path, 'wb') as fout:
+        fout.write(data)
+    run(mpdata, monkeypatch, capsys, 'set', 'data', path, '--if-changed')
+    mooltipass = client(state)
+    assert mooltipass.set_data_context('data')
+    assert mooltipass.read_data_digest() == data_digest([data], len(data))
+
+    out = run(mpdata, monkeypatch, capsys, 'set', 'data', path, '--if-changed')
+    assert 'data is unchanged' in out
+
+    changed = data[:100] + b'!' + data[101:]
+    with open(path, 'wb') as fout:
+        fout.write(changed)
+    out = run(mpdata, monkeypatch, capsys, 'set', 'data', path, '--if-changed')
+    assert '1 data nodes written' in out
+
+    mooltipass = client(state)
+    assert mooltipass.set_data_context('data')
+    assert mooltipass.read_data_context().tobytes() == changed
+    assert mooltipass.set_data_context('data')
+    assert mooltipass.read_data_digest() == data_digest([changed], len(changed))
+
+    out = run(mpdata, monkeypatch, capsys, 'set', 'data', path, '--if-changed')
+    assert 'data is unchanged' in out
+
+
+def test_bundle(state, tmp_path, monkeypatch, capfdbinary):
+    top = tmp_path / 'top'
+    (top / 'sub').mkdir(parents=True)
+    (top / 'a.txt').write_bytes(b'a' * 100)
+    (top / 'sub' / 'b.bin').write_bytes(os.urandom(3000))
+    run(mpdata, monkeypatch, capfdbinary, 'bundle', 'bun', str(top), '-c', '1024')
+
+    out = run(mpdata, monkeypatch, capfdbinary, 'get', 'bun:')
+    assert b'top/a.txt' in out and b'top/sub/b.bin' in out
+    out = run(mpdata, monkeypatch, capfdbinary, 'get', 'bun:top/sub/b.bin')
+    assert out == (top / 'sub' / 'b.bin').read_bytes()
+
+    # Too long to be a context name
+    deep = top / ('d' * 40) / ('e' * 40)
+    deep.mkdir(parents=True)
+    (deep / 'c.txt').write_bytes(b'c' * 10)
+    run(mpdata, monkeypatch, capfdbinary, 'bundle', 'deep', str(top / ('d' * 40)))
+    out = run(mpdata, monkeypatch, capfdbinary, 'get',
+              'deep:{}/{}/c.txt'.format('d' * 40, 'e' * 40))
+    assert out == b'c' * 10